@@ -0,0 +1,908 @@
+"""
+Benchmark offline del bot, eseguibili senza Telegram.
+
+Uso:
+    python benchmark.py handler [--richieste 5000] [--concorrenza 100] [--sorgente memoria|file|db]
+    python benchmark.py ingest [--righe 10000] [--ripetizioni 5] [--db]
+    python benchmark.py impianti [--impianti 20000] [--ricerche 5000] [--raggio 10]
+    python benchmark.py notifiche [--iscritti 100000] [--al-secondo 0] [--latenza-ms 40]
+    python benchmark.py metriche [--chiamate 200000]
+    python benchmark.py trigger [--richieste 500] [--ondate 3]
+    python benchmark.py classifica [--giorni 14] [--richieste 5000]
+    python benchmark.py storico [--richieste 200] [--worker 2]
+    python benchmark.py inline [--utenti 2000]
+    python benchmark.py backfill [--file 300] [--righe 2000] [--worker 4] [--db]
+
+Ogni benchmark stampa i risultati in JSON; con --output FILE li salva anche su file,
+così da poter confrontare esecuzioni diverse. Dove serve un database si usa quello
+indicato dalle variabili DB_* (--db / --sorgente db) oppure un sostituto in-process.
+"""
+import argparse
+import asyncio
+import hashlib
+import http.server
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import random
+import statistics
+import time
+from datetime import date, datetime
+
+import psycopg2.extensions
+from telegram.error import RetryAfter
+
+import bot
+
+# Riquadro approssimativo dell'Italia usato per generare dati sintetici
+LAT_MIN, LAT_MAX = 36.6, 47.1
+LON_MIN, LON_MAX = 6.6, 18.5
+
+
+def percentili(campioni_ms: list) -> dict:
+    """p50/p95/p99 e media di una lista di durate in millisecondi."""
+    ordinati = sorted(campioni_ms)
+    def p(q):
+        return ordinati[min(len(ordinati) - 1, int(q * len(ordinati)))]
+    return {
+        "p50_ms": p(0.50),
+        "p95_ms": p(0.95),
+        "p99_ms": p(0.99),
+        "media_ms": statistics.fmean(ordinati),
+    }
+
+
+# --- Handler Telegram ---
+
+class MessaggioFinto:
+    """Sostituto di telegram.Message: registra le chiamate alla Bot API."""
+
+    def __init__(self, testo: str, api):
+        self.text = testo
+        self.message_id = 1
+        self._api = api
+
+    async def reply_text(self, text, **kwargs):
+        return await self._api.chiamata("sendMessage")
+
+    async def reply_html(self, text, **kwargs):
+        return await self._api.chiamata("sendMessage")
+
+    async def reply_photo(self, photo, **kwargs):
+        # Un caricamento (bytes) costa più di un file_id già noto a Telegram
+        caricamento = isinstance(photo, bytes)
+        messaggio = await self._api.chiamata("sendPhoto (caricamento)" if caricamento else "sendPhoto (file_id)")
+        messaggio.photo = [type("FotoFinta", (), {"file_id": f"file-{hash(photo) if caricamento else photo}"})()]
+        return messaggio
+
+
+class ApiFinta:
+    """Bot API finta con latenza fissa; conta le chiamate per metodo."""
+
+    def __init__(self, latenza: float):
+        self._latenza = latenza
+        self.chiamate = {}
+
+    async def chiamata(self, metodo: str):
+        self.chiamate[metodo] = self.chiamate.get(metodo, 0) + 1
+        if self._latenza:
+            await asyncio.sleep(self._latenza)
+        return MessaggioFinto("", self)
+
+    async def edit_message_text(self, **kwargs):
+        return await self.chiamata("editMessageText")
+
+
+class UtenteFinto:
+    def mention_html(self):
+        return '<a href="tg://user?id=1">Utente</a>'
+
+
+class UpdateFinto:
+    def __init__(self, testo: str, api: ApiFinta, chat_id: int):
+        self.message = MessaggioFinto(testo, api)
+        self.effective_user = UtenteFinto()
+        self.effective_chat = type("ChatFinta", (), {"id": chat_id})()
+
+
+class ContestoFinto:
+    def __init__(self, api: ApiFinta):
+        self.bot = api
+        self.args = []
+        self.user_data = {}
+
+
+def snapshot_sintetico(rng: random.Random) -> bot.SnapshotPrezzi:
+    """Snapshot con prezzi casuali per tutte le regioni."""
+    oggi = date.today()
+    prezzi = {r: {c: round(rng.uniform(0.7, 2.1), 3) for c in bot.CARBURANTI} for r in bot.REGIONI_VALIDATE}
+    return bot.crea_snapshot_prezzi(prezzi, {r: oggi for r in bot.REGIONI_VALIDATE})
+
+
+def bench_handler(args) -> dict:
+    rng = random.Random(args.seed)
+    caricamento_file_ms = None
+    if args.sorgente == "memoria":
+        bot._snapshot_prezzi = snapshot_sintetico(rng)
+    elif args.sorgente == "file":
+        # Avvio a caldo con il DB irraggiungibile: si serve lo snapshot salvato su file
+        bot.SNAPSHOT_FILE = os.path.join(tempfile.mkdtemp(), "snapshot_prezzi.json")
+        bot.salva_snapshot_su_file(snapshot_sintetico(rng))
+        inizio = time.perf_counter()
+        bot.carica_snapshot_da_file()
+        caricamento_file_ms = (time.perf_counter() - inizio) * 1000
+    else:
+        bot._snapshot_prezzi = bot.SnapshotPrezzi() # Snapshot vuoto: ogni richiesta va al DB
+
+    comandi = []
+    for _ in range(args.richieste):
+        if rng.random() < args.quota_start:
+            comandi.append((bot.start_command, "/start"))
+        else:
+            comandi.append((bot.regione_command, "/" + rng.choice(bot.REGIONI_VALIDATE)))
+
+    async def esegui():
+        if args.sorgente == "db":
+            await bot.apri_pool_async()
+        api = ApiFinta(args.latenza_ms / 1000)
+        limite = asyncio.Semaphore(args.concorrenza)
+        durate = {"start": [], "regione": []}
+
+        async def richiesta(i, handler, testo):
+            async with limite:
+                inizio = time.perf_counter()
+                await handler(UpdateFinto(testo, api, chat_id=i), ContestoFinto(api))
+                nome = "start" if handler is bot.start_command else "regione"
+                durate[nome].append((time.perf_counter() - inizio) * 1000)
+
+        inizio = time.perf_counter()
+        await asyncio.gather(*(richiesta(i, h, t) for i, (h, t) in enumerate(comandi)))
+        totale = time.perf_counter() - inizio
+        if args.sorgente == "db":
+            await bot.chiudi_pool_async()
+        return durate, totale, api
+
+    durate, totale, api = asyncio.run(esegui())
+    return {
+        "benchmark": "handler",
+        "sorgente": args.sorgente,
+        "caricamento_snapshot_file_ms": caricamento_file_ms,
+        "richieste": len(comandi),
+        "concorrenza": args.concorrenza,
+        "latenza_bot_ms": args.latenza_ms,
+        "durata_s": totale,
+        "richieste_al_secondo": len(comandi) / totale,
+        "latenza": {nome: percentili(valori) for nome, valori in durate.items() if valori},
+        "chiamate_bot_api": api.chiamate,
+        "cache_messaggi": bot.statistiche_cache_messaggi.valori(),
+    }
+
+
+# --- Import del CSV regionale ---
+
+class CursoreFinto:
+    """Cursore psycopg2 minimale: accetta le query di update_database e conta le righe copiate."""
+
+    def __init__(self, connessione):
+        self._connessione = connessione
+        self.rowcount = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, query, parametri=None):
+        # L'INSERT ... SELECT dalla tabella di staging "inserisce" tutte le righe copiate
+        self.rowcount = self._connessione.righe_in_staging if query.lstrip().startswith("INSERT") else 0
+
+    def copy_expert(self, query, buffer):
+        self._connessione.righe_in_staging = sum(1 for _ in buffer)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+class ConnessioneFinta:
+    """Sostituto in-process di una connessione PostgreSQL, per misurare il resto della pipeline."""
+
+    def __init__(self):
+        self.closed = False
+        self.righe_in_staging = 0
+
+    def cursor(self):
+        return CursoreFinto(self)
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.righe_in_staging = 0
+
+    def rollback(self):
+        self.righe_in_staging = 0
+
+    def close(self):
+        self.closed = True
+
+
+def genera_csv_regionale(righe: int, rng: random.Random, giorno: date | None = None) -> bytes:
+    """CSV nel formato MIMIT con `righe` righe valide distribuite sulle regioni."""
+    per_regione = max(1, righe // len(bot.REGIONI_VALIDATE))
+    linee = [f"Prezzi medi regionali aggiornati al {giorno or date.today():%d-%m-%Y}", "Regione;Tipo;Modalita;Prezzo"]
+    for regione in bot.REGIONI_VALIDATE:
+        for i in range(per_regione):
+            tipo = bot.CARBURANTI[i] if i < len(bot.CARBURANTI) else f"Carburante {i}"
+            linee.append(f"{regione};{tipo};self;{rng.uniform(0.7, 2.1):.3f}".replace(".", ","))
+    return ("\n".join(linee) + "\n").encode("utf-8")
+
+
+def avvia_server_http(contenuti: dict, condizionale: bool = False):
+    """
+    Serve `contenuti` ({percorso: bytes}) su una porta locale libera; restituisce (server, url_base).
+    Con condizionale=True ogni risposta porta ETag (hash del contenuto) e Last-Modified, e una
+    richiesta con If-None-Match uguale all'ETag riceve 304. Le richieste ricevute, come
+    (percorso, intestazioni), finiscono in server.richieste.
+    """
+    richieste = []
+
+    class Gestore(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            richieste.append((self.path, dict(self.headers)))
+            corpo = contenuti.get(self.path)
+            if corpo is None:
+                self.send_error(404)
+                return
+            etag = f'"{hashlib.sha256(corpo).hexdigest()[:16]}"'
+            if condizionale and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Length", str(len(corpo)))
+            if condizionale:
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", "Wed, 14 Oct 2026 08:00:00 GMT")
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Gestore)
+    server.richieste = richieste
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def usa_database_in_process() -> None:
+    """Fa puntare il pool del bot al sostituto in-process di PostgreSQL."""
+    bot.SNAPSHOT_FILE = os.path.join(tempfile.mkdtemp(), "snapshot_prezzi.json")
+    bot.DB_HOST = bot.DB_PORT = bot.DB_NAME = bot.DB_USER = bot.DB_PASSWORD = "in-process"
+    bot._db_pool = bot.PoolConnessioni(ConnessioneFinta, 1, 2, 300, 10, 30)
+
+
+def bench_ingest(args) -> dict:
+    rng = random.Random(args.seed)
+    server, url_base = avvia_server_http({"/MediaRegionaleStradale.csv": genera_csv_regionale(args.righe, rng)})
+    bot.CSV_URL = url_base + "/MediaRegionaleStradale.csv"
+    bot.STATO_DOWNLOAD_FILE = os.path.join(tempfile.mkdtemp(), "stato_download.json")
+    if not args.db:
+        usa_database_in_process()
+
+    esecuzioni = []
+    try:
+        for _ in range(args.ripetizioni):
+            report = {}
+            inizio = time.perf_counter()
+            if not bot.update_database(report, forza=True):
+                raise SystemExit("update_database fallito: vedi il log.")
+            report["totale"] = time.perf_counter() - inizio
+            esecuzioni.append(report)
+    finally:
+        server.shutdown()
+
+    fasi = {}
+    for report in esecuzioni:
+        for fase, secondi in report["tempi"].items():
+            fasi.setdefault(fase, []).append(secondi * 1000)
+    totali = [r["totale"] for r in esecuzioni]
+    righe_valide = esecuzioni[-1]["righe_valide"]
+    return {
+        "benchmark": "ingest",
+        "database": "postgres" if args.db else "in-process",
+        "righe_csv": args.righe,
+        "righe_valide": righe_valide,
+        "ripetizioni": len(esecuzioni),
+        "righe_al_secondo": righe_valide / statistics.median(totali),
+        "totale_mediana_ms": statistics.median(totali) * 1000,
+        "fasi_mediana_ms": {fase: statistics.median(valori) for fase, valori in fasi.items()},
+        "ultima_esecuzione": {k: v for k, v in esecuzioni[-1].items() if k in ("inserite", "saltate", "scartate")},
+    }
+
+
+# --- Backfill di un archivio ---
+
+def bench_backfill(args) -> dict:
+    """Archivio sintetico di CSV giornalieri: un crash simulato a metà, poi ripresa dal checkpoint."""
+    rng = random.Random(args.seed)
+    cartella = tempfile.mkdtemp()
+    oggi = date.today().toordinal()
+    for i in range(args.file):
+        giorno = date.fromordinal(oggi - i)
+        sottocartella = os.path.join(cartella, str(giorno.year))
+        os.makedirs(sottocartella, exist_ok=True)
+        with open(os.path.join(sottocartella, f"MediaRegionaleStradale_{giorno:%Y%m%d}.csv"), "wb") as f:
+            f.write(genera_csv_regionale(args.righe, rng, giorno))
+    bot.RETENTION_GIORNI = args.file # tutto l'archivio rientra nella retention
+    if not args.db:
+        usa_database_in_process()
+
+    # Primo tentativo: il DB "cade" al terzo lotto
+    copia = bot.copia_in_prezzi_regionali
+    lotti = 0
+    def copia_instabile(conn, testo_csv, giorni):
+        nonlocal lotti
+        lotti += 1
+        if lotti == 3:
+            raise psycopg2.OperationalError("connessione persa (simulata)")
+        return copia(conn, testo_csv, giorni)
+    bot.copia_in_prezzi_regionali = copia_instabile
+    interrotto = bot.backfill(cartella, worker=args.worker, righe_per_lotto=args.righe_per_lotto)
+    bot.copia_in_prezzi_regionali = copia
+
+    ripresa = bot.backfill(cartella, worker=args.worker, righe_per_lotto=args.righe_per_lotto)
+    ripetuto = bot.backfill(cartella, worker=args.worker, righe_per_lotto=args.righe_per_lotto)
+    return {
+        "benchmark": "backfill",
+        "file": args.file,
+        "righe_per_file": args.righe,
+        "worker": args.worker,
+        "interrotto": {k: interrotto[k] for k in ("esito", "file_gia_importati", "lotti", "righe_valide")},
+        "ripresa": ripresa,
+        "terza_esecuzione_file_da_importare": ripetuto["file_totali"] - ripetuto["file_gia_importati"],
+    }
+
+
+# --- Distributori ---
+
+def genera_impianti(numero: int, rng: random.Random):
+    """Anagrafica e prezzi sintetici: ~5 prezzi per impianto, addensati attorno ad alcune città."""
+    centri = [(rng.uniform(LAT_MIN, LAT_MAX), rng.uniform(LON_MIN, LON_MAX)) for _ in range(60)]
+    impianti = {}
+    prezzi = []
+    for id_impianto in range(1, numero + 1):
+        lat_c, lon_c = rng.choice(centri)
+        lat = min(max(rng.gauss(lat_c, 0.3), LAT_MIN), LAT_MAX)
+        lon = min(max(rng.gauss(lon_c, 0.3), LON_MIN), LON_MAX)
+        impianti[id_impianto] = bot.Impianto(
+            id_impianto, f"Gestore {id_impianto}", rng.choice(["Eni", "Q8", "IP", "Tamoil", "Pompe Bianche"]),
+            f"Impianto {id_impianto}", f"Via Roma {id_impianto}", "Comune", "XX", lat, lon
+        )
+        for carburante in ("Benzina", "Gasolio"):
+            for self_service in (True, False):
+                prezzi.append((id_impianto, carburante, round(rng.uniform(1.6, 2.1), 3), self_service))
+        if rng.random() < 0.3:
+            prezzi.append((id_impianto, rng.choice(["GPL", "Metano"]), round(rng.uniform(0.6, 1.5), 3), False))
+    return impianti, prezzi
+
+
+def bench_impianti(args) -> dict:
+    rng = random.Random(args.seed)
+    impianti, prezzi = genera_impianti(args.impianti, rng)
+
+    inizio = time.perf_counter()
+    indice = bot.IndiceImpianti(impianti, prezzi)
+    costruzione_ms = (time.perf_counter() - inizio) * 1000
+
+    # Le ricerche partono vicino a impianti esistenti, come farebbe un utente reale
+    elenco = list(impianti.values())
+    punti = []
+    for _ in range(args.ricerche):
+        impianto = rng.choice(elenco)
+        punti.append((impianto.latitudine + rng.uniform(-0.05, 0.05), impianto.longitudine + rng.uniform(-0.05, 0.05),
+                      rng.choice(bot.CARBURANTI)))
+
+    durate = []
+    for lat, lon, carburante in punti:
+        inizio = time.perf_counter()
+        indice.cerca(lat, lon, carburante, args.raggio, bot.NUMERO_DISTRIBUTORI)
+        durate.append((time.perf_counter() - inizio) * 1000)
+
+    # Verifica su un campione contro una scansione lineare di tutti gli impianti
+    migliori = {}
+    for id_impianto, carburante, prezzo, self_service in prezzi:
+        chiave = (id_impianto, carburante)
+        if chiave not in migliori or prezzo < migliori[chiave]:
+            migliori[chiave] = prezzo
+    discordanze = 0
+    for lat, lon, carburante in punti[:50]:
+        attesi = sorted(
+            (prezzo, bot.distanza_km(lat, lon, impianti[i].latitudine, impianti[i].longitudine))
+            for (i, c), prezzo in migliori.items()
+            if c == carburante and bot.distanza_km(lat, lon, impianti[i].latitudine, impianti[i].longitudine) <= args.raggio
+        )[:bot.NUMERO_DISTRIBUTORI]
+        ottenuti = [(prezzo, distanza) for prezzo, distanza, _, _ in indice.cerca(lat, lon, carburante, args.raggio, bot.NUMERO_DISTRIBUTORI)]
+        if attesi != ottenuti:
+            discordanze += 1
+
+    return {
+        "benchmark": "impianti",
+        "impianti": len(impianti),
+        "prezzi": len(prezzi),
+        "costruzione_indice_ms": costruzione_ms,
+        "ricerche": len(durate),
+        "raggio_km": args.raggio,
+        "ricerca": percentili(durate),
+        "ricerche_al_secondo": len(durate) / (sum(durate) / 1000),
+        "discordanze_scansione_lineare": discordanze,
+    }
+
+
+class BotFinto:
+    """Bot API finta: ogni send_message costa `latenza` secondi e può rispondere con RetryAfter."""
+
+    def __init__(self, latenza: float, probabilita_retry_after: float, rng: random.Random):
+        self._latenza = latenza
+        self._probabilita_retry_after = probabilita_retry_after
+        self._rng = rng
+        self.invii_per_chat = {} # chat_id -> istanti di invio
+        self.retry_after = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        istante = time.perf_counter()
+        await asyncio.sleep(self._latenza)
+        if self._rng.random() < self._probabilita_retry_after:
+            self.retry_after += 1
+            raise RetryAfter(1)
+        self.invii_per_chat.setdefault(chat_id, []).append(istante)
+
+
+def bench_notifiche(args) -> dict:
+    rng = random.Random(args.seed)
+    # Un iscritto su 20 ha più avvisi scattati insieme, per esercitare il limite per chat
+    notifiche = []
+    for i in range(args.iscritti):
+        chat_id = rng.randrange(args.iscritti // 20) if rng.random() < 0.05 else 1_000_000 + i
+        notifiche.append((chat_id, f"🔔 Avviso {i}", None))
+
+    async def esegui():
+        bot_finto = BotFinto(args.latenza_ms / 1000, args.retry_after, rng)
+        dispatcher = bot.DispatcherNotifiche(
+            bot_finto, messaggi_al_secondo=args.al_secondo or None,
+            intervallo_chat=args.intervallo_chat, numero_worker=args.worker
+        )
+        dispatcher.avvia()
+        inizio = time.perf_counter()
+        dispatcher.accoda(notifiche)
+        await dispatcher.attendi_svuotamento()
+        durata = time.perf_counter() - inizio
+        await dispatcher.ferma()
+        return bot_finto, dispatcher, durata
+
+    bot_finto, dispatcher, durata = asyncio.run(esegui())
+    intervalli = [b - a for istanti in bot_finto.invii_per_chat.values() for a, b in zip(istanti, istanti[1:])]
+    return {
+        "benchmark": "notifiche",
+        "notifiche": len(notifiche),
+        "chat": len(bot_finto.invii_per_chat),
+        "worker": args.worker,
+        "limite_al_secondo": args.al_secondo or None,
+        "latenza_bot_ms": args.latenza_ms,
+        "durata_s": durata,
+        "inviate": dispatcher.inviati,
+        "fallite": dispatcher.falliti,
+        "retry_after_ricevuti": bot_finto.retry_after,
+        "messaggi_al_secondo": dispatcher.inviati / durata,
+        "intervallo_minimo_stessa_chat_s": min(intervalli) if intervalli else None,
+    }
+
+
+# --- Trigger concorrenti ---
+
+def genera_csv_impianti(impianti: dict, prezzi: list):
+    """Anagrafica e prezzi sintetici nel formato MIMIT con separatore '|'."""
+    anagrafica = ["Estrazione del " + date.today().isoformat(),
+                  "idImpianto|Gestore|Bandiera|Tipo Impianto|Nome Impianto|Indirizzo|Comune|Provincia|Latitudine|Longitudine"]
+    anagrafica += [f"{i.id_impianto}|{i.gestore}|{i.bandiera}|Stradale|{i.nome}|{i.indirizzo}|{i.comune}|{i.provincia}|"
+                   f"{i.latitudine}|{i.longitudine}" for i in impianti.values()]
+    comunicazione = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    righe_prezzi = ["Estrazione del " + date.today().isoformat(), "idImpianto|descCarburante|prezzo|isSelf|dtComu"]
+    righe_prezzi += [f"{id_impianto}|{carburante}|{prezzo}|{int(self_service)}|{comunicazione}"
+                     for id_impianto, carburante, prezzo, self_service in prezzi]
+    return ("\n".join(anagrafica) + "\n").encode("utf-8"), ("\n".join(righe_prezzi) + "\n").encode("utf-8")
+
+
+def bench_trigger(args) -> dict:
+    """Raffiche di POST /trigger-update concorrenti (più lo scheduler): deve girare un solo job alla volta."""
+    from aiohttp.test_utils import TestClient, TestServer
+    from telegram.ext import Application
+
+    rng = random.Random(args.seed)
+    anagrafica, prezzi = genera_csv_impianti(*genera_impianti(2000, rng))
+    server, url_base = avvia_server_http({
+        "/MediaRegionaleStradale.csv": genera_csv_regionale(args.righe, rng),
+        "/anagrafica.csv": anagrafica,
+        "/prezzi.csv": prezzi,
+    })
+    bot.CSV_URL = url_base + "/MediaRegionaleStradale.csv"
+    bot.ANAGRAFICA_IMPIANTI_URL = url_base + "/anagrafica.csv"
+    bot.PREZZI_IMPIANTI_URL = url_base + "/prezzi.csv"
+    bot.STATO_DOWNLOAD_FILE = os.path.join(tempfile.mkdtemp(), "stato_download.json")
+    bot.UPDATE_SECRET = "benchmark"
+    usa_database_in_process()
+
+    # Conta quanti aggiornamenti eseguono davvero in parallelo
+    in_corso = massimo_in_corso = 0
+    lock_conteggio = threading.Lock()
+    update_database = bot.update_database
+    def update_database_contato(*a, **kw):
+        nonlocal in_corso, massimo_in_corso
+        with lock_conteggio:
+            in_corso += 1
+            massimo_in_corso = max(massimo_in_corso, in_corso)
+        try:
+            return update_database(*a, **kw)
+        finally:
+            with lock_conteggio:
+                in_corso -= 1
+    bot.update_database = update_database_contato
+
+    async def esegui():
+        application = Application.builder().token("123:benchmark").build()
+        risposte = []
+        async with TestClient(TestServer(bot.crea_app_web(application))) as client:
+            async def trigger():
+                risposta = await client.post("/trigger-update?secret=benchmark")
+                return await risposta.json()
+            for _ in range(args.ondate):
+                # Lo scheduler parte insieme alla raffica di trigger HTTP
+                scheduler = asyncio.create_task(asyncio.to_thread(bot.gestore_aggiornamenti.esegui, "scheduler"))
+                risposte += await asyncio.gather(*(trigger() for _ in range(args.richieste)))
+                await scheduler
+            # Un trigger arrivato a job appena concluso può averne avviato un altro: si attende che finisca
+            while (stato := await (await client.get("/update-status")).json())["in_corso"]:
+                await asyncio.sleep(0.05)
+        return risposte, stato
+
+    inizio = time.perf_counter()
+    try:
+        risposte, stato = asyncio.run(esegui())
+    finally:
+        bot.update_database = update_database
+        server.shutdown()
+    durata = time.perf_counter() - inizio
+
+    return {
+        "benchmark": "trigger",
+        "richieste_http": len(risposte),
+        "ondate": args.ondate,
+        "durata_s": durata,
+        "job_avviati_da_http": sum(1 for r in risposte if r["nuovo"]),
+        "job_distinti": len({r["job_id"] for r in risposte} | {j["job_id"] for j in stato["ultimi"]}),
+        "massimo_job_in_contemporanea": massimo_in_corso,
+        "esiti": [j["stato"] for j in stato["ultimi"]],
+    }
+
+
+# --- Classifica e confronto ---
+
+def righe_prezzi_sintetiche(giorni: int, rng: random.Random) -> list:
+    """Righe (regione, carburante, data, prezzo) come quelle lette da aggiorna_matrice_prezzi."""
+    oggi = date.today()
+    return [
+        (regione, carburante, date.fromordinal(oggi.toordinal() - g), round(rng.uniform(0.7, 2.1), 3))
+        for g in range(giorni) for regione in bot.REGIONI_VALIDATE for carburante in bot.CARBURANTI
+        if rng.random() > 0.02 # qualche buco, come nei CSV reali
+    ]
+
+
+def bench_classifica(args) -> dict:
+    rng = random.Random(args.seed)
+    righe = righe_prezzi_sintetiche(args.giorni, rng)
+
+    inizio = time.perf_counter()
+    bot._matrice_prezzi = bot.crea_matrice_prezzi(righe)
+    costruzione_ms = (time.perf_counter() - inizio) * 1000
+
+    # Verifica delle classifiche contro un calcolo riga per riga
+    ultimi = {}
+    for regione, carburante, giorno, prezzo in sorted(righe, key=lambda r: r[2]):
+        ultimi[(regione, carburante)] = prezzo
+    discordanze = 0
+    for c, carburante in enumerate(bot.CARBURANTI):
+        attesi = sorted(ultimi[(r, carburante)] for r in bot.REGIONI_VALIDATE if (r, carburante) in ultimi)
+        ottenuti = [float(p) for p in sorted(bot._matrice_prezzi.ultimi[:, c]) if p == p]
+        media = sum(attesi) / len(attesi)
+        if attesi != ottenuti or abs(media - bot._matrice_prezzi.media_nazionale[c]) > 1e-9:
+            discordanze += 1
+
+    async def esegui():
+        api = ApiFinta(0)
+        durate = {"classifica": [], "confronta": []}
+        for i in range(args.richieste):
+            if rng.random() < 0.5:
+                nome, handler, argomenti = "classifica", bot.classifica_command, [rng.choice(bot.CARBURANTI)]
+            else:
+                nome, handler = "confronta", bot.confronta_command
+                argomenti = " ".join(rng.sample(bot.REGIONI_VALIDATE, 2)).split()
+            contesto = ContestoFinto(api)
+            contesto.args = argomenti
+            inizio = time.perf_counter()
+            # Una chat per richiesta: il limite per chat non deve respingere le richieste misurate
+            await handler(UpdateFinto("/" + nome, api, chat_id=i), contesto)
+            durate[nome].append((time.perf_counter() - inizio) * 1000)
+        return durate, api
+
+    durate, api = asyncio.run(esegui())
+    return {
+        "benchmark": "classifica",
+        "giorni": args.giorni,
+        "righe": len(righe),
+        "costruzione_matrice_ms": costruzione_ms,
+        "latenza": {nome: percentili(valori) for nome, valori in durate.items() if valori},
+        "chiamate_bot_api": api.chiamate,
+        "discordanze_calcolo_riga_per_riga": discordanze,
+    }
+
+
+# --- Grafici di /storico ---
+
+def bench_storico(args) -> dict:
+    """/storico con una serie sintetica: disegno nel pool di processi, cache e riuso del file_id."""
+    rng = random.Random(args.seed)
+    righe = righe_prezzi_sintetiche(bot.RETENTION_GIORNI, rng)
+
+    serie_regioni = {}
+    for regione, carburante, giorno, prezzo in sorted(righe, key=lambda riga: riga[2]):
+        date_serie, prezzi = serie_regioni.setdefault(regione, {}).setdefault(carburante, ([], []))
+        date_serie.append(giorno)
+        prezzi.append(prezzo)
+
+    async def storico_sintetico(regione, giorni, carburante=None):
+        return {c: serie for c, serie in serie_regioni[regione].items() if carburante in (None, c)}
+
+    bot.leggi_storico_regione = storico_sintetico
+    bot._async_db_pool = object() # il pool non viene usato: la serie arriva da storico_sintetico
+    bot._snapshot_prezzi = bot.SnapshotPrezzi()
+    bot.GRAFICI_WORKER = args.worker
+    bot.cache_grafici = bot.CacheGrafici(tempfile.mkdtemp(), max_memoria=args.richieste, max_disco=args.richieste)
+
+    async def esegui():
+        bot.avvia_pool_grafici()
+        api = ApiFinta(0)
+        ritardo_massimo_loop = 0.0
+        attivo = True
+
+        async def sonda_loop():
+            # Misura quanto l'event loop resta bloccato mentre i grafici vengono disegnati
+            nonlocal ritardo_massimo_loop
+            while attivo:
+                inizio = time.perf_counter()
+                await asyncio.sleep(0.005)
+                ritardo_massimo_loop = max(ritardo_massimo_loop, time.perf_counter() - inizio - 0.005)
+
+        async def richiesta(i, argomenti):
+            contesto = ContestoFinto(api)
+            contesto.args = argomenti
+            inizio = time.perf_counter()
+            # Una chat per richiesta: il limite per chat non deve respingere le richieste misurate
+            await bot.storico_command(UpdateFinto("/storico", api, chat_id=i), contesto)
+            return (time.perf_counter() - inizio) * 1000
+
+        richieste = [[rng.choice(bot.REGIONI_VALIDATE), str(rng.choice((7, 14, bot.RETENTION_GIORNI)))] for _ in range(args.richieste)]
+        sonda = asyncio.create_task(sonda_loop())
+        try:
+            inizio = time.perf_counter()
+            prima = await asyncio.gather(*(richiesta(i, a) for i, a in enumerate(richieste)))
+            durata_prima = time.perf_counter() - inizio
+            seconda = [await richiesta(i, a) for i, a in enumerate(richieste)]
+        finally:
+            attivo = False
+            await sonda
+            bot.ferma_pool_grafici()
+        return prima, durata_prima, seconda, ritardo_massimo_loop, api
+
+    prima, durata_prima, seconda, ritardo_massimo_loop, api = asyncio.run(esegui())
+    return {
+        "benchmark": "storico",
+        "richieste": args.richieste,
+        "worker": args.worker,
+        "prima_passata_concorrente": {"durata_s": durata_prima, **percentili(prima)},
+        "seconda_passata_da_cache": percentili(seconda),
+        "ritardo_massimo_event_loop_ms": ritardo_massimo_loop * 1000,
+        "chiamate_bot_api": api.chiamate,
+    }
+
+
+# --- Modalità inline ---
+
+class InlineQueryFinta:
+    """Sostituto di telegram.InlineQuery: registra risultati e cache_time della risposta."""
+
+    def __init__(self, testo: str, api: ApiFinta):
+        self.query = testo
+        self._api = api
+        self.risultati = None
+
+    async def answer(self, results, cache_time=None, **kwargs):
+        self.risultati = results
+        return await self._api.chiamata(f"answerInlineQuery (cache_time {cache_time})")
+
+
+def bench_inline(args) -> dict:
+    """Ogni utente digita il nome di una regione un carattere alla volta, come farebbe in @bot Lomb."""
+    rng = random.Random(args.seed)
+    bot._snapshot_prezzi = snapshot_sintetico(rng)
+    api = ApiFinta(0)
+    nomi = bot.REGIONI_VALIDATE + [alias for elenco in bot.ALIAS_REGIONI.values() for alias in elenco]
+
+    async def esegui():
+        durate = []
+        senza_risultati = 0
+        for _ in range(args.utenti):
+            nome = rng.choice(nomi)
+            for lunghezza in range(len(nome) + 1):
+                query = InlineQueryFinta(nome[:lunghezza], api)
+                aggiornamento = type("UpdateInlineFinto", (), {"inline_query": query})()
+                inizio = time.perf_counter()
+                await bot.inline_query_command(aggiornamento, ContestoFinto(api))
+                durate.append((time.perf_counter() - inizio) * 1000)
+                senza_risultati += not query.risultati
+        return durate, senza_risultati
+
+    durate, senza_risultati = asyncio.run(esegui())
+    return {
+        "benchmark": "inline",
+        "utenti": args.utenti,
+        "query": len(durate),
+        "query_senza_risultati": senza_risultati,
+        "latenza": percentili(durate),
+        "chiamate_bot_api": api.chiamate,
+    }
+
+
+# --- Metriche ---
+
+def bench_metriche(args) -> dict:
+    """Costo aggiunto da misura_durata rispetto alla stessa funzione non strumentata."""
+    from prometheus_client import CollectorRegistry, Histogram
+
+    istogramma = Histogram("bench_durata_secondi", "solo per il benchmark", registry=CollectorRegistry())
+
+    async def nuda():
+        return None
+
+    strumentata = bot.misura_durata(istogramma)(nuda)
+
+    def nuda_sync():
+        return None
+
+    strumentata_sync = bot.misura_durata(istogramma)(nuda_sync)
+
+    async def cronometra_async(funzione):
+        inizio = time.perf_counter()
+        for _ in range(args.chiamate):
+            await funzione()
+        return (time.perf_counter() - inizio) / args.chiamate * 1e9
+
+    def cronometra_sync(funzione):
+        inizio = time.perf_counter()
+        for _ in range(args.chiamate):
+            funzione()
+        return (time.perf_counter() - inizio) / args.chiamate * 1e9
+
+    async def esegui():
+        return await cronometra_async(nuda), await cronometra_async(strumentata)
+
+    async_nuda_ns, async_strumentata_ns = asyncio.run(esegui())
+    sync_nuda_ns, sync_strumentata_ns = cronometra_sync(nuda_sync), cronometra_sync(strumentata_sync)
+    return {
+        "benchmark": "metriche",
+        "chiamate": args.chiamate,
+        "overhead_async_ns": async_strumentata_ns - async_nuda_ns,
+        "overhead_sync_ns": sync_strumentata_ns - sync_nuda_ns,
+    }
+
+
+def metadati_esecuzione() -> dict:
+    """Informazioni per confrontare risultati di esecuzioni diverse."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"eseguito_il": datetime.now().isoformat(timespec="seconds"), "commit": commit,
+            "python": platform.python_version()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark offline del bot prezzi carburante.")
+    parser.add_argument("--seed", type=int, default=42, help="seme per i dati sintetici")
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    sottocomandi = parser.add_subparsers(dest="benchmark", required=True)
+
+    p_handler = sottocomandi.add_parser("handler", help="latenza e throughput di /start e /Regione con una Bot API finta")
+    p_handler.add_argument("--richieste", type=int, default=5000)
+    p_handler.add_argument("--concorrenza", type=int, default=100)
+    p_handler.add_argument("--quota-start", type=float, default=0.1, help="frazione di richieste /start")
+    p_handler.add_argument("--latenza-ms", type=float, default=0, help="latenza simulata di ogni chiamata alla Bot API")
+    p_handler.add_argument("--sorgente", choices=("memoria", "file", "db"), default="memoria",
+                           help="memoria: snapshot sintetico; db: snapshot vuoto e query sul DB delle variabili DB_*")
+    p_handler.set_defaults(esegui=bench_handler)
+
+    p_ingest = sottocomandi.add_parser("ingest", help="update_database su un CSV sintetico servito in locale")
+    p_ingest.add_argument("--righe", type=int, default=10000)
+    p_ingest.add_argument("--ripetizioni", type=int, default=5)
+    p_ingest.add_argument("--db", action="store_true",
+                          help="usa il PostgreSQL delle variabili DB_* (scrive in prezzi_regionali!) invece del sostituto in-process")
+    p_ingest.set_defaults(esegui=bench_ingest)
+
+    p_impianti = sottocomandi.add_parser("impianti", help="ricerca dei distributori più economici vicino a una posizione")
+    p_impianti.add_argument("--impianti", type=int, default=20000)
+    p_impianti.add_argument("--ricerche", type=int, default=5000)
+    p_impianti.add_argument("--raggio", type=float, default=bot.RAGGIO_RICERCA_KM)
+    p_impianti.set_defaults(esegui=bench_impianti)
+
+    p_notifiche = sottocomandi.add_parser("notifiche", help="invio degli avvisi di prezzo verso una Bot API finta")
+    p_notifiche.add_argument("--iscritti", type=int, default=100000)
+    p_notifiche.add_argument("--al-secondo", type=float, default=0,
+                             help="limite globale di messaggi al secondo (0 = nessun limite, per misurare il dispatcher)")
+    p_notifiche.add_argument("--intervallo-chat", type=float, default=bot.NOTIFICHE_INTERVALLO_CHAT)
+    p_notifiche.add_argument("--worker", type=int, default=64)
+    p_notifiche.add_argument("--latenza-ms", type=float, default=40)
+    p_notifiche.add_argument("--retry-after", type=float, default=0.0001, help="probabilità di RetryAfter per invio")
+    p_notifiche.set_defaults(esegui=bench_notifiche)
+
+    p_metriche = sottocomandi.add_parser("metriche", help="overhead della strumentazione Prometheus per chiamata")
+    p_metriche.add_argument("--chiamate", type=int, default=200000)
+    p_metriche.set_defaults(esegui=bench_metriche)
+
+    p_trigger = sottocomandi.add_parser("trigger", help="raffiche di /trigger-update concorrenti contro il gestore dei job")
+    p_trigger.add_argument("--richieste", type=int, default=500, help="richieste HTTP per ondata")
+    p_trigger.add_argument("--ondate", type=int, default=3)
+    p_trigger.add_argument("--righe", type=int, default=10000, help="righe del CSV regionale sintetico")
+    p_trigger.set_defaults(esegui=bench_trigger)
+
+    p_classifica = sottocomandi.add_parser("classifica", help="/classifica e /confronta dalla matrice dei prezzi in memoria")
+    p_classifica.add_argument("--giorni", type=int, default=14, help="giorni di storico nella matrice")
+    p_classifica.add_argument("--richieste", type=int, default=5000)
+    p_classifica.set_defaults(esegui=bench_classifica)
+
+    p_storico = sottocomandi.add_parser("storico", help="grafici di /storico: pool di processi, cache e file_id")
+    p_storico.add_argument("--richieste", type=int, default=200)
+    p_storico.add_argument("--worker", type=int, default=2, help="processi per il disegno dei grafici")
+    p_storico.set_defaults(esegui=bench_storico)
+
+    p_inline = sottocomandi.add_parser("inline", help="query inline digitate carattere per carattere")
+    p_inline.add_argument("--utenti", type=int, default=2000)
+    p_inline.set_defaults(esegui=bench_inline)
+
+    p_backfill = sottocomandi.add_parser("backfill", help="import di un archivio di CSV con crash simulato e ripresa")
+    p_backfill.add_argument("--file", type=int, default=300)
+    p_backfill.add_argument("--righe", type=int, default=2000, help="righe per file")
+    p_backfill.add_argument("--worker", type=int, default=4)
+    p_backfill.add_argument("--righe-per-lotto", type=int, default=50_000)
+    p_backfill.add_argument("--db", action="store_true", help="usa il database indicato dalle variabili DB_*")
+    p_backfill.set_defaults(esegui=bench_backfill)
+
+    args = parser.parse_args()
+    risultati = {**metadati_esecuzione(), **args.esegui(args)}
+    testo = json.dumps(risultati, indent=2, ensure_ascii=False)
+    print(testo)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(testo + "\n")
+
+
+if __name__ == "__main__":
+    main()
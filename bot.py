@@ -1,15 +1,42 @@
+import argparse
 import asyncio # Assicurati che sia presente
+import contextlib
+import functools
 import logging
 import os
-from datetime import datetime
+from datetime import datetime, date
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import json
 import csv
-from io import StringIO
+import heapq
+import html
+import math
+import re
+from io import BytesIO, StringIO
+import multiprocessing
+import numpy as np
 import psycopg2
+import asyncpg
 import threading
-from flask import Flask, request, abort # Aggiunto request e abort per il trigger
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
+import uuid
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from aiohttp import web # Server HTTP asincrono per health check, trigger e webhook
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+import hmac
+import secrets
+import signal
+import sys
+import unicodedata
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, CommandHandler, ContextTypes, InlineQueryHandler, MessageHandler, filters
 from apscheduler.schedulers.background import BackgroundScheduler # Aggiunto per schedulazione
 from apscheduler.triggers.cron import CronTrigger # Aggiunto per schedulazione
 import pytz # Aggiunto per gestione fuso orario
@@ -20,6 +47,7 @@ logging.basicConfig(
     level=logging.INFO
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING) # Health check e webhook sono molto frequenti
 logger = logging.getLogger(__name__)
 
 # --- Recupero del Token del Bot e Variabili d'Ambiente ---
@@ -30,10 +58,26 @@ DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
+# Dimensionamento del pool di connessioni condiviso
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", "300")) # secondi prima di chiudere una connessione inattiva
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))            # attesa massima per una connessione libera
+DB_POOL_PING_DOPO = float(os.getenv("DB_POOL_PING_DOPO", "30"))        # oltre questa inattività si verifica la connessione con SELECT 1
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))         # secondi per aprire una connessione (DB che non risponde)
 
 # Secret per il trigger di aggiornamento (DEVI impostarlo come var d'ambiente su Render!)
 UPDATE_SECRET = os.getenv("UPDATE_SECRET", "imposta_un_secret_sicuro") # Default debole, sovrascrivi!
 
+# Modalità webhook (opzionale): se WEBHOOK_URL è impostato, Telegram invia gli update
+# via HTTP sulla stessa porta del health check invece di usare il polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # URL pubblico del servizio, es. https://TUA_APP_URL.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Secret verificato sull'header X-Telegram-Bot-Api-Secret-Token; se assente se ne genera uno ad ogni avvio
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Numero massimo di update Telegram gestiti in parallelo
+CONCORRENZA_UPDATE = int(os.getenv("CONCORRENZA_UPDATE", "64"))
+
 if not TELEGRAM_BOT_TOKEN:
     logger.critical("FATALE: La variabile d'ambiente TELEGRAM_BOT_TOKEN non è impostata.")
     # Potresti voler uscire qui se TELEGRAM_BOT_TOKEN è essenziale per avviare
@@ -45,6 +89,11 @@ if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
 # --- Costanti ---
 # URL del file CSV dal MIMIT
 CSV_URL = "https://www.mimit.gov.it/images/stories/carburanti/MediaRegionaleStradale.csv"
+# CSV MIMIT dei singoli distributori: anagrafica degli impianti attivi e prezzi comunicati
+ANAGRAFICA_IMPIANTI_URL = "https://www.mimit.gov.it/images/exportCSV/anagrafica_impianti_attivi.csv"
+PREZZI_IMPIANTI_URL = "https://www.mimit.gov.it/images/exportCSV/prezzo_alle_8.csv"
+# File locale con ETag, Last-Modified e hash dell'ultimo CSV importato con successo
+STATO_DOWNLOAD_FILE = os.getenv("STATO_DOWNLOAD_FILE", "stato_download.json")
 # Questo formato ha la data in prima riga e usa ';' come separatore
 IS_MIMIT_FORMAT = False # Lo impostiamo a False per usare la logica di parsing corretta
 
@@ -57,17 +106,145 @@ REGIONI_VALIDATE = sorted([
     "Toscana", "Trento", "Umbria", "Valle d'Aosta", "Veneto"
 ])
 
-# --- Flask App per Health Check di Render e Trigger Aggiornamento ---
-flask_app = Flask(__name__)
+# Copia locale dell'ultimo snapshot dei prezzi: caricata all'avvio prima del DB e servita
+# (segnalata come non aggiornata) se il DB non è raggiungibile
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "snapshot_prezzi.json")
+SNAPSHOT_RIPROVA_MINUTI = int(os.getenv("SNAPSHOT_RIPROVA_MINUTI", "5")) # nuovo tentativo sul DB finché obsoleto
+
+# Controllo del carico: accessi concorrenti ai dati (DB) e limite di richieste per chat (token bucket)
+ACCESSI_DATI_CONCORRENTI = int(os.getenv("ACCESSI_DATI_CONCORRENTI", str(DB_POOL_MAX)))
+ATTESA_MASSIMA_ACCESSO = float(os.getenv("ATTESA_MASSIMA_ACCESSO", "5"))    # secondi in coda prima di rinunciare
+RICHIESTE_PER_CHAT_RAFFICA = int(os.getenv("RICHIESTE_PER_CHAT_RAFFICA", "5")) # richieste consentite di fila
+RICHIESTE_PER_CHAT_AL_MINUTO = float(os.getenv("RICHIESTE_PER_CHAT_AL_MINUTO", "20"))
+# Sotto questa attesa la risposta arriva direttamente, senza il messaggio "Sto cercando..."
+ATTESA_SENZA_SEGNAPOSTO = float(os.getenv("ATTESA_SENZA_SEGNAPOSTO", "0.1"))
+
+# Migrazioni SQL versionate (NNN_descrizione.sql), applicate in ordine all'avvio
+CARTELLA_MIGRAZIONI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+# Storico dei prezzi regionali da conservare. prezzi_regionali è partizionata per mese e si
+# eliminano solo partizioni interamente più vecchie della finestra: i dati restano quindi
+# disponibili per almeno RETENTION_GIORNI giorni (e al più circa un mese in più).
+RETENTION_GIORNI = int(os.getenv("RETENTION_GIORNI", "30"))
+
+# Ordine di visualizzazione dei carburanti nei messaggi
+CARBURANTI = ['Benzina', 'Gasolio', 'GPL', 'Metano']
+
+# Modalità inline (@bot Lomb): nomi alternativi delle regioni e durata della cache lato Telegram
+ALIAS_REGIONI = {
+    "Bolzano": ["Alto Adige", "Südtirol", "Trentino Alto Adige"],
+    "Trento": ["Trentino", "Trentino Alto Adige"],
+    "Emilia Romagna": ["Emilia-Romagna", "Romagna"],
+    "Friuli Venezia Giulia": ["Friuli", "FVG", "Venezia Giulia"],
+    "Valle d'Aosta": ["Aosta", "VdA", "Vallée d'Aoste"],
+}
+INLINE_CACHE_SECONDI = int(os.getenv("INLINE_CACHE_SECONDI", "3600"))
+
+# Giorni di storico caricati nella matrice usata da /classifica e /confronta
+GIORNI_MATRICE = int(os.getenv("GIORNI_MATRICE", "14"))
+
+# Grafici di /storico: processi dedicati al disegno e dimensione delle cache (numero di immagini)
+GRAFICI_WORKER = int(os.getenv("GRAFICI_WORKER", "2"))
+CARTELLA_CACHE_GRAFICI = os.getenv("CARTELLA_CACHE_GRAFICI", "cache_grafici")
+GRAFICI_CACHE_MEMORIA = int(os.getenv("GRAFICI_CACHE_MEMORIA", "64"))
+GRAFICI_CACHE_DISCO = int(os.getenv("GRAFICI_CACHE_DISCO", "500"))
+
+# Ricerca dei distributori più economici vicino a una posizione
+RAGGIO_RICERCA_KM = float(os.getenv("RAGGIO_RICERCA_KM", "10"))
+NUMERO_DISTRIBUTORI = int(os.getenv("NUMERO_DISTRIBUTORI", "5"))
+
+# Avvisi di prezzo: limiti di invio (Telegram consente ~30 msg/s in totale e ~1 msg/s per chat)
+NOTIFICHE_AL_SECONDO = float(os.getenv("NOTIFICHE_AL_SECONDO", "25"))
+NOTIFICHE_INTERVALLO_CHAT = float(os.getenv("NOTIFICHE_INTERVALLO_CHAT", "1.0"))
+MAX_AVVISI_PER_CHAT = int(os.getenv("MAX_AVVISI_PER_CHAT", "20"))
+
+# --- Metriche Prometheus (esposte su /metrics) ---
+_BUCKET_RAPIDI = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DURATA_HANDLER = Histogram("bot_handler_durata_secondi", "Durata degli handler Telegram", ["comando"], buckets=_BUCKET_RAPIDI)
+DURATA_LETTURA_PREZZI = Histogram("bot_lettura_prezzi_durata_secondi", "Durata della lettura dei prezzi di una regione (snapshot o DB)", buckets=_BUCKET_RAPIDI)
+DURATA_CONNESSIONE_DB = Histogram("bot_db_connessione_durata_secondi", "Attesa per ottenere una connessione dal pool", ["pool"], buckets=_BUCKET_RAPIDI)
+DURATA_QUERY_DB = Histogram("bot_db_query_durata_secondi", "Durata delle query al database", ["query"], buckets=_BUCKET_RAPIDI)
+DURATA_AGGIORNAMENTO = Histogram("bot_aggiornamento_durata_secondi", "Durata complessiva di update_database", buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+DURATA_FASE_AGGIORNAMENTO = Histogram("bot_aggiornamento_fase_durata_secondi", "Durata delle fasi di aggiornamento (download, analisi, caricamento, ...)", ["fase"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+RIGHE_CSV = Counter("bot_righe_csv", "Righe del CSV regionale per esito (inserita, gia_presente, scartata) e motivo", ["esito", "motivo"])
+ETA_DATI = Gauge("bot_dati_eta_secondi", "Età della data_aggiornamento più recente servita dal bot")
+DURATA_GRAFICO = Histogram("bot_grafico_durata_secondi", "Disegno di un grafico di /storico nel pool di processi", buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+RICHIESTE_GRAFICI = Counter("bot_grafici_richieste", "Richieste di /storico per origine dell'immagine (file_id, memoria, disco, disegnato)", ["origine"])
+RICHIESTE_LIMITATE = Counter("bot_richieste_limitate", "Richieste respinte dal limite per chat o per sovraccarico", ["motivo"])
+RICHIESTE_CONDIVISE = Counter("bot_richieste_condivise", "Letture di una regione unite a una lettura già in corso")
+SNAPSHOT_OBSOLETO = Gauge("bot_snapshot_obsoleto", "1 se lo snapshot servito non è confermato dal DB (DB irraggiungibile)")
+CACHE_MESSAGGI = Counter("bot_cache_messaggi", "Richieste servite dai messaggi pre-formattati (hit) o formattate al volo (miss)", ["esito"])
+
+def misura_durata(istogramma):
+    """Decoratore che registra in `istogramma` la durata di una funzione, sincrona o async."""
+    def decoratore(funzione):
+        if asyncio.iscoroutinefunction(funzione):
+            @functools.wraps(funzione)
+            async def wrapper_async(*args, **kwargs):
+                inizio = time.perf_counter()
+                try:
+                    return await funzione(*args, **kwargs)
+                finally:
+                    istogramma.observe(time.perf_counter() - inizio)
+            return wrapper_async
+
+        @functools.wraps(funzione)
+        def wrapper(*args, **kwargs):
+            inizio = time.perf_counter()
+            try:
+                return funzione(*args, **kwargs)
+            finally:
+                istogramma.observe(time.perf_counter() - inizio)
+        return wrapper
+    return decoratore
+
+def _eta_dati_secondi() -> float:
+    data_riferimento = ottieni_snapshot().data_riferimento
+    if data_riferimento is None:
+        return float("nan")
+    return (datetime.now() - datetime.combine(data_riferimento, datetime.min.time())).total_seconds()
+
+ETA_DATI.set_function(_eta_dati_secondi)
+SNAPSHOT_OBSOLETO.set_function(lambda: float(ottieni_snapshot().obsoleto))
+
+# --- Server HTTP per Health Check di Render, Trigger Aggiornamento e Webhook ---
+CHIAVE_APPLICATION = web.AppKey("application", Application)
 
-@flask_app.route('/') # Endpoint radice per health check
-def health_check():
+async def health_check(request: web.Request) -> web.Response:
     """Risponde OK ai check di Render."""
     logger.debug("Health check endpoint '/' chiamato.")
-    return "OK", 200
+    return web.Response(text="OK")
 
-@flask_app.route('/trigger-update', methods=['POST']) # Endpoint per aggiornamento DB
-def trigger_update_http():
+async def ready_check(request: web.Request) -> web.Response:
+    """
+    Readiness, distinta dalla liveness di '/': 200 se ci sono prezzi da servire, 503 altrimenti.
+    Riporta età e stato dello snapshot; non interroga il DB.
+    """
+    snapshot = ottieni_snapshot()
+    stato = {
+        "pronto": not snapshot.vuoto(),
+        "snapshot": {
+            "regioni": len(snapshot.date_regioni),
+            "data_riferimento": snapshot.data_riferimento.isoformat() if snapshot.data_riferimento else None,
+            "eta_dati_secondi": None if snapshot.vuoto() else round(_eta_dati_secondi()),
+            "caricato_il": snapshot.caricato_il.isoformat(timespec="seconds") if snapshot.caricato_il else None,
+            "eta_snapshot_secondi": round((datetime.now() - snapshot.caricato_il).total_seconds()) if snapshot.caricato_il else None,
+            "origine": snapshot.origine,
+            "obsoleto": snapshot.obsoleto,
+        },
+        "aggiornamento_in_corso": gestore_aggiornamenti.stato()["in_corso"] is not None,
+    }
+    return web.json_response(stato, status=200 if stato["pronto"] else 503)
+
+async def metrics(request: web.Request) -> web.Response:
+    """Espone le metriche in formato Prometheus."""
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+def _secret_valido(ricevuto: str, atteso: str) -> bool:
+    """Confronto a tempo costante; in bytes perché compare_digest rifiuta le str non ASCII."""
+    return hmac.compare_digest(ricevuto.encode("utf-8"), atteso.encode("utf-8"))
+
+async def trigger_update_http(request: web.Request) -> web.Response:
     """
     Endpoint sicuro per triggerare l'aggiornamento del database.
     Richiede un parametro 'secret' nella query string.
@@ -75,288 +252,2393 @@ def trigger_update_http():
     curl -X POST "https://TUA_APP_URL.onrender.com/trigger-update?secret=IL_TUO_SECRET"
     """
     logger.info("Chiamata ricevuta a /trigger-update")
-    secret_ricevuto = request.args.get('secret')
+    secret_ricevuto = request.query.get('secret')
 
     if not secret_ricevuto:
         logger.warning("Trigger update chiamato senza parametro 'secret'.")
-        abort(400, description="Parametro 'secret' mancante.") # Bad Request
+        raise web.HTTPBadRequest(text="Parametro 'secret' mancante.")
 
-    if secret_ricevuto != UPDATE_SECRET:
+    if not _secret_valido(secret_ricevuto, UPDATE_SECRET):
         logger.warning("Trigger update chiamato con secret errato.")
-        abort(403, description="Secret non valido.") # Forbidden
-
-    logger.info("Secret valido, avvio aggiornamento database in background...")
-    # Avviamo l'aggiornamento in un thread separato per non bloccare la richiesta HTTP
-    update_thread = threading.Thread(target=update_database_wrapper)
-    update_thread.start()
+        raise web.HTTPForbidden(text="Secret non valido.")
 
-    return "Aggiornamento avviato in background.", 202 # Accepted
-
-def update_database_wrapper():
-    """ Chiamata a update_database con gestione inizio/fine log. """
-    logger.info("Esecuzione di update_database() avviata dal trigger HTTP...")
-    success = update_database()
-    if success:
-        logger.info("Esecuzione di update_database() completata con successo.")
+    # Se un aggiornamento è già in corso la richiesta si unisce a quello invece di avviarne un altro
+    job, nuovo = gestore_aggiornamenti.avvia("http")
+    if nuovo:
+        logger.info(f"Secret valido, aggiornamento {job.id} avviato in background.")
     else:
-        logger.error("Esecuzione di update_database() fallita.")
+        logger.info(f"Secret valido, aggiornamento {job.id} già in corso: nessun nuovo avvio.")
+    return web.json_response({"job_id": job.id, "stato": job.stato, "nuovo": nuovo}, status=202) # Accepted
+
+async def update_status_http(request: web.Request) -> web.Response:
+    """Stato dell'aggiornamento in corso e degli ultimi completati."""
+    return web.json_response(gestore_aggiornamenti.stato(), dumps=functools.partial(json.dumps, default=str))
+
+async def cancel_update_http(request: web.Request) -> web.Response:
+    """Richiede l'annullamento dell'aggiornamento in corso (protetto dallo stesso secret del trigger)."""
+    secret_ricevuto = request.query.get('secret', '')
+    if not _secret_valido(secret_ricevuto, UPDATE_SECRET):
+        logger.warning("Annullamento aggiornamento chiamato con secret errato o mancante.")
+        raise web.HTTPForbidden(text="Secret non valido.")
+    job = gestore_aggiornamenti.annulla()
+    if job is None:
+        return web.json_response({"annullato": False, "motivo": "nessun aggiornamento in corso"}, status=409)
+    return web.json_response({"annullato": True, "job_id": job.id}, status=202)
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """Riceve gli update di Telegram in modalità webhook e li passa all'Application."""
+    secret_ricevuto = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not _secret_valido(secret_ricevuto, WEBHOOK_SECRET):
+        logger.warning("Webhook chiamato con secret token errato.")
+        raise web.HTTPForbidden()
+
+    application = request.app[CHIAVE_APPLICATION]
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Update webhook non valido: {e}")
+        raise web.HTTPBadRequest()
+    # Rispondiamo subito: l'update viene elaborato dall'Application in parallelo agli altri
+    await application.update_queue.put(update)
+    return web.Response()
+
+def crea_app_web(application: Application) -> web.Application:
+    """Crea il server HTTP unico con health check, trigger e (se attivo) webhook."""
+    app_web = web.Application()
+    app_web[CHIAVE_APPLICATION] = application
+    app_web.router.add_get('/', health_check) # Endpoint radice per health check (liveness)
+    app_web.router.add_get('/ready', ready_check)
+    app_web.router.add_post('/trigger-update', trigger_update_http) # Endpoint per aggiornamento DB
+    app_web.router.add_get('/update-status', update_status_http)
+    app_web.router.add_post('/update-cancel', cancel_update_http)
+    app_web.router.add_get('/metrics', metrics)
+    if WEBHOOK_URL:
+        app_web.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return app_web
+
+# --- Gestione dei job di aggiornamento ---
+
+class AggiornamentoAnnullato(Exception):
+    """Sollevata ai punti di controllo di un aggiornamento di cui è stato chiesto l'annullamento."""
+
+def _verifica_annullamento(annullamento: threading.Event | None) -> None:
+    if annullamento is not None and annullamento.is_set():
+        raise AggiornamentoAnnullato()
+
+def _copia_report(report: dict) -> dict:
+    """Copia annidata di un report; ogni dict.copy() è atomico rispetto al thread che lo scrive."""
+    return {chiave: _copia_report(valore) if isinstance(valore, dict) else valore for chiave, valore in report.copy().items()}
+
+@dataclass
+class JobAggiornamento:
+    """Un'esecuzione di update_database + update_impianti."""
+    id: str
+    origine: str # "http" o "scheduler"
+    avviato_il: datetime
+    stato: str = "in_corso" # in_corso, completato, fallito, annullato
+    durata_s: float | None = None
+    report_prezzi: dict = field(default_factory=dict)
+    report_impianti: dict = field(default_factory=dict)
+    annullamento: threading.Event = field(default_factory=threading.Event, repr=False)
+    terminato: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def come_dict(self) -> dict:
+        # Mentre il job è in corso il thread dell'aggiornamento aggiunge chiavi ai report:
+        # si serializzano copie, non i dizionari vivi
+        return {
+            "job_id": self.id,
+            "origine": self.origine,
+            "avviato_il": self.avviato_il.isoformat(timespec="seconds"),
+            "stato": self.stato,
+            "durata_s": self.durata_s,
+            "prezzi_regionali": _copia_report(self.report_prezzi),
+            "impianti": _copia_report(self.report_impianti),
+        }
+
+class GestoreAggiornamenti:
+    """
+    Esegue un solo aggiornamento alla volta: trigger HTTP e scheduler che arrivano mentre
+    un aggiornamento è in corso si uniscono a quello invece di avviarne un altro.
+    Conserva lo stato degli ultimi `storico` job.
+    """
+
+    def __init__(self, storico: int = 20):
+        self._lock = threading.Lock()
+        self._corrente: JobAggiornamento | None = None
+        self._storico = deque(maxlen=storico)
+
+    def avvia(self, origine: str):
+        """Avvia un aggiornamento in background; restituisce (job, nuovo)."""
+        with self._lock:
+            if self._corrente is not None:
+                return self._corrente, False
+            job = JobAggiornamento(id=uuid.uuid4().hex[:12], origine=origine, avviato_il=datetime.now())
+            self._corrente = job
+        threading.Thread(target=self._esegui, args=(job,), name=f"aggiornamento-{job.id}", daemon=True).start()
+        return job, True
+
+    def esegui(self, origine: str = "scheduler") -> JobAggiornamento:
+        """Avvia (o raggiunge) un aggiornamento e ne attende la fine. Usato dallo scheduler."""
+        job, _ = self.avvia(origine)
+        job.terminato.wait()
+        return job
+
+    def annulla(self) -> JobAggiornamento | None:
+        """Chiede l'annullamento del job in corso; restituisce il job o None se non ce n'è."""
+        with self._lock:
+            job = self._corrente
+        if job is not None:
+            logger.warning(f"Richiesto l'annullamento dell'aggiornamento {job.id}.")
+            job.annullamento.set()
+        return job
+
+    def stato(self) -> dict:
+        with self._lock:
+            corrente = self._corrente
+            storico = list(self._storico)
+        return {
+            "in_corso": corrente.come_dict() if corrente else None,
+            "ultimi": [job.come_dict() for job in reversed(storico)],
+        }
+
+    def _esegui(self, job: JobAggiornamento) -> None:
+        logger.info(f"Aggiornamento {job.id} avviato (origine: {job.origine}).")
+        inizio = time.monotonic()
+        try:
+            ok_prezzi = update_database(job.report_prezzi, annullamento=job.annullamento)
+            ok_impianti = False
+            if not job.annullamento.is_set():
+                ok_impianti = update_impianti(job.report_impianti, annullamento=job.annullamento)
+            if job.annullamento.is_set():
+                job.stato = "annullato"
+            else:
+                job.stato = "completato" if ok_prezzi and ok_impianti else "fallito"
+        except Exception as e:
+            logger.error(f"Errore imprevisto nell'aggiornamento {job.id}: {e}", exc_info=True)
+            job.stato = "fallito"
+        finally:
+            job.durata_s = round(time.monotonic() - inizio, 3)
+            with self._lock:
+                self._corrente = None
+                self._storico.append(job)
+            job.terminato.set()
+            logger.info(f"Aggiornamento {job.id} terminato: {job.stato} in {job.durata_s}s.")
+
+gestore_aggiornamenti = GestoreAggiornamenti()
 
 # --- Funzioni Database ---
 
+def _apri_connessione_db():
+    """Apre una nuova connessione fisica al database PostgreSQL."""
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        connect_timeout=DB_CONNECT_TIMEOUT
+    )
+    logger.info("Connessione al database Supabase riuscita.")
+    return conn
+
+class PoolConnessioni:
+    """
+    Pool di connessioni psycopg2 limitato e thread-safe.
+    Le connessioni vengono verificate al prelievo e chiuse dopo idle_timeout
+    secondi di inattività (mantenendone almeno `minimo`).
+    """
+
+    def __init__(self, connetti, minimo: int, massimo: int, idle_timeout: float, attesa_massima: float, ping_dopo: float):
+        self._connetti = connetti
+        self._minimo = max(0, minimo)
+        self._massimo = max(1, massimo, self._minimo)
+        self._idle_timeout = idle_timeout
+        self._attesa_massima = attesa_massima
+        self._ping_dopo = ping_dopo
+        self._cond = threading.Condition()
+        self._libere = deque() # (connessione, istante del rilascio); le più recenti a destra
+        self._totali = 0       # connessioni aperte, libere o in uso
+        self._chiuso = False   # dopo chiudi_tutte le connessioni rilasciate vengono chiuse
+
+    def preriscalda(self) -> None:
+        """Apre subito le connessioni minime."""
+        # Si prelevano tutte prima di rilasciarne una: altrimenti ogni acquisisci riprenderebbe la stessa
+        prese = []
+        try:
+            for _ in range(self._minimo):
+                conn = self.acquisisci()
+                if not conn:
+                    break
+                prese.append(conn)
+        finally:
+            # Anche se un'apertura fallisce, quelle già aperte tornano al pool
+            for conn in prese:
+                self.rilascia(conn)
+
+    def acquisisci(self):
+        """Restituisce una connessione valida, o None se non disponibile entro il timeout."""
+        inizio = time.monotonic()
+        scadenza = inizio + self._attesa_massima
+        atteso = False
+        while True:
+            conn = None
+            istante_rilascio = None
+            with self._cond:
+                self._chiudi_inattive()
+                while not self._libere and self._totali >= self._massimo:
+                    residuo = scadenza - time.monotonic()
+                    if residuo <= 0:
+                        logger.error(f"Pool DB esaurito: nessuna connessione libera dopo {time.monotonic() - inizio:.2f}s (max {self._massimo}).")
+                        return None
+                    atteso = True
+                    self._cond.wait(residuo)
+                if self._libere:
+                    conn, istante_rilascio = self._libere.pop()
+                else:
+                    self._totali += 1 # Riserva il posto, la connessione si apre fuori dal lock
+
+            if conn is None:
+                try:
+                    conn = self._connetti()
+                except Exception:
+                    self._scarta()
+                    raise
+            elif not self._connessione_valida(conn, istante_rilascio):
+                logger.warning("Connessione DB non più valida scartata dal pool.")
+                self._chiudi(conn)
+                self._scarta()
+                continue
+
+            if atteso:
+                logger.warning(f"Pool DB esaurito: connessione ottenuta dopo {time.monotonic() - inizio:.3f}s di attesa.")
+            return conn
+
+    def rilascia(self, conn) -> None:
+        """Restituisce una connessione al pool (chiudendola se inutilizzabile)."""
+        if conn is None:
+            return
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback() # Nessuna transazione aperta deve sopravvivere al rilascio
+        except psycopg2.Error:
+            pass
+        if conn.closed:
+            self._scarta()
+            return
+        with self._cond:
+            if not self._chiuso:
+                self._libere.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+        self._chiudi(conn)
+        self._scarta()
+
+    def chiudi_tutte(self) -> None:
+        """Chiude le connessioni libere (quelle in uso verranno chiuse al rilascio)."""
+        with self._cond:
+            self._chiuso = True
+            while self._libere:
+                conn, _ = self._libere.popleft()
+                self._chiudi(conn)
+                self._totali -= 1
+            self._cond.notify_all()
+
+    def _connessione_valida(self, conn, istante_rilascio: float) -> bool:
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - istante_rilascio < self._ping_dopo:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _chiudi_inattive(self) -> None:
+        # Chiamato con il lock acquisito: le connessioni più vecchie sono a sinistra
+        adesso = time.monotonic()
+        while self._libere and self._totali > self._minimo and adesso - self._libere[0][1] > self._idle_timeout:
+            conn, _ = self._libere.popleft()
+            self._chiudi(conn)
+            self._totali -= 1
+
+    def _scarta(self) -> None:
+        with self._cond:
+            self._totali -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _chiudi(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def _ottieni_pool() -> PoolConnessioni:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = PoolConnessioni(
+                    _apri_connessione_db, DB_POOL_MIN, DB_POOL_MAX,
+                    DB_POOL_IDLE_TIMEOUT, DB_POOL_TIMEOUT, DB_POOL_PING_DOPO
+                )
+    return _db_pool
+
 def get_db_connection():
-    """Crea e restituisce una connessione al database PostgreSQL."""
-    conn = None # Inizializza a None
+    """Preleva una connessione dal pool condiviso (da restituire con release_db_connection)."""
     try:
         if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
              logger.error("Connessione DB fallita: variabili d'ambiente mancanti.")
              return None
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        logger.info("Connessione al database Supabase riuscita.")
-        return conn
+        with DURATA_CONNESSIONE_DB.labels(pool="sync").time():
+            return _ottieni_pool().acquisisci()
     except psycopg2.OperationalError as e:
         logger.error(f"Errore di connessione al database: {e}")
-        if conn: conn.close() # Assicura chiusura se l'errore avviene dopo la connessione parziale
         return None
     except Exception as e:
         logger.error(f"Errore generico durante la connessione al DB: {e}")
-        if conn: conn.close()
         return None
 
-def update_database():
-    """Scarica il CSV, lo processa, aggiorna il DB e pulisce i dati vecchi."""
+def release_db_connection(conn) -> None:
+    """Restituisce al pool una connessione ottenuta con get_db_connection."""
+    if conn is not None:
+        _ottieni_pool().rilascia(conn)
+
+# --- Migrazioni dello schema e partizioni di prezzi_regionali ---
+
+# Chiave dell'advisory lock che serializza le migrazioni tra istanze avviate insieme
+LOCK_MIGRAZIONI = 74_110_001
+_NOME_MIGRAZIONE = re.compile(r"^(\d+)_(\w+)\.sql$")
+_NOME_PARTIZIONE = re.compile(r"^prezzi_regionali_(\d{4})_(\d{2})$")
+
+def elenca_migrazioni() -> list:
+    """(versione, nome, percorso) dei file di CARTELLA_MIGRAZIONI, in ordine di versione."""
+    migrazioni = []
+    for nome_file in os.listdir(CARTELLA_MIGRAZIONI):
+        corrispondenza = _NOME_MIGRAZIONE.match(nome_file)
+        if corrispondenza:
+            migrazioni.append((int(corrispondenza.group(1)), corrispondenza.group(2), os.path.join(CARTELLA_MIGRAZIONI, nome_file)))
+    migrazioni.sort()
+    versioni = [versione for versione, _, _ in migrazioni]
+    if len(versioni) != len(set(versioni)):
+        raise RuntimeError(f"Versioni di migrazione duplicate in {CARTELLA_MIGRAZIONI}: {versioni}")
+    return migrazioni
+
+def applica_migrazioni() -> bool:
+    """
+    Applica in un'unica transazione le migrazioni non ancora registrate in schema_migrazioni,
+    poi crea le partizioni del mese corrente e del successivo.
+    """
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Migrazioni saltate: impossibile connettersi al DB.")
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (LOCK_MIGRAZIONI,))
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrazioni (
+                    versione INTEGER PRIMARY KEY,
+                    nome TEXT NOT NULL,
+                    applicata_il TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+            """)
+            cur.execute("SELECT versione FROM schema_migrazioni;")
+            applicate = {riga[0] for riga in cur.fetchall()}
+            for versione, nome, percorso in elenca_migrazioni():
+                if versione in applicate:
+                    continue
+                logger.info(f"Applicazione migrazione {versione:03d} ({nome})...")
+                with open(percorso, encoding="utf-8") as f:
+                    cur.execute(f.read())
+                cur.execute("INSERT INTO schema_migrazioni (versione, nome) VALUES (%s, %s);", (versione, nome))
+        oggi = date.today()
+        assicura_partizioni(conn, oggi, _mese_successivo(oggi))
+        conn.commit()
+        return True
+    except (psycopg2.Error, OSError, RuntimeError) as e:
+        logger.error(f"Errore durante l'applicazione delle migrazioni: {e}")
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn)
+
+def _mese_successivo(giorno: date) -> date:
+    """Primo giorno del mese successivo a `giorno`."""
+    return date(giorno.year + giorno.month // 12, giorno.month % 12 + 1, 1)
+
+def sql_partizione_mese(giorno: date) -> str:
+    """CREATE TABLE della partizione mensile di prezzi_regionali che contiene `giorno`."""
+    inizio = giorno.replace(day=1)
+    return (
+        f"CREATE TABLE IF NOT EXISTS prezzi_regionali_{inizio:%Y_%m} PARTITION OF prezzi_regionali "
+        f"FOR VALUES FROM ('{inizio.isoformat()}') TO ('{_mese_successivo(inizio).isoformat()}');"
+    )
+
+def assicura_partizioni(conn, *giorni: date) -> None:
+    """Crea, se mancano, le partizioni mensili che contengono i giorni indicati (senza commit)."""
+    with conn.cursor() as cur:
+        for mese in sorted({giorno.replace(day=1) for giorno in giorni}):
+            cur.execute(sql_partizione_mese(mese))
+
+def elimina_partizioni_scadute(conn, giorni_da_mantenere: int = RETENTION_GIORNI) -> list:
+    """
+    Elimina le partizioni di prezzi_regionali che contengono solo dati più vecchi di
+    `giorni_da_mantenere` giorni. Costa un DROP TABLE per mese, qualunque sia la
+    dimensione della tabella. Non esegue il commit; restituisce i nomi eliminati.
+    """
+    limite = date.fromordinal(date.today().toordinal() - giorni_da_mantenere)
+    eliminate = []
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'prezzi_regionali'::regclass;
+        """)
+        for (nome,) in cur.fetchall():
+            corrispondenza = _NOME_PARTIZIONE.match(nome)
+            if not corrispondenza:
+                continue
+            inizio = date(int(corrispondenza.group(1)), int(corrispondenza.group(2)), 1)
+            if _mese_successivo(inizio) <= limite:
+                cur.execute(f"DROP TABLE {nome};")
+                eliminate.append(nome)
+    return sorted(eliminate)
+
+# --- Download condizionale dei CSV ---
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_stato_download_lock = threading.Lock()
+
+def _ottieni_sessione_http() -> requests.Session:
+    """Sessione HTTP riutilizzata, con retry e backoff esponenziale sugli errori temporanei."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=3,
+                backoff_factor=2, # 0s, 4s, 8s tra i tentativi (urllib3 2.x)
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET"]),
+            )
+            _http_session = requests.Session()
+            _http_session.mount("https://", HTTPAdapter(max_retries=retry))
+            _http_session.mount("http://", HTTPAdapter(max_retries=retry))
+        return _http_session
+
+def _leggi_stato_download() -> dict:
+    try:
+        with open(STATO_DOWNLOAD_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Stato download illeggibile ({STATO_DOWNLOAD_FILE}), verrà ignorato: {e}")
+        return {}
+
+def registra_download(url: str, metadati: dict) -> None:
+    """Salva ETag, Last-Modified e hash di un download importato con successo."""
+    with _stato_download_lock:
+        stato = _leggi_stato_download()
+        stato[url] = metadati
+        file_temporaneo = f"{STATO_DOWNLOAD_FILE}.tmp"
+        try:
+            with open(file_temporaneo, "w", encoding='utf-8') as f:
+                json.dump(stato, f)
+            os.replace(file_temporaneo, STATO_DOWNLOAD_FILE)
+        except OSError as e:
+            logger.warning(f"Impossibile salvare lo stato del download in {STATO_DOWNLOAD_FILE}: {e}")
+
+def _intestazioni_condizionali(precedente: dict) -> dict:
+    """Header If-None-Match / If-Modified-Since a partire dai metadati dell'ultimo import."""
+    headers = {}
+    if precedente.get("etag"):
+        headers["If-None-Match"] = precedente["etag"]
+    if precedente.get("last_modified"):
+        headers["If-Modified-Since"] = precedente["last_modified"]
+    return headers
+
+def scarica_se_modificato(url: str, forza: bool = False, timeout: int = 30):
+    """
+    Scarica `url` con una richiesta condizionale basata sull'ultimo import riuscito.
+    Restituisce (contenuto, metadati); contenuto è None se il file non è cambiato
+    (risposta 304 o stesso hash). I metadati vanno registrati con registra_download
+    solo dopo che il contenuto è stato importato.
+    """
+    precedente = {} if forza else _leggi_stato_download().get(url, {})
+    response = _ottieni_sessione_http().get(url, headers=_intestazioni_condizionali(precedente), timeout=timeout)
+    if response.status_code == 304:
+        logger.info(f"{url} non modificato (304).")
+        return None, precedente
+    response.raise_for_status()
+
+    metadati = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "sha256": hashlib.sha256(response.content).hexdigest(),
+    }
+    if precedente.get("sha256") == metadati["sha256"]:
+        logger.info(f"{url} scaricato ma identico all'ultimo import (hash invariato).")
+        registra_download(url, metadati) # Aggiorna comunque ETag/Last-Modified
+        return None, metadati
+    return response.content, metadati
+
+class FormatoCSVNonValido(ValueError):
+    """Il CSV scaricato non ha la struttura attesa (data in prima riga, intestazione)."""
+
+def analizza_csv_prezzi(csv_text: str):
+    """
+    Analizza e valida in memoria l'intero CSV delle medie regionali.
+    Restituisce (data_aggiornamento, righe_valide, scarti) dove righe_valide è una lista
+    di tuple (regione, tipo_carburante, prezzo) e scarti conta le righe rifiutate per motivo.
+    Solleva FormatoCSVNonValido se data o intestazione non sono leggibili.
+    """
+    csv_data = StringIO(csv_text)
+
+    prima_riga = csv_data.readline().strip()
+    try:
+        parti = prima_riga.split()
+        if len(parti) < 2: raise ValueError("Formato prima riga non riconosciuto")
+        data_str = parti[-1]
+        data_aggiornamento = datetime.strptime(data_str, "%d-%m-%Y").date()
+    except (IndexError, ValueError, TypeError) as e:
+        raise FormatoCSVNonValido(f"Impossibile estrarre la data dalla prima riga: '{prima_riga}'. Errore: {e}") from e
+
+    csv_reader = csv.reader(csv_data, delimiter=';')
+    try:
+         header = next(csv_reader)
+         logger.debug(f"Intestazione CSV letta: {header}")
+    except StopIteration:
+         raise FormatoCSVNonValido("Il file CSV sembra vuoto dopo la prima riga.")
+
+    righe_valide = []
+    chiavi_viste = set()
+    scarti = {}
+    def scarta(motivo, numero_riga, row):
+        scarti[motivo] = scarti.get(motivo, 0) + 1
+        logger.warning(f"Riga {numero_riga} ignorata ({motivo}): {row}")
+
+    for numero_riga, row in enumerate(csv_reader, start=3):
+        if len(row) < 4:
+            scarta("troppo_corta", numero_riga, row)
+            continue
+        regione = row[0].strip()
+        tipo_carburante = row[1].strip()
+        prezzo_str = row[3].strip()
+        if not regione or not tipo_carburante or not prezzo_str:
+            scarta("dati_mancanti", numero_riga, row)
+            continue
+        try:
+           prezzo = float(prezzo_str.replace(",", "."))
+        except ValueError:
+           scarta("prezzo_non_valido", numero_riga, row)
+           continue
+        if regione not in REGIONI_VALIDATE:
+             scarta("regione_sconosciuta", numero_riga, row)
+             continue
+        if (regione, tipo_carburante) in chiavi_viste:
+             scarta("duplicata", numero_riga, row)
+             continue
+        chiavi_viste.add((regione, tipo_carburante))
+        righe_valide.append((regione, tipo_carburante, prezzo))
+
+    return data_aggiornamento, righe_valide, scarti
+
+def carica_prezzi_regionali(conn, data_aggiornamento: date, righe: list) -> int:
+    """
+    Carica le righe con COPY in una tabella temporanea e le unisce a prezzi_regionali
+    con un unico INSERT ... SELECT ... ON CONFLICT. Non esegue il commit.
+    Restituisce il numero di righe effettivamente inserite.
+    """
+    return copia_in_prezzi_regionali(conn, serializza_per_copy(data_aggiornamento, righe), [data_aggiornamento])
+
+def serializza_per_copy(data_aggiornamento: date, righe: list) -> str:
+    """Righe (regione, tipo_carburante, prezzo) nel CSV letto dal COPY di copia_in_prezzi_regionali."""
+    buffer = StringIO()
+    giorno = data_aggiornamento.isoformat()
+    csv.writer(buffer).writerows((regione, tipo, prezzo, giorno) for regione, tipo, prezzo in righe)
+    return buffer.getvalue()
+
+def copia_in_prezzi_regionali(conn, testo_csv: str, giorni: list) -> int:
+    """
+    Un COPY in staging e un merge per righe già serializzate con serializza_per_copy,
+    anche di giorni diversi (`giorni` serve a creare le partizioni). Non esegue il commit.
+    """
+    buffer = StringIO(testo_csv)
+    assicura_partizioni(conn, *giorni)
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS staging_prezzi_regionali (
+                regione TEXT,
+                tipo_carburante TEXT,
+                prezzo_medio NUMERIC,
+                data_aggiornamento DATE
+            ) ON COMMIT DELETE ROWS;
+        """)
+        with DURATA_QUERY_DB.labels(query="copy_staging_prezzi").time():
+            cur.copy_expert(
+                "COPY staging_prezzi_regionali (regione, tipo_carburante, prezzo_medio, data_aggiornamento) "
+                "FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+        with DURATA_QUERY_DB.labels(query="merge_prezzi_regionali").time():
+            cur.execute("""
+                INSERT INTO prezzi_regionali (regione, tipo_carburante, prezzo_medio, data_aggiornamento)
+                SELECT regione, tipo_carburante, prezzo_medio, data_aggiornamento
+                FROM staging_prezzi_regionali
+                ON CONFLICT (regione, tipo_carburante, data_aggiornamento) DO NOTHING;
+            """)
+        return cur.rowcount
+
+def decodifica_csv(contenuto: bytes) -> str:
+    """Decodifica un CSV MIMIT: UTF-8, con ripiego su ISO-8859-1 per i file più vecchi."""
+    try:
+        return contenuto.decode('utf-8')
+    except UnicodeDecodeError:
+        logger.warning("Decodifica UTF-8 fallita, tentativo con ISO-8859-1 (Latin-1)")
+        return contenuto.decode('iso-8859-1')
+
+@misura_durata(DURATA_AGGIORNAMENTO)
+def update_database(report: dict | None = None, forza: bool = False, annullamento: threading.Event | None = None) -> bool:
+    """
+    Scarica il CSV, lo processa, aggiorna il DB e pulisce i dati vecchi.
+    Se il CSV non è cambiato dall'ultimo import non fa nulla (salvo forza=True).
+    Se viene passato un dizionario `report`, vi registra tempi per fase e conteggi.
+    Se `annullamento` viene impostato, l'aggiornamento si interrompe al primo punto di
+    controllo senza salvare nulla.
+    """
     logger.info(f"Tentativo di aggiornamento database da URL: {CSV_URL}")
+    if report is None:
+        report = {}
+    tempi = report.setdefault("tempi", {})
     conn = None
-    cur = None
-    cur_delete = None # Inizializza il cursore per la delete
     success = False # Flag per indicare successo/fallimento
 
     try:
-        response = requests.get(CSV_URL, timeout=30)
-        response.raise_for_status()
+        inizio = time.perf_counter()
+        contenuto, metadati_download = scarica_se_modificato(CSV_URL, forza=forza)
+        tempi["download"] = time.perf_counter() - inizio
+        if contenuto is None:
+            logger.info("CSV invariato dall'ultimo aggiornamento: nessuna elaborazione necessaria.")
+            report["esito"] = "invariato"
+            return True
         logger.info("CSV scaricato con successo.")
+        _verifica_annullamento(annullamento)
 
-        # Usiamo StringIO per trattare la stringa del CSV come un file
-        try:
-            csv_text = response.content.decode('utf-8')
-        except UnicodeDecodeError:
-             logger.warning("Decodifica UTF-8 fallita, tentativo con ISO-8859-1 (Latin-1)")
-             csv_text = response.content.decode('iso-8859-1')
+        csv_text = decodifica_csv(contenuto)
 
-        csv_data = StringIO(csv_text)
+        # --- ANALISI E VALIDAZIONE (tutto in memoria, prima di toccare il DB) ---
+        inizio = time.perf_counter()
+        try:
+            data_aggiornamento, righe_valide, scarti = analizza_csv_prezzi(csv_text)
+        except FormatoCSVNonValido as e:
+            logger.error(str(e))
+            return False # Errore fatale per questo aggiornamento
+        tempi["analisi"] = time.perf_counter() - inizio
+        logger.info(f"Data aggiornamento rilevata dal CSV: {data_aggiornamento}")
+        report["data_aggiornamento"] = data_aggiornamento
+        report["righe_valide"] = len(righe_valide)
+        report["scartate"] = scarti
+        _verifica_annullamento(annullamento)
 
         conn = get_db_connection()
         if not conn:
             logger.error("Aggiornamento fallito: impossibile connettersi al DB.")
+            segna_snapshot_obsoleto()
             return False
 
-        cur = conn.cursor()
-        data_aggiornamento = None
-        righe_processate = 0
-        righe_inserite = 0
+        # --- INSERIMENTO DATI NUOVI (COPY + merge in un'unica transazione) ---
+        inizio = time.perf_counter()
+        righe_inserite = carica_prezzi_regionali(conn, data_aggiornamento, righe_valide)
+        _verifica_annullamento(annullamento)
+        conn.commit()
+        tempi["caricamento"] = time.perf_counter() - inizio
+        registra_download(CSV_URL, metadati_download)
+        report["esito"] = "aggiornato"
+        report["inserite"] = righe_inserite
+        report["saltate"] = len(righe_valide) - righe_inserite # già presenti nel DB
+        logger.info(
+            f"Inserimento dati completato. Righe valide: {len(righe_valide)}, inserite: {righe_inserite}, "
+            f"già presenti: {report['saltate']}, scartate: {sum(scarti.values())} {scarti}."
+        )
 
-        # --- INSERIMENTO DATI NUOVI ---
-        prima_riga = csv_data.readline().strip()
-        try:
-            parti = prima_riga.split()
-            if len(parti) < 2: raise ValueError("Formato prima riga non riconosciuto")
-            data_str = parti[-1]
-            data_aggiornamento = datetime.strptime(data_str, "%d-%m-%Y").date()
-            logger.info(f"Data aggiornamento rilevata dal CSV: {data_aggiornamento}")
-        except (IndexError, ValueError, TypeError) as e:
-            logger.error(f"Impossibile estrarre la data dalla prima riga: '{prima_riga}'. Errore: {e}")
-            return False # Errore fatale per questo aggiornamento
+        # Sostituisce lo snapshot in memoria con i dati appena salvati
+        aggiorna_snapshot_prezzi(conn)
+        aggiorna_matrice_prezzi(conn)
 
-        csv_reader = csv.reader(csv_data, delimiter=';')
-        try:
-             header = next(csv_reader)
-             logger.info(f"Intestazione CSV letta: {header}")
-        except StopIteration:
-             logger.error("Errore: il file CSV sembra vuoto dopo la prima riga.")
-             return False
-
-        for row in csv_reader:
-            righe_processate += 1
+        # Avvisi di prezzo scattati con i nuovi dati, inviati dal dispatcher del bot
+        if _dispatcher_notifiche is not None:
             try:
-                if len(row) < 4:
-                    logger.warning(f"Riga {righe_processate+2} ignorata (troppo corta): {row}")
-                    continue
-                regione = row[0].strip()
-                tipo_carburante = row[1].strip()
-                prezzo_str = row[3].strip()
-                if not regione or not tipo_carburante or not prezzo_str:
-                    logger.warning(f"Riga {righe_processate+2} ignorata (dati mancanti): {row}")
-                    continue
-                try:
-                   prezzo = float(prezzo_str.replace(",", "."))
-                except ValueError:
-                   logger.warning(f"Prezzo non valido '{prezzo_str}' per {regione}/{tipo_carburante} (Riga {righe_processate+2}). Ignorata: {row}")
-                   continue
-                if regione not in REGIONI_VALIDATE:
-                     logger.warning(f"Regione '{regione}' letta dal CSV ma non presente nella lista REGIONI_VALIDATE (Riga {righe_processate+2}). Riga ignorata: {row}")
-                     continue
-
-                query = """
-                    INSERT INTO prezzi_regionali (regione, tipo_carburante, prezzo_medio, data_aggiornamento)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (regione, tipo_carburante, data_aggiornamento) DO NOTHING;
-                """
-                cur.execute(query, (regione, tipo_carburante, prezzo, data_aggiornamento))
-                if cur.rowcount > 0:
-                    righe_inserite += 1
-
-            except Exception as e:
-                logger.error(f"Errore processando la riga {righe_processate+2}: {row}. Errore: {e}")
-                conn.rollback() # Annulla transazione parziale
-
-        # Commit degli inserimenti
-        conn.commit()
-        logger.info(f"Inserimento dati completato. Righe CSV lette (dopo intestazione): {righe_processate}, Righe nuove inserite: {righe_inserite}.")
-
-        # --- PULIZIA DATI VECCHI ---
+                notifiche = valuta_avvisi(conn, data_aggiornamento)
+                conn.commit()
+                report["avvisi_scattati"] = len(notifiche)
+                _dispatcher_notifiche.accoda_da_thread(notifiche)
+            except psycopg2.Error as e:
+                logger.error(f"Errore Database durante la valutazione degli avvisi: {e}")
+                conn.rollback()
+
+        # --- PULIZIA DATI VECCHI (eliminazione di partizioni mensili intere) ---
+        inizio = time.perf_counter()
         try:
-            giorni_da_mantenere = 30 # Mantieni gli ultimi 30 giorni
-            logger.info(f"Avvio pulizia dati più vecchi di {giorni_da_mantenere} giorni...")
-            cur_delete = conn.cursor() # Usa un nuovo cursore per la delete
-            query_delete = """
-                DELETE FROM prezzi_regionali
-                WHERE data_aggiornamento < CURRENT_DATE - INTERVAL '%s days';
-            """
-            cur_delete.execute(query_delete, (giorni_da_mantenere,))
-            righe_cancellate = cur_delete.rowcount
-            conn.commit() # Commit della cancellazione
-            logger.info(f"Pulizia completata. Righe vecchie cancellate: {righe_cancellate}.")
-            cur_delete.close() # Chiudi il cursore della delete
-            cur_delete = None # Resetta la variabile per il blocco finally
+            logger.info(f"Avvio pulizia delle partizioni più vecchie di {RETENTION_GIORNI} giorni...")
+            with DURATA_QUERY_DB.labels(query="retention_prezzi_regionali").time():
+                partizioni_eliminate = elimina_partizioni_scadute(conn)
+            conn.commit() # Commit dell'eliminazione
+            report["partizioni_eliminate"] = partizioni_eliminate
+            logger.info(f"Pulizia completata. Partizioni eliminate: {partizioni_eliminate or 'nessuna'}.")
         except psycopg2.Error as e:
              logger.error(f"Errore Database durante la pulizia dei dati vecchi: {e}")
              if conn and not conn.closed: conn.rollback() # Annulla cancellazione in caso di errore
         except Exception as e:
              logger.error(f"Errore imprevisto durante la pulizia: {e}")
              if conn and not conn.closed: conn.rollback()
+        tempi["pulizia"] = time.perf_counter() - inizio
 
         success = True # L'aggiornamento è considerato riuscito anche se la pulizia fallisce
-
+        RIGHE_CSV.labels(esito="inserita", motivo="").inc(righe_inserite)
+        RIGHE_CSV.labels(esito="gia_presente", motivo="").inc(report["saltate"])
+        for motivo, quante in scarti.items():
+            RIGHE_CSV.labels(esito="scartata", motivo=motivo).inc(quante)
+        logger.info("Tempi aggiornamento: " + ", ".join(f"{fase} {secondi:.3f}s" for fase, secondi in tempi.items()))
+
+    except AggiornamentoAnnullato:
+        logger.warning("Aggiornamento database annullato: nessun dato salvato.")
+        report["esito"] = "annullato"
+        if conn and not conn.closed: conn.rollback()
     except requests.exceptions.RequestException as e:
         logger.error(f"Errore durante il download del CSV: {e}")
     except psycopg2.Error as e:
         logger.error(f"Errore Database durante l'aggiornamento/inserimento: {e}")
-        if conn: conn.rollback() # Annulla transazione
+        if conn and not conn.closed: conn.rollback() # Annulla transazione
     except UnicodeDecodeError as e:
         logger.error(f"Errore di decodifica del file CSV: {e}")
     except Exception as e:
         logger.error(f"Errore imprevisto durante l'aggiornamento del database: {e}")
         if conn and not conn.closed: conn.rollback()
     finally:
-        # Assicurati di chiudere tutti i cursori e la connessione
-        if cur and not cur.closed:
-            cur.close()
-        if cur_delete and not cur_delete.closed: # Chiudi anche cur_delete se esiste
-            cur_delete.close()
-        if conn and not conn.closed:
-             conn.close()
-             logger.info("Connessione al database chiusa (dopo aggiornamento e pulizia).")
+        if conn:
+             release_db_connection(conn)
+             logger.info("Connessione al database restituita al pool (dopo aggiornamento e pulizia).")
+        for fase, secondi in tempi.items():
+            DURATA_FASE_AGGIORNAMENTO.labels(fase=fase).observe(secondi)
     return success
 
 
-def get_prezzi_regione_dal_db(nome_regione: str) -> str:
-    """Recupera i prezzi più recenti per una regione dal DB e formatta la risposta."""
-    logger.info(f"Richiesta prezzi per regione: {nome_regione}")
-    conn = None
+# --- Import storico (backfill) da un archivio di CSV MIMIT ---
+
+def analizza_file_archivio(percorso: str):
+    """
+    Legge e valida un CSV dell'archivio con le stesse regole di update_database e prepara
+    già le righe per il COPY. Gira nei processi del pool di backfill: restituisce
+    (percorso, data, testo_csv, numero_righe, scarti, byte), con data None se il file
+    non è utilizzabile.
+    """
+    try:
+        with open(percorso, "rb") as f:
+            contenuto = f.read()
+    except OSError as e:
+        logger.error(f"{percorso}: lettura fallita: {e}")
+        return percorso, None, "", 0, {"file_illeggibile": 1}, -1 # dimensione -1: riprovato alla ripresa
+    try:
+        data_aggiornamento, righe, scarti = analizza_csv_prezzi(decodifica_csv(contenuto))
+    except FormatoCSVNonValido as e:
+        logger.error(f"{percorso}: {e}")
+        return percorso, None, "", 0, {"formato_non_valido": 1}, len(contenuto)
+    return percorso, data_aggiornamento, serializza_per_copy(data_aggiornamento, righe), len(righe), scarti, len(contenuto)
+
+def elenca_file_archivio(cartella: str) -> list:
+    """Tutti i .csv sotto `cartella` (anche nelle sottocartelle), in ordine di percorso."""
+    return sorted(
+        os.path.join(radice, nome)
+        for radice, _, nomi in os.walk(cartella)
+        for nome in nomi if nome.lower().endswith(".csv")
+    )
+
+def _leggi_checkpoint(percorso: str) -> dict:
+    try:
+        with open(percorso, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _scrivi_checkpoint(percorso: str, completati: dict) -> None:
+    """Scrittura atomica: un crash a metà lascia il checkpoint precedente intatto."""
+    temporaneo = f"{percorso}.tmp"
+    with open(temporaneo, "w", encoding="utf-8") as f:
+        json.dump(completati, f, indent=1, sort_keys=True)
+    os.replace(temporaneo, percorso)
+
+def backfill(cartella: str, file_checkpoint: str | None = None, worker: int | None = None,
+             righe_per_lotto: int = 50_000) -> dict:
+    """
+    Importa in prezzi_regionali tutti i CSV delle medie regionali di un archivio.
+    I file vengono analizzati e serializzati in parallelo in un pool di processi e caricati
+    a lotti con un COPY per lotto. Dopo ogni commit il checkpoint registra i file completati, che
+    alla ripresa vengono saltati (a meno che la dimensione non sia cambiata).
+    I file più vecchi della retention vengono saltati: la pulizia li eliminerebbe comunque.
+    Restituisce un report con conteggi e throughput.
+    """
+    file_checkpoint = file_checkpoint or os.path.join(cartella, ".backfill_checkpoint.json")
+    completati = _leggi_checkpoint(file_checkpoint)
+    tutti = elenca_file_archivio(cartella)
+    da_importare = [
+        p for p in tutti
+        if completati.get(os.path.relpath(p, cartella), {}).get("dimensione") != os.path.getsize(p)
+    ]
+    limite_retention = date.fromordinal(date.today().toordinal() - RETENTION_GIORNI)
+    report = {
+        "file_totali": len(tutti), "file_gia_importati": len(tutti) - len(da_importare),
+        "file_importati": 0, "file_non_validi": 0, "file_oltre_retention": 0,
+        "righe_valide": 0, "inserite": 0, "scartate": {}, "lotti": 0, "byte_letti": 0,
+    }
+    logger.info(f"Backfill da {cartella}: {len(da_importare)} file da importare, {report['file_gia_importati']} già fatti.")
+
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Backfill annullato: impossibile connettersi al DB.")
+        report["esito"] = "errore"
+        return report
+
+    lotto, file_nel_lotto = [], {}
+    righe_nel_lotto = 0
+    inizio = time.perf_counter()
+
+    def salva_lotto():
+        nonlocal righe_nel_lotto
+        if lotto:
+            report["inserite"] += copia_in_prezzi_regionali(conn, "".join(testo for _, testo in lotto), [g for g, _ in lotto])
+        conn.commit()
+        completati.update(file_nel_lotto)
+        _scrivi_checkpoint(file_checkpoint, completati)
+        report["lotti"] += 1
+        trascorsi = time.perf_counter() - inizio
+        fatti = report["file_importati"] + report["file_non_validi"] + report["file_oltre_retention"]
+        logger.info(
+            f"Backfill: {fatti}/{len(da_importare)} file, {report['righe_valide']} righe "
+            f"({report['righe_valide'] / trascorsi:.0f} righe/s, {fatti / trascorsi:.1f} file/s)."
+        )
+        lotto.clear()
+        file_nel_lotto.clear()
+        righe_nel_lotto = 0
+
+    try:
+        # "fork" evita di reimportare il bot in ogni processo (secondi di avvio con "spawn"): il backfill
+        # gira da riga di comando senza altri thread, e i figli non usano le connessioni ereditate
+        with ProcessPoolExecutor(max_workers=worker, mp_context=multiprocessing.get_context("fork")) as pool:
+            for percorso, data_aggiornamento, testo_csv, numero_righe, scarti, dimensione in pool.map(
+                analizza_file_archivio, da_importare, chunksize=4
+            ):
+                report["byte_letti"] += max(dimensione, 0)
+                for motivo, quante in scarti.items():
+                    report["scartate"][motivo] = report["scartate"].get(motivo, 0) + quante
+                voce = {"dimensione": dimensione, "data": data_aggiornamento.isoformat() if data_aggiornamento else None, "righe": numero_righe}
+                if data_aggiornamento is None:
+                    voce["esito"] = "non_valido"
+                    report["file_non_validi"] += 1
+                elif data_aggiornamento < limite_retention:
+                    voce["esito"] = "oltre_retention"
+                    report["file_oltre_retention"] += 1
+                else:
+                    voce["esito"] = "importato"
+                    report["file_importati"] += 1
+                    report["righe_valide"] += numero_righe
+                    lotto.append((data_aggiornamento, testo_csv))
+                    righe_nel_lotto += numero_righe
+                file_nel_lotto[os.path.relpath(percorso, cartella)] = voce
+                if righe_nel_lotto >= righe_per_lotto:
+                    salva_lotto()
+            salva_lotto()
+        report["esito"] = "completato"
+    except psycopg2.Error as e:
+        logger.error(f"Errore Database durante il backfill (riprendibile dal checkpoint): {e}")
+        if not conn.closed: conn.rollback()
+        report["esito"] = "errore"
+    finally:
+        release_db_connection(conn)
+
+    durata = time.perf_counter() - inizio
+    report["durata_s"] = round(durata, 3)
+    report["file_al_secondo"] = round((len(da_importare) / durata) if durata else 0.0, 1)
+    report["righe_al_secondo"] = round((report["righe_valide"] / durata) if durata else 0.0)
+    report["mb_al_secondo"] = round((report["byte_letti"] / 1e6 / durata) if durata else 0.0, 2)
+    if report["file_oltre_retention"]:
+        logger.warning(
+            f"{report['file_oltre_retention']} file più vecchi di RETENTION_GIORNI={RETENTION_GIORNI} saltati: "
+            "aumenta RETENTION_GIORNI per conservarli."
+        )
+    logger.info(f"Backfill terminato ({report['esito']}) in {durata:.1f}s.")
+    return report
+
+def backfill_cli(argomenti: list) -> int:
+    """Punto di ingresso di `python bot.py backfill <cartella>`."""
+    parser = argparse.ArgumentParser(prog="bot.py backfill", description="Importa un archivio di CSV MIMIT delle medie regionali.")
+    parser.add_argument("cartella", help="cartella con i CSV (anche in sottocartelle)")
+    parser.add_argument("--checkpoint", help="file di checkpoint (default: <cartella>/.backfill_checkpoint.json)")
+    parser.add_argument("--worker", type=int, default=None, help="processi per l'analisi dei file (default: numero di CPU)")
+    parser.add_argument("--righe-per-lotto", type=int, default=50_000, help="righe caricate con ogni COPY")
+    args = parser.parse_args(argomenti)
+
+    if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
+        logger.critical("Backfill impossibile: variabili d'ambiente del database mancanti.")
+        return 1
+    if not applica_migrazioni():
+        return 1
+    try:
+        report = backfill(args.cartella, args.checkpoint, args.worker, args.righe_per_lotto)
+    finally:
+        if _db_pool is not None:
+            _db_pool.chiudi_tutte()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0 if report["esito"] == "completato" else 1
+
+# --- Snapshot in memoria dei prezzi ---
+
+@dataclass(frozen=True)
+class SnapshotPrezzi:
+    """Fotografia immutabile degli ultimi prezzi disponibili per ogni regione."""
+    prezzi: dict = field(default_factory=dict)       # regione -> {tipo_carburante: prezzo}
+    date_regioni: dict = field(default_factory=dict) # regione -> data_aggiornamento più recente
+    data_riferimento: date | None = None             # data più recente tra tutte le regioni
+    messaggi: dict = field(default_factory=dict)     # (regione, data) -> messaggio HTML già formattato
+    inline: dict = field(default_factory=dict)       # prefisso normalizzato -> risultati inline già costruiti
+    obsoleto: bool = False                           # True se non confermato dal DB (irraggiungibile)
+    origine: str = "db"                              # "db" oppure "file" (SNAPSHOT_FILE)
+    caricato_il: datetime | None = None              # lettura dal DB da cui deriva lo snapshot
+
+    def vuoto(self) -> bool:
+        return not self.prezzi
+
+    def messaggio(self, nome_regione: str) -> str | None:
+        """Messaggio pre-formattato per la regione, o None se non presente."""
+        return self.messaggi.get((nome_regione, self.date_regioni.get(nome_regione)))
+
+    def risultati_inline(self, testo: str) -> tuple:
+        """Risultati inline per il testo digitato (prefisso di un nome, di un alias o di una loro parola)."""
+        return self.inline.get(normalizza_testo_inline(testo), ())
+
+_AVVISO_OBSOLETO = "\n⚠️ <i>Database non raggiungibile: questi sono gli ultimi prezzi salvati.</i>"
+
+def crea_snapshot_prezzi(prezzi: dict, date_regioni: dict, obsoleto: bool = False, origine: str = "db",
+                         caricato_il: datetime | None = None) -> SnapshotPrezzi:
+    """
+    Costruisce uno snapshot formattando una volta sola i messaggi di tutte le regioni.
+    Se obsoleto, i messaggi avvisano che i dati potrebbero non essere aggiornati.
+    """
+    messaggi = {}
+    for regione in REGIONI_VALIDATE:
+        data_regione = date_regioni.get(regione)
+        if data_regione is None:
+            messaggi[(regione, None)] = f"❓ Mi dispiace, non ho ancora dati disponibili per la regione '{regione}'."
+        else:
+            messaggi[(regione, data_regione)] = formatta_messaggio_prezzi(regione, data_regione, prezzi[regione]) + (
+                _AVVISO_OBSOLETO if obsoleto else ""
+            )
+    data_riferimento = max(date_regioni.values()) if date_regioni else None
+    return SnapshotPrezzi(
+        prezzi, date_regioni, data_riferimento, messaggi, crea_indice_inline(prezzi, date_regioni, messaggi),
+        obsoleto, origine, caricato_il or datetime.now()
+    )
+
+def normalizza_testo_inline(testo: str) -> str:
+    """Minuscolo, senza accenti, con apostrofi e trattini trasformati in spazi."""
+    testo = unicodedata.normalize("NFKD", testo.lower())
+    testo = "".join(c for c in testo if not unicodedata.combining(c))
+    return " ".join(testo.replace("'", " ").replace("-", " ").split())
+
+def crea_indice_inline(prezzi: dict, date_regioni: dict, messaggi: dict) -> dict:
+    """
+    Costruisce una volta per import i risultati inline delle regioni con dati e l'indice
+    che associa ogni prefisso (di nome, alias o singola parola) ai risultati corrispondenti.
+    La stringa vuota elenca tutte le regioni.
+    """
+    risultati = {}
+    for posizione, regione in enumerate(REGIONI_VALIDATE):
+        data_regione = date_regioni.get(regione)
+        if data_regione is None:
+            continue
+        descrizione = " · ".join(f"{tipo} € {prezzi[regione][tipo]:.3f}" for tipo in CARBURANTI if tipo in prezzi[regione])
+        risultati[regione] = InlineQueryResultArticle(
+            id=f"regione-{posizione}",
+            title=f"⛽ {regione} ({data_regione.strftime('%d/%m/%Y')})",
+            description=descrizione,
+            input_message_content=InputTextMessageContent(messaggi[(regione, data_regione)], parse_mode="HTML"),
+        )
+
+    corrispondenze = {"": list(risultati)}
+    for regione in risultati:
+        for nome in [regione] + ALIAS_REGIONI.get(regione, []):
+            parole = normalizza_testo_inline(nome).split()
+            for inizio in range(len(parole)):
+                coda = " ".join(parole[inizio:])
+                for fine in range(1, len(coda) + 1):
+                    elenco = corrispondenze.setdefault(coda[:fine], [])
+                    if regione not in elenco:
+                        elenco.append(regione)
+    # Stesso ordine di REGIONI_VALIDATE e al massimo 50 risultati, il limite della Bot API
+    return {
+        prefisso: tuple(risultati[r] for r in sorted(regioni, key=REGIONI_VALIDATE.index)[:50])
+        for prefisso, regioni in corrispondenze.items()
+    }
+
+class ContatoreCache:
+    """Contatori thread-safe di hit/miss della cache dei messaggi."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+
+    def registra(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hit += 1
+            else:
+                self.miss += 1
+        CACHE_MESSAGGI.labels(esito="hit" if hit else "miss").inc()
+
+    def valori(self) -> dict:
+        with self._lock:
+            return {"hit": self.hit, "miss": self.miss}
+
+statistiche_cache_messaggi = ContatoreCache()
+
+# Lo snapshot viene sostituito in blocco (assegnazione atomica): i lettori
+# prendono un riferimento e non vedono mai uno stato parziale.
+_snapshot_prezzi = SnapshotPrezzi()
+
+def ottieni_snapshot() -> SnapshotPrezzi:
+    """Restituisce lo snapshot corrente (eventualmente vuoto)."""
+    return _snapshot_prezzi
+
+def aggiorna_snapshot_prezzi(conn=None) -> bool:
+    """
+    Ricarica dal DB gli ultimi prezzi di ogni regione e sostituisce lo snapshot.
+    Se conn è None preleva (e restituisce) una connessione dal pool.
+    """
+    global _snapshot_prezzi
+    connessione_propria = conn is None
     cur = None
+    try:
+        if connessione_propria:
+            conn = get_db_connection()
+            if not conn:
+                logger.error("Snapshot non aggiornato: impossibile connettersi al DB.")
+                segna_snapshot_obsoleto()
+                return False
+        cur = conn.cursor()
+        # Una sola query: per ogni regione le righe della sua data più recente
+        with DURATA_QUERY_DB.labels(query="snapshot_prezzi").time():
+            cur.execute("""
+                SELECT p.regione, p.tipo_carburante, p.prezzo_medio, p.data_aggiornamento
+                FROM prezzi_regionali p
+                JOIN (
+                    SELECT regione, MAX(data_aggiornamento) AS data_max
+                    FROM prezzi_regionali
+                    GROUP BY regione
+                ) m ON m.regione = p.regione AND m.data_max = p.data_aggiornamento;
+            """)
+        prezzi = {}
+        date_regioni = {}
+        for regione, tipo, prezzo, data_agg in cur.fetchall():
+            prezzi.setdefault(regione, {})[tipo] = float(prezzo)
+            date_regioni[regione] = data_agg
+        # Un DB vuoto non sovrascrive l'ultima copia buona, né in memoria né su file
+        if not prezzi and not _snapshot_prezzi.vuoto():
+            logger.warning("Nessun prezzo nel DB: si continua a servire lo snapshot corrente.")
+            return True
+        _snapshot_prezzi = crea_snapshot_prezzi(prezzi, date_regioni)
+        logger.info(f"Snapshot prezzi aggiornato: {len(prezzi)} regioni, data di riferimento {_snapshot_prezzi.data_riferimento}.")
+        if not _snapshot_prezzi.vuoto():
+            salva_snapshot_su_file(_snapshot_prezzi)
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"Errore Database durante il caricamento dello snapshot: {e}")
+        if conn and not conn.closed: conn.rollback()
+        segna_snapshot_obsoleto()
+        return False
+    except Exception as e:
+        logger.error(f"Errore imprevisto durante il caricamento dello snapshot: {e}")
+        return False
+    finally:
+        if cur and not cur.closed: cur.close()
+        if connessione_propria: release_db_connection(conn)
+
+def segna_snapshot_obsoleto() -> None:
+    """Il DB non risponde: si continua a servire lo snapshot corrente, segnalandolo nei messaggi."""
+    global _snapshot_prezzi
+    snapshot = _snapshot_prezzi
+    if snapshot.vuoto() or snapshot.obsoleto:
+        return
+    logger.warning("Snapshot prezzi segnato come obsoleto: il DB non è raggiungibile.")
+    _snapshot_prezzi = crea_snapshot_prezzi(snapshot.prezzi, snapshot.date_regioni, True, snapshot.origine, snapshot.caricato_il)
+
+def salva_snapshot_su_file(snapshot: SnapshotPrezzi, percorso: str | None = None) -> None:
+    """Scrive lo snapshot in SNAPSHOT_FILE (JSON compatto, scrittura atomica)."""
+    percorso = percorso or SNAPSHOT_FILE
+    contenuto = {
+        "caricato_il": snapshot.caricato_il.isoformat(timespec="seconds"),
+        "prezzi": snapshot.prezzi,
+        "date_regioni": {regione: giorno.isoformat() for regione, giorno in snapshot.date_regioni.items()},
+    }
+    temporaneo = f"{percorso}.tmp"
+    try:
+        with open(temporaneo, "w", encoding="utf-8") as f:
+            json.dump(contenuto, f, separators=(",", ":"), ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaneo, percorso)
+    except OSError as e:
+        logger.warning(f"Impossibile salvare lo snapshot in {percorso}: {e}")
+
+def carica_snapshot_da_file(percorso: str | None = None) -> bool:
+    """
+    Carica lo snapshot salvato da salva_snapshot_su_file, segnato come obsoleto finché
+    una lettura dal DB non lo sostituisce. Da chiamare all'avvio, prima del bot.
+    """
+    global _snapshot_prezzi
+    percorso = percorso or SNAPSHOT_FILE
+    try:
+        with open(percorso, encoding="utf-8") as f:
+            contenuto = json.load(f)
+        date_regioni = {regione: date.fromisoformat(giorno) for regione, giorno in contenuto["date_regioni"].items()}
+        snapshot = crea_snapshot_prezzi(
+            contenuto["prezzi"], date_regioni, obsoleto=True, origine="file",
+            caricato_il=datetime.fromisoformat(contenuto["caricato_il"]),
+        )
+    except FileNotFoundError:
+        logger.info(f"Nessuno snapshot locale in {percorso}.")
+        return False
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Snapshot locale {percorso} illeggibile, ignorato: {e}")
+        return False
+    _snapshot_prezzi = snapshot
+    logger.info(f"Snapshot locale caricato da {percorso}: {len(date_regioni)} regioni, data di riferimento {snapshot.data_riferimento}.")
+    return True
+
+def riprova_snapshot_obsoleto() -> None:
+    """Job periodico: finché lo snapshot è obsoleto riprova a leggerlo dal DB."""
+    if ottieni_snapshot().obsoleto and aggiorna_snapshot_prezzi():
+        aggiorna_matrice_prezzi()
+
+def formatta_messaggio_prezzi(nome_regione: str, data_recente: date, prezzi: dict) -> str:
+    """Formatta in HTML i prezzi medi di una regione (prezzi: {tipo_carburante: prezzo})."""
+    data_formattata = data_recente.strftime('%d/%m/%Y')
+    messaggio = f"⛽ <b>Prezzi Medi - {nome_regione}</b> ({data_formattata}) ⛽\n"
+    messaggio += "-------------------------------------------------\n"
+
+    prezzi_dict = {tipo: 'N.D.' for tipo in CARBURANTI}
+    for tipo, prezzo in prezzi.items():
+        if tipo in prezzi_dict:
+           prezzi_dict[tipo] = f"€ {prezzo:.3f}" # Formatta a 3 decimali
+
+    messaggio += f"🟢 <b>Benzina:</b> {prezzi_dict['Benzina']}\n"
+    messaggio += f"⚫ <b>Gasolio:</b> {prezzi_dict['Gasolio']}\n"
+    messaggio += f"🔵 <b>GPL:</b>      {prezzi_dict['GPL']}\n"
+    messaggio += f"⚪ <b>Metano:</b>   {prezzi_dict['Metano']}\n"
+    messaggio += "-------------------------------------------------"
+    return messaggio
+
+
+# --- Matrice dei prezzi regionali: classifica nazionale e confronto tra regioni ---
+
+@dataclass(frozen=True)
+class MatricePrezzi:
+    """
+    Prezzi degli ultimi giorni in un array regioni × carburanti × giorni (NaN se mancante),
+    con le grandezze derivate calcolate una volta sola a ogni import.
+    Gli indici seguono REGIONI_VALIDATE e CARBURANTI.
+    """
+    giorni: tuple = ()                # date dell'asse dei giorni, in ordine crescente
+    valori: np.ndarray | None = None  # (regioni, carburanti, giorni)
+    ultimi: np.ndarray | None = None  # (regioni, carburanti): ultimo prezzo disponibile
+    date_ultimi: tuple = ()           # regione -> data dell'ultimo prezzo (None se assente)
+    variazioni: np.ndarray | None = None       # ultimo prezzo meno la rilevazione precedente
+    media_nazionale: np.ndarray | None = None  # (carburanti,): media delle regioni
+    scostamenti: np.ndarray | None = None      # (regioni, carburanti): ultimo prezzo meno la media
+    classifiche: dict = field(default_factory=dict) # carburante -> messaggio HTML già formattato
+
+    def vuoto(self) -> bool:
+        return not self.giorni
+
+def crea_matrice_prezzi(righe) -> MatricePrezzi:
+    """Costruisce la matrice da righe (regione, tipo_carburante, data_aggiornamento, prezzo_medio)."""
+    indice_regione = {regione: i for i, regione in enumerate(REGIONI_VALIDATE)}
+    indice_carburante = {carburante: i for i, carburante in enumerate(CARBURANTI)}
+    righe = [r for r in righe if r[0] in indice_regione and r[1] in indice_carburante]
+    if not righe:
+        return MatricePrezzi()
+    giorni = tuple(sorted({r[2] for r in righe}))
+    indice_giorno = {giorno: i for i, giorno in enumerate(giorni)}
+
+    valori = np.full((len(REGIONI_VALIDATE), len(CARBURANTI), len(giorni)), np.nan)
+    valori[
+        [indice_regione[r[0]] for r in righe],
+        [indice_carburante[r[1]] for r in righe],
+        [indice_giorno[r[2]] for r in righe],
+    ] = [float(r[3]) for r in righe]
+
+    # Indice dell'ultima rilevazione disponibile fino a ogni giorno (forward fill sull'asse dei giorni)
+    posizioni = np.where(np.isnan(valori), -1, np.arange(len(giorni)))
+    np.maximum.accumulate(posizioni, axis=2, out=posizioni)
+    riempiti = np.take_along_axis(valori, np.maximum(posizioni, 0), axis=2)
+    riempiti[posizioni < 0] = np.nan
+
+    indice_ultimo = posizioni[:, :, -1]
+    ultimi = riempiti[:, :, -1]
+    # Prezzo disponibile il giorno prima dell'ultima rilevazione di ogni regione/carburante
+    indice_precedente = indice_ultimo - 1
+    precedenti = np.take_along_axis(riempiti, np.maximum(indice_precedente, 0)[:, :, None], axis=2)[:, :, 0]
+    precedenti[indice_precedente < 0] = np.nan
+    variazioni = ultimi - precedenti
+
+    conteggi = np.count_nonzero(~np.isnan(ultimi), axis=0)
+    media_nazionale = np.divide(np.nansum(ultimi, axis=0), conteggi, out=np.full(len(CARBURANTI), np.nan), where=conteggi > 0)
+    scostamenti = ultimi - media_nazionale
+
+    ultimo_per_regione = indice_ultimo.max(axis=1)
+    date_ultimi = tuple(giorni[i] if i >= 0 else None for i in ultimo_per_regione)
+
+    matrice = MatricePrezzi(giorni, valori, ultimi, date_ultimi, variazioni, media_nazionale, scostamenti)
+    for carburante in CARBURANTI:
+        matrice.classifiche[carburante] = formatta_classifica(matrice, carburante)
+    return matrice
+
+def _variazione_html(variazione: float) -> str:
+    """Freccia e valore della variazione rispetto alla rilevazione precedente."""
+    if np.isnan(variazione):
+        return ""
+    if abs(variazione) < 0.0005:
+        return " ="
+    return f" {'▲' if variazione > 0 else '▼'}{abs(variazione):.3f}"
+
+def formatta_classifica(matrice: MatricePrezzi, carburante: str) -> str:
+    """Classifica delle regioni dalla più economica per un carburante, con scostamento dalla media."""
+    c = CARBURANTI.index(carburante)
+    if np.isnan(matrice.media_nazionale[c]):
+        return f"❓ Non ho dati recenti sul prezzo di {carburante}."
+    ordine = np.argsort(matrice.ultimi[:, c], kind="stable") # NaN in fondo
+    righe = [
+        f"🏆 <b>Classifica {carburante}</b> (dati al {matrice.giorni[-1].strftime('%d/%m/%Y')})",
+        f"Media nazionale: <b>€ {matrice.media_nazionale[c]:.3f}</b>",
+        "<i>scostamento dalla media, variazione sulla rilevazione precedente</i>",
+        "",
+    ]
+    for posizione, r in enumerate(ordine, start=1):
+        prezzo = matrice.ultimi[r, c]
+        if np.isnan(prezzo):
+            righe.append(f"– {REGIONI_VALIDATE[r]}: N.D.")
+            continue
+        righe.append(
+            f"{posizione}. {REGIONI_VALIDATE[r]}: <b>€ {prezzo:.3f}</b> "
+            f"({matrice.scostamenti[r, c]:+.3f}){_variazione_html(matrice.variazioni[r, c])}"
+        )
+    return "\n".join(righe)
+
+def formatta_confronto(matrice: MatricePrezzi, regione_a: str, regione_b: str) -> str:
+    """Confronto carburante per carburante tra due regioni e rispetto alla media nazionale."""
+    a, b = REGIONI_VALIDATE.index(regione_a), REGIONI_VALIDATE.index(regione_b)
+    differenze = matrice.ultimi[a] - matrice.ultimi[b]
+    righe = [f"⚖️ <b>{regione_a} vs {regione_b}</b>"]
+    for regione, r in ((regione_a, a), (regione_b, b)):
+        data_regione = matrice.date_ultimi[r]
+        righe.append(f"<i>{regione}: dati al {data_regione.strftime('%d/%m/%Y') if data_regione else 'N.D.'}</i>")
+    for c, carburante in enumerate(CARBURANTI):
+        media = matrice.media_nazionale[c]
+        righe.append(f"\n<b>{carburante}</b> (media nazionale {'N.D.' if np.isnan(media) else f'€ {media:.3f}'})")
+        for regione, r in ((regione_a, a), (regione_b, b)):
+            prezzo = matrice.ultimi[r, c]
+            if np.isnan(prezzo):
+                righe.append(f"  {regione}: N.D.")
+            else:
+                righe.append(
+                    f"  {regione}: € {prezzo:.3f} ({matrice.scostamenti[r, c]:+.3f} vs media)"
+                    f"{_variazione_html(matrice.variazioni[r, c])}"
+                )
+        if not np.isnan(differenze[c]):
+            if abs(differenze[c]) < 0.0005:
+                righe.append("  Stesso prezzo")
+            else:
+                righe.append(f"  Più economica: <b>{regione_b if differenze[c] > 0 else regione_a}</b> di € {abs(differenze[c]):.3f}")
+    return "\n".join(righe)
+
+# Sostituita in blocco a ogni import, come lo snapshot: classifiche e derivate restano valide fino al successivo
+_matrice_prezzi = MatricePrezzi()
+
+def ottieni_matrice_prezzi() -> MatricePrezzi:
+    return _matrice_prezzi
+
+def aggiorna_matrice_prezzi(conn=None) -> bool:
+    """
+    Ricarica con una sola query gli ultimi GIORNI_MATRICE giorni di prezzi regionali
+    e sostituisce la matrice. Se conn è None preleva una connessione dal pool.
+    """
+    global _matrice_prezzi
+    connessione_propria = conn is None
+    try:
+        if connessione_propria:
+            conn = get_db_connection()
+            if not conn:
+                logger.error("Matrice prezzi non aggiornata: impossibile connettersi al DB.")
+                return False
+        with conn.cursor() as cur:
+            with DURATA_QUERY_DB.labels(query="matrice_prezzi").time():
+                cur.execute("""
+                    SELECT regione, tipo_carburante, data_aggiornamento, prezzo_medio
+                    FROM prezzi_regionali
+                    WHERE data_aggiornamento > (SELECT MAX(data_aggiornamento) FROM prezzi_regionali) - %s;
+                """, (GIORNI_MATRICE,))
+                righe = cur.fetchall()
+        _matrice_prezzi = crea_matrice_prezzi(righe)
+        logger.info(f"Matrice prezzi aggiornata: {len(righe)} righe su {len(_matrice_prezzi.giorni)} giorni.")
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"Errore Database durante il caricamento della matrice prezzi: {e}")
+        if conn and not conn.closed: conn.rollback()
+        return False
+    finally:
+        if connessione_propria: release_db_connection(conn)
+
+# --- Storico dei prezzi: grafici PNG con cache ---
+
+def disegna_grafico_storico(regione: str, serie: dict, giorni: int) -> bytes:
+    """
+    Disegna l'andamento dei prezzi (serie: {carburante: ([date], [prezzi])}) e restituisce il PNG.
+    Gira nei processi di _pool_grafici: matplotlib viene importato solo lì.
+    """
+    from matplotlib.figure import Figure
+    import matplotlib.dates as mdates
+
+    figura = Figure(figsize=(8, 4.5), dpi=100)
+    assi = figura.add_subplot()
+    for carburante, (date_serie, prezzi) in serie.items():
+        assi.plot(date_serie, prezzi, marker="o", markersize=3, linewidth=1.5, label=carburante)
+    assi.set_title(f"Prezzi medi {regione} - ultimi {giorni} giorni")
+    assi.set_ylabel("€")
+    assi.xaxis.set_major_formatter(mdates.DateFormatter("%d/%m"))
+    assi.grid(alpha=0.3)
+    assi.legend()
+    figura.autofmt_xdate()
+    buffer = BytesIO()
+    figura.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+class CacheGrafici:
+    """
+    Cache LRU dei grafici in memoria e su disco, con chiave (regione, carburante, giorni, data).
+    Ricorda anche il file_id assegnato da Telegram al primo invio, così le richieste
+    successive non ricaricano l'immagine. Thread-safe.
+    """
 
+    def __init__(self, cartella: str, max_memoria: int, max_disco: int):
+        self._cartella = cartella
+        self._max_memoria = max_memoria
+        self._max_disco = max_disco
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict() # chiave -> PNG
+        self._file_id = OrderedDict() # chiave -> file_id Telegram
+
+    def _percorso(self, chiave: tuple) -> str:
+        nome = hashlib.sha1(repr(chiave).encode("utf-8")).hexdigest()[:20]
+        return os.path.join(self._cartella, f"{nome}.png")
+
+    def file_id(self, chiave: tuple) -> str | None:
+        with self._lock:
+            if chiave in self._file_id:
+                self._file_id.move_to_end(chiave)
+                return self._file_id[chiave]
+        return None
+
+    def registra_file_id(self, chiave: tuple, file_id: str | None) -> None:
+        """Associa (o con None dimentica) il file_id Telegram del grafico."""
+        with self._lock:
+            if file_id is None:
+                self._file_id.pop(chiave, None)
+                return
+            self._file_id[chiave] = file_id
+            self._file_id.move_to_end(chiave)
+            while len(self._file_id) > self._max_disco:
+                self._file_id.popitem(last=False)
+
+    def leggi(self, chiave: tuple):
+        """Restituisce (PNG, origine) cercando in memoria e poi su disco, oppure (None, None)."""
+        with self._lock:
+            if chiave in self._memoria:
+                self._memoria.move_to_end(chiave)
+                return self._memoria[chiave], "memoria"
+        percorso = self._percorso(chiave)
+        try:
+            with open(percorso, "rb") as f:
+                png = f.read()
+            os.utime(percorso) # la data di modifica fa da "ultimo accesso" per l'LRU su disco
+        except OSError:
+            return None, None
+        self._metti_in_memoria(chiave, png)
+        return png, "disco"
+
+    def salva(self, chiave: tuple, png: bytes) -> None:
+        self._metti_in_memoria(chiave, png)
+        try:
+            os.makedirs(self._cartella, exist_ok=True)
+            percorso = self._percorso(chiave)
+            temporaneo = f"{percorso}.{uuid.uuid4().hex}.tmp"
+            with open(temporaneo, "wb") as f:
+                f.write(png)
+            os.replace(temporaneo, percorso)
+            self._pulisci_disco()
+        except OSError as e:
+            logger.warning(f"Impossibile salvare il grafico in {self._cartella}: {e}")
+
+    def _metti_in_memoria(self, chiave: tuple, png: bytes) -> None:
+        with self._lock:
+            self._memoria[chiave] = png
+            self._memoria.move_to_end(chiave)
+            while len(self._memoria) > self._max_memoria:
+                self._memoria.popitem(last=False)
+
+    def _pulisci_disco(self) -> None:
+        """Elimina i file usati meno di recente oltre max_disco."""
+        with os.scandir(self._cartella) as voci:
+            file_png = [(voce.stat().st_mtime, voce.path) for voce in voci if voce.name.endswith(".png")]
+        if len(file_png) <= self._max_disco:
+            return
+        file_png.sort()
+        for _, percorso in file_png[:len(file_png) - self._max_disco]:
+            try:
+                os.remove(percorso)
+            except OSError:
+                pass
+
+cache_grafici = CacheGrafici(CARTELLA_CACHE_GRAFICI, GRAFICI_CACHE_MEMORIA, GRAFICI_CACHE_DISCO)
+
+# Processi per il disegno dei grafici (CPU) e limite ai disegni in corso o in attesa,
+# creati in post_init: l'event loop non esegue mai matplotlib.
+_pool_grafici: ProcessPoolExecutor | None = None
+_limite_grafici: asyncio.Semaphore | None = None
+
+def _crea_pool_grafici() -> ProcessPoolExecutor:
+    # "spawn": i processi figli non ereditano thread e connessioni del bot
+    return ProcessPoolExecutor(max_workers=GRAFICI_WORKER, mp_context=multiprocessing.get_context("spawn"))
+
+def avvia_pool_grafici() -> None:
+    global _pool_grafici, _limite_grafici
+    _pool_grafici = _crea_pool_grafici()
+    _limite_grafici = asyncio.Semaphore(GRAFICI_WORKER * 2)
+
+def _ricrea_pool_grafici(rotto: ProcessPoolExecutor) -> None:
+    """Sostituisce il pool dei grafici dopo la morte di un processo figlio (una volta sola per pool rotto)."""
+    global _pool_grafici
+    if _pool_grafici is not rotto:
+        return # già ricreato da un'altra richiesta o fermato
+    logger.error("Pool dei grafici non più utilizzabile: viene ricreato.")
+    rotto.shutdown(wait=False, cancel_futures=True)
+    _pool_grafici = _crea_pool_grafici()
+
+def ferma_pool_grafici() -> None:
+    global _pool_grafici
+    if _pool_grafici is not None:
+        _pool_grafici.shutdown(wait=False, cancel_futures=True)
+        _pool_grafici = None
+
+_grafici_in_corso: dict = {} # chiave -> Future del disegno già avviato
+
+async def genera_grafico_storico(chiave: tuple, regione: str, serie: dict, giorni: int) -> bytes:
+    """
+    Disegna il grafico nel pool di processi e lo salva in cache. Richieste concorrenti
+    per la stessa chiave attendono lo stesso disegno invece di ripeterlo.
+    """
+    in_corso = _grafici_in_corso.get(chiave)
+    if in_corso is not None:
+        return await asyncio.shield(in_corso)
+    futuro = asyncio.get_running_loop().create_future()
+    _grafici_in_corso[chiave] = futuro
     try:
+        async with _limite_grafici:
+            pool = _pool_grafici
+            try:
+                with DURATA_GRAFICO.time():
+                    png = await asyncio.get_running_loop().run_in_executor(
+                        pool, disegna_grafico_storico, regione, serie, giorni
+                    )
+            except BrokenProcessPool:
+                _ricrea_pool_grafici(pool)
+                raise
+        await asyncio.to_thread(cache_grafici.salva, chiave, png)
+        futuro.set_result(png)
+        return png
+    except BaseException as e:
+        futuro.set_exception(e)
+        futuro.exception() # evita l'avviso "exception was never retrieved" se nessuno era in attesa
+        raise
+    finally:
+        del _grafici_in_corso[chiave]
+
+# --- Distributori: anagrafica, prezzi e indice spaziale ---
+
+# Lato della cella della griglia in gradi (~11 km in latitudine, ~8 km in longitudine al Nord)
+DIMENSIONE_CELLA_GRADI = 0.1
+
+@dataclass(frozen=True)
+class Impianto:
+    """Distributore dell'anagrafica MIMIT."""
+    id_impianto: int
+    gestore: str
+    bandiera: str
+    nome: str
+    indirizzo: str
+    comune: str
+    provincia: str
+    latitudine: float
+    longitudine: float
+
+def categoria_carburante(descrizione: str) -> str | None:
+    """Riconduce la descrizione MIMIT a una delle voci di CARBURANTI (None se diversa)."""
+    descrizione = descrizione.strip().lower()
+    for carburante in CARBURANTI:
+        if descrizione == carburante.lower():
+            return carburante
+    return None
+
+def distanza_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distanza in km tra due coordinate (formula dell'emisenoverso)."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+def _cella(latitudine: float, longitudine: float) -> tuple:
+    return (math.floor(latitudine / DIMENSIONE_CELLA_GRADI), math.floor(longitudine / DIMENSIONE_CELLA_GRADI))
+
+class IndiceImpianti:
+    """
+    Indice spaziale a griglia dei prezzi dei distributori, costruito una volta per import.
+    Per ogni carburante ogni cella contiene (prezzo, latitudine, longitudine, id, self_service)
+    col prezzo migliore dell'impianto; una ricerca visita solo le celle che coprono il raggio.
+    """
+
+    def __init__(self, impianti: dict, prezzi):
+        self.impianti = impianti # id_impianto -> Impianto
+        migliori = {} # (id_impianto, carburante) -> (prezzo, self_service)
+        for id_impianto, descrizione, prezzo, self_service, *_ in prezzi:
+            carburante = categoria_carburante(descrizione)
+            if carburante is None or id_impianto not in impianti:
+                continue
+            attuale = migliori.get((id_impianto, carburante))
+            if attuale is None or prezzo < attuale[0]:
+                migliori[(id_impianto, carburante)] = (prezzo, self_service)
+
+        self._celle = {carburante: {} for carburante in CARBURANTI}
+        for (id_impianto, carburante), (prezzo, self_service) in migliori.items():
+            impianto = impianti[id_impianto]
+            cella = _cella(impianto.latitudine, impianto.longitudine)
+            self._celle[carburante].setdefault(cella, []).append(
+                (prezzo, impianto.latitudine, impianto.longitudine, id_impianto, self_service)
+            )
+        self.numero_prezzi = len(migliori)
+
+    def vuoto(self) -> bool:
+        return self.numero_prezzi == 0
+
+    def cerca(self, latitudine: float, longitudine: float, carburante: str, raggio_km: float, quanti: int) -> list:
+        """
+        Restituisce fino a `quanti` tuple (prezzo, distanza_km, Impianto, self_service)
+        con i prezzi più bassi entro `raggio_km`, ordinate per prezzo e poi per distanza.
+        """
+        celle = self._celle.get(carburante)
+        if not celle:
+            return []
+        delta_lat = raggio_km / 111.0
+        delta_lon = raggio_km / (111.0 * max(math.cos(math.radians(latitudine)), 0.01))
+        cella_min = _cella(latitudine - delta_lat, longitudine - delta_lon)
+        cella_max = _cella(latitudine + delta_lat, longitudine + delta_lon)
+
+        candidati = []
+        for ix in range(cella_min[0], cella_max[0] + 1):
+            for iy in range(cella_min[1], cella_max[1] + 1):
+                for prezzo, lat, lon, id_impianto, self_service in celle.get((ix, iy), ()):
+                    distanza = distanza_km(latitudine, longitudine, lat, lon)
+                    if distanza <= raggio_km:
+                        candidati.append((prezzo, distanza, id_impianto, self_service))
+        migliori = heapq.nsmallest(quanti, candidati)
+        return [(prezzo, distanza, self.impianti[id_impianto], self_service)
+                for prezzo, distanza, id_impianto, self_service in migliori]
+
+# Come per lo snapshot, l'indice viene sostituito in blocco dopo ogni import
+_indice_impianti = IndiceImpianti({}, [])
+
+def ottieni_indice_impianti() -> IndiceImpianti:
+    """Restituisce l'indice corrente (eventualmente vuoto)."""
+    return _indice_impianti
+
+def _righe_csv_mimit(linee, origine: str):
+    """
+    Legge un CSV MIMIT dei distributori (righe in bytes, anche in streaming) e ne
+    restituisce le righe di dati. Salta la riga "Estrazione del ..." e l'intestazione;
+    il separatore (';' o '|') viene riconosciuto dall'intestazione.
+    """
+    iteratore = (linea.decode('utf-8', errors='replace') for linea in linee)
+    intestazione = next(iteratore, None)
+    if intestazione is not None and "idImpianto" not in intestazione:
+        intestazione = next(iteratore, None) # La prima riga era "Estrazione del ..."
+    if intestazione is None:
+        raise FormatoCSVNonValido(f"Intestazione mancante nel CSV {origine}")
+    separatore = '|' if '|' in intestazione else ';'
+    yield from csv.reader(iteratore, delimiter=separatore, quoting=csv.QUOTE_NONE)
+
+def analizza_anagrafica_impianti(righe):
+    """
+    Valida le righe dell'anagrafica (idImpianto, Gestore, Bandiera, Tipo Impianto, Nome,
+    Indirizzo, Comune, Provincia, Latitudine, Longitudine).
+    Restituisce ({id_impianto: Impianto}, scarti per motivo).
+    """
+    impianti = {}
+    scarti = {}
+    for row in righe:
+        if len(row) < 10:
+            motivo = "troppo_corta"
+        else:
+            try:
+                id_impianto = int(row[0])
+                latitudine = float(row[8].replace(",", "."))
+                longitudine = float(row[9].replace(",", "."))
+            except ValueError:
+                motivo = "valori_non_validi"
+            else:
+                # Coordinate assenti (0,0) o palesemente fuori dall'Italia
+                if not (35.0 <= latitudine <= 48.0 and 6.0 <= longitudine <= 19.0):
+                    motivo = "coordinate_non_valide"
+                else:
+                    impianti[id_impianto] = Impianto(
+                        id_impianto, row[1].strip(), row[2].strip(), row[4].strip(),
+                        row[5].strip(), row[6].strip(), row[7].strip(), latitudine, longitudine
+                    )
+                    continue
+        scarti[motivo] = scarti.get(motivo, 0) + 1
+    return impianti, scarti
+
+def analizza_prezzi_impianti(righe, impianti: dict):
+    """
+    Valida le righe dei prezzi (idImpianto, descCarburante, prezzo, isSelf, dtComu) degli
+    impianti presenti in anagrafica. Per ogni (impianto, carburante, self) tiene la
+    comunicazione più recente. Restituisce (lista di tuple, scarti per motivo).
+    """
+    prezzi = {}
+    scarti = {}
+    for row in righe:
+        if len(row) < 5:
+            motivo = "troppo_corta"
+        else:
+            try:
+                id_impianto = int(row[0])
+                carburante = row[1].strip()
+                prezzo = float(row[2].replace(",", "."))
+                self_service = row[3].strip() == "1"
+                data_comunicazione = datetime.strptime(row[4].strip(), "%d/%m/%Y %H:%M:%S")
+            except ValueError:
+                motivo = "valori_non_validi"
+            else:
+                if id_impianto not in impianti:
+                    motivo = "impianto_sconosciuto"
+                elif not carburante or prezzo <= 0:
+                    motivo = "dati_mancanti"
+                else:
+                    chiave = (id_impianto, carburante, self_service)
+                    attuale = prezzi.get(chiave)
+                    if attuale is None or data_comunicazione > attuale[4]:
+                        prezzi[chiave] = (id_impianto, carburante, prezzo, self_service, data_comunicazione)
+                    continue
+        scarti[motivo] = scarti.get(motivo, 0) + 1
+    return list(prezzi.values()), scarti
+
+def carica_impianti(conn, impianti: dict, prezzi: list) -> None:
+    """Sostituisce anagrafica e prezzi dei distributori con due COPY (senza commit)."""
+    buffer_impianti = StringIO()
+    writer = csv.writer(buffer_impianti)
+    for i in impianti.values():
+        writer.writerow((i.id_impianto, i.gestore, i.bandiera, i.nome, i.indirizzo,
+                         i.comune, i.provincia, i.latitudine, i.longitudine))
+    buffer_impianti.seek(0)
+
+    buffer_prezzi = StringIO()
+    writer = csv.writer(buffer_prezzi)
+    writer.writerows(prezzi)
+    buffer_prezzi.seek(0)
+
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE impianti, prezzi_impianti;")
+        cur.copy_expert(
+            "COPY impianti (id_impianto, gestore, bandiera, nome, indirizzo, comune, provincia, latitudine, longitudine) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer_impianti
+        )
+        cur.copy_expert(
+            "COPY prezzi_impianti (id_impianto, carburante, prezzo, self_service, data_comunicazione) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer_prezzi
+        )
+
+def update_impianti(report: dict | None = None, forza: bool = False, annullamento: threading.Event | None = None) -> bool:
+    """
+    Scarica prezzi e anagrafica dei distributori, li carica nel DB e ricostruisce
+    l'indice spaziale. Se il file prezzi non è cambiato (304 o stesso hash) non
+    scarica l'anagrafica e non analizza nulla.
+    `annullamento` funziona come per update_database.
+    """
+    global _indice_impianti
+    logger.info(f"Tentativo di aggiornamento distributori da URL: {PREZZI_IMPIANTI_URL}")
+    if report is None:
+        report = {}
+    tempi = report.setdefault("tempi", {})
+    conn = None
+    success = False
+
+    try:
+        # --- PREZZI (richiesta condizionale, letti prima dell'anagrafica) ---
+        inizio = time.perf_counter()
+        sessione = _ottieni_sessione_http()
+        precedente = {} if forza else _leggi_stato_download().get(PREZZI_IMPIANTI_URL, {})
+        with sessione.get(PREZZI_IMPIANTI_URL, headers=_intestazioni_condizionali(precedente),
+                          stream=True, timeout=60) as risposta_prezzi:
+            if risposta_prezzi.status_code == 304:
+                logger.info("Prezzi dei distributori non modificati (304).")
+                report["esito"] = "invariato"
+                return True
+            risposta_prezzi.raise_for_status()
+            metadati = {
+                "etag": risposta_prezzi.headers.get("ETag"),
+                "last_modified": risposta_prezzi.headers.get("Last-Modified"),
+            }
+            # Il file prezzi si legge (e si hasha) per intero prima di aprire l'anagrafica:
+            # se è identico all'ultimo import non si scarica né si analizza nient'altro
+            hasher = hashlib.sha256()
+            linee_prezzi = []
+            for linea in risposta_prezzi.iter_lines():
+                hasher.update(linea + b"\n")
+                linee_prezzi.append(linea)
+        metadati["sha256"] = hasher.hexdigest()
+        if precedente.get("sha256") == metadati["sha256"]:
+            logger.info("Prezzi dei distributori identici all'ultimo import (hash invariato).")
+            registra_download(PREZZI_IMPIANTI_URL, metadati)
+            report["esito"] = "invariato"
+            return True
+        _verifica_annullamento(annullamento)
+
+        # L'anagrafica serve per validare i prezzi: la analizziamo mentre arriva
+        with sessione.get(ANAGRAFICA_IMPIANTI_URL, stream=True, timeout=60) as risposta_anagrafica:
+            risposta_anagrafica.raise_for_status()
+            impianti, scarti_anagrafica = analizza_anagrafica_impianti(
+                _righe_csv_mimit(risposta_anagrafica.iter_lines(), ANAGRAFICA_IMPIANTI_URL)
+            )
+        prezzi, scarti_prezzi = analizza_prezzi_impianti(_righe_csv_mimit(linee_prezzi, PREZZI_IMPIANTI_URL), impianti)
+        tempi["download_analisi"] = time.perf_counter() - inizio
+        report["impianti"] = len(impianti)
+        report["prezzi"] = len(prezzi)
+        report["scartate"] = {"anagrafica": scarti_anagrafica, "prezzi": scarti_prezzi}
+        logger.info(
+            f"Distributori letti: {len(impianti)} impianti (scartati {scarti_anagrafica}), "
+            f"{len(prezzi)} prezzi (scartati {scarti_prezzi})."
+        )
+        _verifica_annullamento(annullamento)
+
         conn = get_db_connection()
         if not conn:
-            return "❌ Errore: Impossibile connettersi al database al momento."
+            logger.error("Aggiornamento distributori fallito: impossibile connettersi al DB.")
+            return False
 
-        cur = conn.cursor()
+        inizio = time.perf_counter()
+        carica_impianti(conn, impianti, prezzi)
+        _verifica_annullamento(annullamento)
+        conn.commit()
+        tempi["caricamento"] = time.perf_counter() - inizio
+        registra_download(PREZZI_IMPIANTI_URL, metadati)
+
+        inizio = time.perf_counter()
+        _indice_impianti = IndiceImpianti(impianti, prezzi)
+        tempi["indice"] = time.perf_counter() - inizio
+        report["esito"] = "aggiornato"
+        success = True
+        logger.info("Tempi aggiornamento distributori: " + ", ".join(f"{fase} {secondi:.3f}s" for fase, secondi in tempi.items()))
+
+    except AggiornamentoAnnullato:
+        logger.warning("Aggiornamento distributori annullato: nessun dato salvato.")
+        report["esito"] = "annullato"
+        if conn and not conn.closed: conn.rollback()
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Errore durante il download dei CSV dei distributori: {e}")
+    except FormatoCSVNonValido as e:
+        logger.error(str(e))
+    except psycopg2.Error as e:
+        logger.error(f"Errore Database durante l'aggiornamento dei distributori: {e}")
+        if conn and not conn.closed: conn.rollback()
+    except Exception as e:
+        logger.error(f"Errore imprevisto durante l'aggiornamento dei distributori: {e}")
+        if conn and not conn.closed: conn.rollback()
+    finally:
+        release_db_connection(conn)
+    return success
+
+def carica_indice_impianti() -> bool:
+    """Ricostruisce l'indice spaziale dai dati già presenti nel DB (usato all'avvio)."""
+    global _indice_impianti
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Indice distributori non caricato: impossibile connettersi al DB.")
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT id_impianto, gestore, bandiera, nome, indirizzo, comune, provincia, latitudine, longitudine
+                FROM impianti;
+            """)
+            impianti = {row[0]: Impianto(*row) for row in cur.fetchall()}
+            cur.execute("SELECT id_impianto, carburante, prezzo, self_service FROM prezzi_impianti;")
+            prezzi = [(id_impianto, carburante, float(prezzo), self_service)
+                      for id_impianto, carburante, prezzo, self_service in cur.fetchall()]
+        conn.rollback() # Chiude la transazione di sola lettura
+        _indice_impianti = IndiceImpianti(impianti, prezzi)
+        logger.info(f"Indice distributori caricato: {len(impianti)} impianti, {_indice_impianti.numero_prezzi} prezzi indicizzati.")
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"Errore Database durante il caricamento dell'indice distributori: {e}")
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn)
+
+def formatta_distributori_vicini(carburante: str, raggio_km: float, risultati: list) -> str:
+    """Formatta in HTML l'elenco dei distributori più economici."""
+    if not risultati:
+        return f"❓ Nessun distributore con {carburante} entro {raggio_km:g} km dalla posizione inviata."
+    messaggio = f"📍 <b>{carburante} più economico entro {raggio_km:g} km</b>\n"
+    messaggio += "-------------------------------------------------\n"
+    for posizione, (prezzo, distanza, impianto, self_service) in enumerate(risultati, start=1):
+        modalita = "self" if self_service else "servito"
+        nome = html.escape(impianto.bandiera or impianto.nome or impianto.gestore)
+        indirizzo = html.escape(f"{impianto.indirizzo}, {impianto.comune}")
+        mappa = f"https://maps.google.com/?q={impianto.latitudine},{impianto.longitudine}"
+        messaggio += (
+            f"{posizione}. <b>€ {prezzo:.3f}</b> ({modalita}) - {nome}\n"
+            f"    {indirizzo} · {distanza:.1f} km · <a href=\"{mappa}\">mappa</a>\n"
+        )
+    messaggio += "-------------------------------------------------"
+    return messaggio
 
-        # Trova la data più recente per la regione specificata
+
+# --- Avvisi di prezzo e invio delle notifiche ---
+
+def valuta_avvisi(conn, data_aggiornamento: date) -> list:
+    """
+    Confronta in blocco gli avvisi con i prezzi del giorno `data_aggiornamento` (senza commit).
+    Riarma gli avvisi il cui prezzo è tornato sopra soglia e marca come notificati quelli
+    appena scesi sotto, scrivendo i loro messaggi in notifiche_in_uscita nella stessa
+    transazione. Restituisce le notifiche come (chat_id, messaggio, id_notifica).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE avvisi_prezzo a
+            SET notificato = FALSE
+            FROM prezzi_regionali p
+            WHERE a.notificato
+              AND p.regione = a.regione AND p.tipo_carburante = a.tipo_carburante
+              AND p.data_aggiornamento = %s
+              AND p.prezzo_medio >= a.soglia;
+        """, (data_aggiornamento,))
         cur.execute("""
-            SELECT MAX(data_aggiornamento)
-            FROM prezzi_regionali
-            WHERE regione = %s;
-        """, (nome_regione,))
-        result = cur.fetchone()
+            UPDATE avvisi_prezzo a
+            SET notificato = TRUE
+            FROM prezzi_regionali p
+            WHERE NOT a.notificato
+              AND p.regione = a.regione AND p.tipo_carburante = a.tipo_carburante
+              AND p.data_aggiornamento = %s
+              AND p.prezzo_medio < a.soglia
+            RETURNING a.chat_id, a.regione, a.tipo_carburante, a.soglia, p.prezzo_medio;
+        """, (data_aggiornamento,))
+        scattati = cur.fetchall()
+        logger.info(f"Avvisi di prezzo scattati per il {data_aggiornamento}: {len(scattati)}.")
+        if not scattati:
+            return []
+        data_formattata = data_aggiornamento.strftime('%d/%m/%Y')
+        messaggi = [
+            f"🔔 <b>Avviso prezzo</b>\n{tipo} in {regione} è sceso a <b>€ {prezzo:.3f}</b> "
+            f"(soglia € {soglia:.3f}) il {data_formattata}."
+            for _, regione, tipo, soglia, prezzo in scattati
+        ]
+        cur.execute("""
+            INSERT INTO notifiche_in_uscita (chat_id, testo)
+            SELECT * FROM unnest(%s::bigint[], %s::text[])
+            RETURNING chat_id, testo, id;
+        """, ([chat_id for chat_id, *_ in scattati], messaggi))
+        return cur.fetchall()
+
+class DispatcherNotifiche:
+    """
+    Coda di invio dei messaggi verso Telegram che gira sull'event loop del bot.
+    Rispetta un limite globale di messaggi al secondo e un intervallo minimo per chat,
+    gestisce RetryAfter sospendendo tutti gli invii e ritenta gli errori temporanei.
+    Per i messaggi con un id_notifica chiama `conferma(id_notifica)` dopo l'invio o un
+    rifiuto definitivo: quelli falliti per errori temporanei restano da riprovare.
+    """
+
+    def __init__(self, bot, messaggi_al_secondo: float | None = NOTIFICHE_AL_SECONDO,
+                 intervallo_chat: float = NOTIFICHE_INTERVALLO_CHAT, numero_worker: int = 8, max_tentativi: int = 3,
+                 conferma=None):
+        self._bot = bot
+        self._conferma = conferma
+        self._intervallo_globale = 1 / messaggi_al_secondo if messaggi_al_secondo else 0.0
+        self._intervallo_chat = intervallo_chat
+        self._numero_worker = numero_worker
+        self._max_tentativi = max_tentativi
+        self._coda = None
+        self._loop = None
+        self._worker = []
+        self._prossimo_slot = 0.0   # primo istante libero per un invio (limite globale)
+        self._prossimo_per_chat = {} # chat_id -> primo istante libero per quella chat
+        self._in_attesa = 0          # messaggi rimandati con call_later e non ancora in coda
+        self._pendenti = 0           # messaggi accodati e non ancora inviati o scartati
+        self._svuotato = None
+        self._id_in_coda = set()     # id_notifica accodati e non ancora conclusi
+        self._conferme = set()       # task di conferma in corso (riferimenti forti)
+        self.inviati = 0
+        self.falliti = 0
+
+    def avvia(self) -> None:
+        """Avvia i worker sull'event loop corrente."""
+        self._loop = asyncio.get_running_loop()
+        self._coda = asyncio.Queue()
+        self._svuotato = asyncio.Event()
+        self._svuotato.set()
+        self._worker = [asyncio.create_task(self._ciclo()) for _ in range(self._numero_worker)]
+        logger.info(f"Dispatcher notifiche avviato ({self._numero_worker} worker).")
+
+    async def ferma(self) -> None:
+        for worker in self._worker:
+            worker.cancel()
+        await asyncio.gather(*self._worker, return_exceptions=True)
+        self._worker = []
+        await asyncio.gather(*self._conferme, return_exceptions=True)
+
+    def accoda(self, notifiche) -> None:
+        """
+        Accoda una lista di (chat_id, messaggio HTML, id_notifica o None). Da chiamare
+        dall'event loop. Un id_notifica già in coda viene ignorato.
+        """
+        for chat_id, testo, id_notifica in notifiche:
+            if id_notifica is not None:
+                if id_notifica in self._id_in_coda:
+                    continue
+                self._id_in_coda.add(id_notifica)
+            self._coda.put_nowait((chat_id, testo, id_notifica, 1))
+            self._pendenti += 1
+        if self._pendenti:
+            self._svuotato.clear()
+
+    def accoda_da_thread(self, notifiche: list) -> None:
+        """Come accoda, ma utilizzabile da un thread diverso da quello dell'event loop."""
+        if notifiche:
+            self._loop.call_soon_threadsafe(self.accoda, notifiche)
+
+    def in_sospeso(self) -> int:
+        """Messaggi ancora da inviare (in coda, in invio o rimandati)."""
+        return self._pendenti
+
+    async def attendi_svuotamento(self) -> None:
+        """Attende che tutti i messaggi accodati siano stati inviati o scartati."""
+        await self._svuotato.wait()
+
+    def _concludi(self, id_notifica: int | None, inviato: bool, definitivo: bool = True) -> None:
+        if inviato:
+            self.inviati += 1
+        else:
+            self.falliti += 1
+        if id_notifica is not None:
+            self._id_in_coda.discard(id_notifica)
+            if definitivo and self._conferma is not None:
+                conferma = asyncio.create_task(self._conferma(id_notifica))
+                self._conferme.add(conferma)
+                conferma.add_done_callback(self._conferme.discard)
+        self._pendenti -= 1
+        if not self._pendenti:
+            self._prossimo_per_chat.clear() # Nessun invio in corso: i limiti per chat ripartono da zero
+            self._svuotato.set()
+
+    def _rimanda(self, elemento, ritardo: float) -> None:
+        def rimetti_in_coda():
+            self._in_attesa -= 1
+            self._coda.put_nowait(elemento)
+        self._in_attesa += 1
+        self._loop.call_later(ritardo, rimetti_in_coda)
+
+    async def _ciclo(self) -> None:
+        while True:
+            elemento = await self._coda.get()
+            chat_id, testo, id_notifica, tentativo = elemento
+            try:
+                adesso = self._loop.time()
+                # Limite per chat: se la chat ha un invio recente o già prenotato, il suo turno slitta
+                prossimo_chat = self._prossimo_per_chat.get(chat_id, 0.0)
+                if prossimo_chat > adesso:
+                    self._rimanda(elemento, prossimo_chat - adesso)
+                    continue
+
+                # Limite globale: ogni invio prenota il primo slot libero
+                slot = max(adesso, self._prossimo_slot)
+                self._prossimo_slot = slot + self._intervallo_globale
+                self._prossimo_per_chat[chat_id] = slot + self._intervallo_chat
+                if slot > adesso:
+                    await asyncio.sleep(slot - adesso)
 
-        if not result or not result[0]:
+                await self._invia(chat_id, testo, id_notifica, tentativo)
+            finally:
+                self._coda.task_done()
+
+    async def _invia(self, chat_id: int, testo: str, id_notifica: int | None, tentativo: int) -> None:
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=testo, parse_mode='HTML')
+            self._concludi(id_notifica, inviato=True)
+        except RetryAfter as e:
+            attesa = float(e.retry_after)
+            logger.warning(f"Flood control Telegram: invii sospesi per {attesa:.0f}s.")
+            self._prossimo_slot = max(self._prossimo_slot, self._loop.time() + attesa)
+            self._rimanda((chat_id, testo, id_notifica, tentativo), attesa)
+        except (Forbidden, BadRequest) as e:
+            # Bot bloccato dall'utente o chat inesistente: inutile ritentare
+            logger.warning(f"Notifica a {chat_id} scartata: {e}")
+            self._concludi(id_notifica, inviato=False)
+        except TelegramError as e:
+            if tentativo >= self._max_tentativi:
+                # Resta in notifiche_in_uscita: verrà riaccodata al prossimo avvio
+                logger.error(f"Notifica a {chat_id} fallita dopo {tentativo} tentativi: {e}")
+                self._concludi(id_notifica, inviato=False, definitivo=False)
+            else:
+                self._rimanda((chat_id, testo, id_notifica, tentativo + 1), 2 ** tentativo)
+        except Exception as e:
+            logger.error(f"Errore imprevisto inviando una notifica a {chat_id}: {e}")
+            self._concludi(id_notifica, inviato=False, definitivo=False)
+
+_dispatcher_notifiche: DispatcherNotifiche | None = None
+
+
+# --- Accesso asincrono al database (asyncpg) ---
+# Usato dagli handler Telegram, che lo attendono direttamente sull'event loop.
+# L'import (scheduler e /trigger-update) resta sul pool psycopg2 sincrono: gira nel
+# thread del job di GestoreAggiornamenti, quindi non blocca l'event loop, e
+# update_database è l'unico percorso con validazione, staging, partizioni e report.
+
+_async_db_pool: asyncpg.Pool | None = None
+
+async def apri_pool_async() -> None:
+    """Crea il pool asyncpg sull'event loop corrente (da chiamare all'avvio del bot)."""
+    global _async_db_pool
+    if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
+        logger.error("Pool DB asincrono non creato: variabili d'ambiente mancanti.")
+        return
+    try:
+        _async_db_pool = await asyncpg.create_pool(
+            host=DB_HOST,
+            port=int(DB_PORT),
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            max_inactive_connection_lifetime=DB_POOL_IDLE_TIMEOUT,
+            timeout=DB_CONNECT_TIMEOUT,
+        )
+        logger.info(f"Pool DB asincrono creato (min {DB_POOL_MIN}, max {DB_POOL_MAX}).")
+    except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as e:
+        logger.error(f"Creazione del pool DB asincrono fallita: {e!r}")
+        _async_db_pool = None
+
+async def chiudi_pool_async() -> None:
+    """Chiude il pool asyncpg, se aperto."""
+    global _async_db_pool
+    if _async_db_pool is not None:
+        await _async_db_pool.close()
+        _async_db_pool = None
+        logger.info("Pool DB asincrono chiuso.")
+
+async def leggi_notifiche_in_uscita() -> list:
+    """Notifiche degli avvisi non ancora inviate, come (chat_id, messaggio, id_notifica)."""
+    async with _async_db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+        righe = await conn.fetch("SELECT chat_id, testo, id FROM notifiche_in_uscita ORDER BY id;")
+    return [(r["chat_id"], r["testo"], r["id"]) for r in righe]
+
+async def conferma_notifica(id_notifica: int) -> None:
+    """Toglie dall'outbox una notifica inviata (o rifiutata definitivamente da Telegram)."""
+    try:
+        async with _async_db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+            await conn.execute("DELETE FROM notifiche_in_uscita WHERE id = $1;", id_notifica)
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+        # Resta nell'outbox e verrà reinviata al prossimo avvio: meglio un doppione che una perdita
+        logger.error(f"Conferma della notifica {id_notifica} non salvata: {e}")
+
+async def leggi_ultimi_prezzi_regione(nome_regione: str):
+    """
+    Restituisce (data_aggiornamento, {tipo_carburante: prezzo}) con i prezzi più recenti
+    della regione, oppure None se non ci sono dati.
+    """
+    with DURATA_CONNESSIONE_DB.labels(pool="async").time():
+        conn = await _async_db_pool.acquire(timeout=DB_POOL_TIMEOUT)
+    try:
+        with DURATA_QUERY_DB.labels(query="ultimi_prezzi_regione").time():
+            righe = await conn.fetch("""
+                SELECT tipo_carburante, prezzo_medio, data_aggiornamento
+                FROM prezzi_regionali
+                WHERE regione = $1
+                  AND data_aggiornamento = (
+                      SELECT MAX(data_aggiornamento) FROM prezzi_regionali WHERE regione = $1
+                  );
+            """, nome_regione)
+    finally:
+        await _async_db_pool.release(conn)
+    if not righe:
+        return None
+    return righe[0]["data_aggiornamento"], {r["tipo_carburante"]: float(r["prezzo_medio"]) for r in righe}
+
+async def leggi_storico_regione(nome_regione: str, giorni: int, carburante: str | None = None) -> dict:
+    """
+    Serie degli ultimi `giorni` giorni di dati della regione con una sola query di intervallo:
+    {tipo_carburante: ([date], [prezzi])}, vuoto se non ci sono dati.
+    """
+    with DURATA_CONNESSIONE_DB.labels(pool="async").time():
+        conn = await _async_db_pool.acquire(timeout=DB_POOL_TIMEOUT)
+    try:
+        with DURATA_QUERY_DB.labels(query="storico_regione").time():
+            righe = await conn.fetch("""
+                SELECT tipo_carburante, prezzo_medio, data_aggiornamento
+                FROM prezzi_regionali
+                WHERE regione = $1
+                  AND ($3::text IS NULL OR tipo_carburante = $3)
+                  AND data_aggiornamento > (
+                      SELECT MAX(data_aggiornamento) FROM prezzi_regionali WHERE regione = $1
+                  ) - $2::integer
+                ORDER BY data_aggiornamento;
+            """, nome_regione, giorni, carburante)
+    finally:
+        await _async_db_pool.release(conn)
+    serie = {}
+    for carburante_riga in CARBURANTI:
+        punti = [(r["data_aggiornamento"], float(r["prezzo_medio"])) for r in righe if r["tipo_carburante"] == carburante_riga]
+        if punti:
+            serie[carburante_riga] = ([d for d, _ in punti], [p for _, p in punti])
+    return serie
+
+async def salva_avviso(chat_id: int, regione: str, tipo_carburante: str, soglia: float) -> bool:
+    """Crea o aggiorna l'avviso della chat per regione e carburante; False se si supera il limite."""
+    async with _async_db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+        async with conn.transaction():
+            esistenti = await conn.fetchval(
+                "SELECT COUNT(*) FROM avvisi_prezzo WHERE chat_id = $1 AND NOT (regione = $2 AND tipo_carburante = $3);",
+                chat_id, regione, tipo_carburante
+            )
+            if esistenti >= MAX_AVVISI_PER_CHAT:
+                return False
+            await conn.execute("""
+                INSERT INTO avvisi_prezzo (chat_id, regione, tipo_carburante, soglia)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (chat_id, regione, tipo_carburante)
+                DO UPDATE SET soglia = EXCLUDED.soglia, notificato = FALSE;
+            """, chat_id, regione, tipo_carburante, soglia)
+    return True
+
+async def elenca_avvisi(chat_id: int) -> list:
+    """Avvisi della chat come record (id, regione, tipo_carburante, soglia)."""
+    async with _async_db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+        return await conn.fetch(
+            "SELECT id, regione, tipo_carburante, soglia FROM avvisi_prezzo WHERE chat_id = $1 ORDER BY id;",
+            chat_id
+        )
+
+async def rimuovi_avviso(chat_id: int, id_avviso: int) -> bool:
+    """Elimina un avviso della chat; False se non esiste."""
+    async with _async_db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+        esito = await conn.execute("DELETE FROM avvisi_prezzo WHERE chat_id = $1 AND id = $2;", chat_id, id_avviso)
+    return esito != "DELETE 0"
+
+class Sovraccarico(Exception):
+    """Troppe richieste in attesa di accedere ai dati."""
+
+# Limita gli accessi concorrenti ai dati: oltre ACCESSI_DATI_CONCORRENTI si attende in coda,
+# oltre ATTESA_MASSIMA_ACCESSO si rinuncia invece di accumulare richieste
+_limite_accessi_dati = asyncio.Semaphore(ACCESSI_DATI_CONCORRENTI)
+
+_MESSAGGIO_SOVRACCARICO = "⏳ Sto ricevendo molte richieste in questo momento. Riprova tra qualche secondo."
+
+@contextlib.asynccontextmanager
+async def accesso_dati():
+    """Occupa un posto di _limite_accessi_dati per la durata del blocco, o solleva Sovraccarico."""
+    try:
+        await asyncio.wait_for(_limite_accessi_dati.acquire(), timeout=ATTESA_MASSIMA_ACCESSO)
+    except asyncio.TimeoutError:
+        RICHIESTE_LIMITATE.labels(motivo="sovraccarico").inc()
+        raise Sovraccarico() from None
+    try:
+        yield
+    finally:
+        _limite_accessi_dati.release()
+
+class LimitatoreChat:
+    """
+    Token bucket per chat: `raffica` richieste di fila, poi `al_minuto` al minuto.
+    Segnala di avvisare l'utente solo alla prima richiesta respinta di ogni raffica.
+    """
+
+    def __init__(self, raffica: int, al_minuto: float):
+        self._capacita = raffica
+        self._ricarica = al_minuto / 60 # gettoni al secondo
+        self._secchielli = {} # chat_id -> [gettoni, istante, già avvisato]
+
+    def consenti(self, chat_id: int):
+        """Restituisce (consentita, avvisa, secondi_di_attesa)."""
+        adesso = time.monotonic()
+        secchiello = self._secchielli.get(chat_id)
+        if secchiello is None:
+            if len(self._secchielli) > 10_000:
+                self._pulisci(adesso)
+            secchiello = self._secchielli[chat_id] = [float(self._capacita), adesso, False]
+        else:
+            secchiello[0] = min(self._capacita, secchiello[0] + (adesso - secchiello[1]) * self._ricarica)
+            secchiello[1] = adesso
+        if secchiello[0] >= 1:
+            secchiello[0] -= 1
+            secchiello[2] = False
+            return True, False, 0.0
+        avvisa = not secchiello[2]
+        secchiello[2] = True
+        return False, avvisa, (1 - secchiello[0]) / self._ricarica
+
+    def _pulisci(self, adesso: float) -> None:
+        """Dimentica le chat il cui secchiello sarebbe di nuovo pieno."""
+        pieno_dopo = self._capacita / self._ricarica
+        for chat_id in [c for c, (_, istante, _) in self._secchielli.items() if adesso - istante > pieno_dopo]:
+            del self._secchielli[chat_id]
+
+limitatore_chat = LimitatoreChat(RICHIESTE_PER_CHAT_RAFFICA, RICHIESTE_PER_CHAT_AL_MINUTO)
+
+def limita_per_chat(handler):
+    """Applica limitatore_chat all'handler; alla prima richiesta respinta risponde con un avviso."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if chat is not None:
+            consentita, avvisa, attesa = limitatore_chat.consenti(chat.id)
+            if not consentita:
+                RICHIESTE_LIMITATE.labels(motivo="chat").inc()
+                if avvisa and update.message:
+                    await update.message.reply_text(
+                        f"⏳ Stai inviando molte richieste: riprova tra {math.ceil(attesa)} secondi."
+                    )
+                return None
+        return await handler(update, context)
+    return wrapper
+
+_letture_regione_in_corso: dict = {} # regione -> Task della lettura dal DB già avviata
+
+@misura_durata(DURATA_LETTURA_PREZZI)
+async def get_prezzi_regione_dal_db(nome_regione: str) -> str:
+    """Recupera i prezzi più recenti per una regione (snapshot o DB) e formatta la risposta."""
+    logger.info(f"Richiesta prezzi per regione: {nome_regione}")
+
+    # Se lo snapshot è popolato rispondiamo con il messaggio già formattato, senza toccare il DB
+    snapshot = ottieni_snapshot()
+    if not snapshot.vuoto():
+        messaggio = snapshot.messaggio(nome_regione)
+        if messaggio is not None:
+            statistiche_cache_messaggi.registra(hit=True)
+            return messaggio
+    statistiche_cache_messaggi.registra(hit=False)
+
+    if _async_db_pool is None:
+        return "❌ Errore: Impossibile connettersi al database al momento."
+
+    # Richieste concorrenti per la stessa regione condividono una sola lettura dal DB
+    lettura = _letture_regione_in_corso.get(nome_regione)
+    if lettura is None:
+        lettura = asyncio.create_task(_leggi_prezzi_regione_limitato(nome_regione))
+        _letture_regione_in_corso[nome_regione] = lettura
+        lettura.add_done_callback(lambda _: _letture_regione_in_corso.pop(nome_regione, None))
+    else:
+        RICHIESTE_CONDIVISE.inc()
+    # shield: se chi attende viene cancellato, la lettura prosegue per gli altri
+    return await asyncio.shield(lettura)
+
+async def _leggi_prezzi_regione_limitato(nome_regione: str) -> str:
+    """Lettura dal DB dietro il limite globale di accessi, già formattata come risposta."""
+    try:
+        async with accesso_dati():
+            risultato = await leggi_ultimi_prezzi_regione(nome_regione)
+        if risultato is None:
             logger.warning(f"Nessun dato trovato nel DB per la regione: {nome_regione}")
             return f"❓ Mi dispiace, non ho ancora dati disponibili per la regione '{nome_regione}'."
 
-        data_recente = result[0]
-        data_formattata = data_recente.strftime('%d/%m/%Y')
-
-        # Recupera tutti i prezzi per quella regione e quella data
-        cur.execute("""
-            SELECT tipo_carburante, prezzo_medio
-            FROM prezzi_regionali
-            WHERE regione = %s AND data_aggiornamento = %s
-            ORDER BY CASE tipo_carburante  -- Ordine personalizzato
-                     WHEN 'Benzina' THEN 1
-                     WHEN 'Gasolio' THEN 2
-                     WHEN 'GPL'     THEN 3
-                     WHEN 'Metano'  THEN 4
-                     ELSE 5
-                   END;
-        """, (nome_regione, data_recente))
-        prezzi = cur.fetchall()
-
-        if not prezzi:
-             logger.error(f"DB Inconsistency: Data trovata ({data_recente}) ma nessun prezzo per regione: {nome_regione}")
-             return f"⚠️ Errore interno nel recuperare i prezzi per '{nome_regione}' del {data_formattata}."
-
-        # Formattazione dell'output usando HTML
-        messaggio = f"⛽ <b>Prezzi Medi - {nome_regione}</b> ({data_formattata}) ⛽\n"
-        messaggio += "-------------------------------------------------\n"
-
-        prezzi_dict = {'Benzina': 'N.D.', 'Gasolio': 'N.D.', 'GPL': 'N.D.', 'Metano': 'N.D.'}
-        for tipo, prezzo in prezzi:
-            if tipo in prezzi_dict:
-               prezzi_dict[tipo] = f"€ {prezzo:.3f}" # Formatta a 3 decimali
-
-        messaggio += f"🟢 <b>Benzina:</b> {prezzi_dict['Benzina']}\n"
-        messaggio += f"⚫ <b>Gasolio:</b> {prezzi_dict['Gasolio']}\n"
-        messaggio += f"🔵 <b>GPL:</b>      {prezzi_dict['GPL']}\n"
-        messaggio += f"⚪ <b>Metano:</b>   {prezzi_dict['Metano']}\n"
-        messaggio += "-------------------------------------------------"
+        data_recente, prezzi_dict = risultato
+        messaggio = formatta_messaggio_prezzi(nome_regione, data_recente, prezzi_dict)
 
         logger.info(f"Prezzi trovati e formattati per {nome_regione}: {prezzi_dict}")
         return messaggio
 
-    except psycopg2.Error as e:
+    except Sovraccarico:
+        logger.warning(f"Lettura per {nome_regione} rinunciata: troppe richieste in attesa.")
+        return _MESSAGGIO_SOVRACCARICO
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
         logger.error(f"Errore Database durante la lettura per {nome_regione}: {e}")
         return f"❌ Si è verificato un errore nel recuperare i dati per {nome_regione}. Riprova più tardi."
     except Exception as e:
          logger.error(f"Errore imprevisto durante la lettura per {nome_regione}: {e}")
          return "❌ Si è verificato un errore generico. Riprova più tardi."
-    finally:
-        if cur: cur.close()
-        if conn and not conn.closed: conn.close()
-        # logger.debug(f"Connessione DB chiusa per richiesta {nome_regione}.")
 
 # --- Definizione dei Gestori di Comandi/Messaggi Telegram ---
 
+# Elenco delle regioni per /start, formattato una sola volta (REGIONI_VALIDATE è costante)
+_TESTO_START = (
+    "Sono il bot per i prezzi medi regionali dei carburanti (Benzina, Gasolio, GPL, Metano).\n\n"
+    "Per ottenere i prezzi di una regione, invia il comando corrispondente.\n\n"
+    "<b>Regioni disponibili:</b>\n"
+    + ", ".join(f"<code>/{r}</code>" for r in REGIONI_VALIDATE) + "\n\n"
+    "Esempio: invia <code>/Lombardia</code> per vedere i prezzi in Lombardia.\n\n"
+    "📍 Inviami la tua <b>posizione</b> per i distributori più economici vicino a te "
+    "(scegli il carburante con <code>/carburante Gasolio</code>).\n\n"
+    "🏆 Classifica nazionale: <code>/classifica Gasolio</code>. "
+    "Confronto tra due regioni: <code>/confronta Lombardia Lazio</code>. "
+    "Andamento nel tempo: <code>/storico Lombardia</code>.\n\n"
+    "💬 In qualsiasi chat scrivi il mio username seguito da una regione (es. <code>Lomb</code>) "
+    "per condividerne i prezzi.\n\n"
+    "🔔 Ricevi un avviso quando un prezzo scende sotto una soglia: "
+    "<code>/avviso Lombardia Gasolio 1,70</code> (elenco con /avvisi)."
+)
+
+_REGIONI_PER_NOME = {regione.lower(): regione for regione in REGIONI_VALIDATE}
+
+def normalizza_regione(testo: str) -> str:
+    """Normalizza il nome di regione scritto dall'utente per confrontarlo con REGIONI_VALIDATE."""
+    # Normalizzazione più robusta per matchare REGIONI_VALIDATE
+    nome_regione_normalizzato = ' '.join(word.capitalize() for word in testo.replace("'", "' ").split())
+    nome_regione_normalizzato = nome_regione_normalizzato.replace("' ", "'")
+    if "Valle D'aosta" in nome_regione_normalizzato: nome_regione_normalizzato = "Valle d'Aosta"
+    if "Emilia Romagna" in nome_regione_normalizzato: nome_regione_normalizzato = "Emilia Romagna"
+    if "Friuli Venezia Giulia" in nome_regione_normalizzato: nome_regione_normalizzato = "Friuli Venezia Giulia"
+    return _REGIONI_PER_NOME.get(nome_regione_normalizzato.lower(), nome_regione_normalizzato)
+
+@misura_durata(DURATA_HANDLER.labels(comando="start"))
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Invia un messaggio di benvenuto aggiornato."""
     user = update.effective_user
-    elenco_regioni = ", ".join(f"<code>/{r}</code>" for r in REGIONI_VALIDATE)
-    welcome_message = (
-        f"Ciao {user.mention_html()}!\n\n"
-        "Sono il bot per i prezzi medi regionali dei carburanti (Benzina, Gasolio, GPL, Metano).\n\n"
-        "Per ottenere i prezzi di una regione, invia il comando corrispondente.\n\n"
-        "<b>Regioni disponibili:</b>\n"
-        f"{elenco_regioni}\n\n"
-        "Esempio: invia <code>/Lombardia</code> per vedere i prezzi in Lombardia."
-    )
+    welcome_message = f"Ciao {user.mention_html()}!\n\n" + _TESTO_START
     await update.message.reply_html(welcome_message, disable_web_page_preview=True)
 
 
+@misura_durata(DURATA_HANDLER.labels(comando="regione"))
+@limita_per_chat
 async def regione_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Gestisce i comandi /Regione per richiedere i prezzi."""
     if not update.message or not update.message.text:
@@ -369,25 +2651,34 @@ async def regione_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Estrai il nome della regione (rimuovi '/' iniziale) e normalizza
     nome_regione_input = command_text[1:].strip()
-
-    # Normalizzazione più robusta per matchare REGIONI_VALIDATE
-    nome_regione_normalizzato = ' '.join(word.capitalize() for word in nome_regione_input.replace("'", "' ").split())
-    nome_regione_normalizzato = nome_regione_normalizzato.replace("' ", "'")
-    if "Valle D'aosta" in nome_regione_normalizzato: nome_regione_normalizzato = "Valle d'Aosta"
-    if "Emilia Romagna" in nome_regione_normalizzato: nome_regione_normalizzato = "Emilia Romagna"
-    if "Friuli Venezia Giulia" in nome_regione_normalizzato: nome_regione_normalizzato = "Friuli Venezia Giulia"
+    nome_regione_normalizzato = normalizza_regione(nome_regione_input)
 
     logger.info(f"Comando ricevuto: {command_text}. Regione estratta/normalizzata: {nome_regione_normalizzato}")
 
     # Controlla se la regione normalizzata è nella lista delle regioni valide
     if nome_regione_normalizzato in REGIONI_VALIDATE:
+        # Messaggio già pronto nello snapshot: una sola chiamata alla Bot API, senza task né attese
+        inizio = time.perf_counter()
+        messaggio_prezzi = ottieni_snapshot().messaggio(nome_regione_normalizzato)
+        if messaggio_prezzi is not None:
+            DURATA_LETTURA_PREZZI.observe(time.perf_counter() - inizio)
+            statistiche_cache_messaggi.registra(hit=True)
+            await update.message.reply_html(messaggio_prezzi)
+            logger.info(f"Risposta inviata (diretta) per {nome_regione_normalizzato}")
+            return
+
+        # Query asincrona: se la risposta arriva entro ATTESA_SENZA_SEGNAPOSTO la inviamo
+        # direttamente, altrimenti mostriamo "Sto cercando..." e poi lo modifichiamo
+        lettura = asyncio.ensure_future(get_prezzi_regione_dal_db(nome_regione_normalizzato))
+        fatti, _ = await asyncio.wait({lettura}, timeout=ATTESA_SENZA_SEGNAPOSTO)
+        if fatti:
+            await update.message.reply_html(lettura.result())
+            logger.info(f"Risposta inviata (diretta) per {nome_regione_normalizzato}")
+            return
+
         # Mostra "Sto cercando..."
         thinking_message = await update.message.reply_text("🔍 Sto cercando i dati...", disable_notification=True)
-
-        # Esegui la funzione DB in modo sicuro per asyncio
-        messaggio_prezzi = await asyncio.to_thread(
-            get_prezzi_regione_dal_db, nome_regione_normalizzato
-        )
+        messaggio_prezzi = await lettura
 
         # Modifica il messaggio "Sto cercando..." con la risposta finale
         try:
@@ -411,6 +2702,270 @@ async def regione_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             parse_mode='HTML'
         )
 
+@misura_durata(DURATA_HANDLER.labels(comando="carburante"))
+async def carburante_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Imposta il carburante usato nelle ricerche per posizione (/carburante <tipo>)."""
+    richiesto = " ".join(context.args).strip() if context.args else ""
+    carburante = categoria_carburante(richiesto) if richiesto else None
+    if carburante is None:
+        attuale = context.user_data.get("carburante", CARBURANTI[0])
+        await update.message.reply_html(
+            f"Carburante attuale: <b>{attuale}</b>.\n"
+            f"Per cambiarlo usa <code>/carburante &lt;tipo&gt;</code> con uno tra: {', '.join(CARBURANTI)}."
+        )
+        return
+    context.user_data["carburante"] = carburante
+    await update.message.reply_html(f"✅ Carburante impostato: <b>{carburante}</b>. Ora inviami la tua posizione.")
+
+@misura_durata(DURATA_HANDLER.labels(comando="posizione"))
+@limita_per_chat
+async def posizione_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Risponde a una posizione con i distributori più economici nel raggio di ricerca."""
+    posizione = update.message.location
+    carburante = context.user_data.get("carburante", CARBURANTI[0])
+    indice = ottieni_indice_impianti()
+    if indice.vuoto():
+        await update.message.reply_text("⚠️ I prezzi dei distributori non sono ancora disponibili. Riprova più tardi.")
+        return
+
+    inizio = time.perf_counter()
+    risultati = indice.cerca(posizione.latitude, posizione.longitude, carburante, RAGGIO_RICERCA_KM, NUMERO_DISTRIBUTORI)
+    logger.info(f"Ricerca distributori ({carburante}) completata in {(time.perf_counter() - inizio) * 1000:.2f} ms: {len(risultati)} risultati.")
+    await update.message.reply_html(
+        formatta_distributori_vicini(carburante, RAGGIO_RICERCA_KM, risultati),
+        disable_web_page_preview=True
+    )
+
+def dividi_due_regioni(parole: list):
+    """Divide le parole in due nomi di regione validi (anche composti), o None se non possibile."""
+    for taglio in range(1, len(parole)):
+        regione_a = normalizza_regione(" ".join(parole[:taglio]))
+        regione_b = normalizza_regione(" ".join(parole[taglio:]))
+        if regione_a in REGIONI_VALIDATE and regione_b in REGIONI_VALIDATE:
+            return regione_a, regione_b
+    return None
+
+@misura_durata(DURATA_HANDLER.labels(comando="classifica"))
+@limita_per_chat
+async def classifica_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Classifica nazionale delle regioni per un carburante: /classifica <carburante>."""
+    carburante = categoria_carburante(" ".join(context.args)) if context.args else None
+    if carburante is None:
+        await update.message.reply_html(
+            f"Uso: <code>/classifica &lt;carburante&gt;</code> con uno tra: {', '.join(CARBURANTI)}."
+        )
+        return
+    matrice = ottieni_matrice_prezzi()
+    if matrice.vuoto():
+        await update.message.reply_text("⚠️ I prezzi regionali non sono ancora disponibili. Riprova più tardi.")
+        return
+    await update.message.reply_html(matrice.classifiche[carburante])
+
+@misura_durata(DURATA_HANDLER.labels(comando="confronta"))
+@limita_per_chat
+async def confronta_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Confronta i prezzi di due regioni: /confronta <RegioneA> <RegioneB>."""
+    regioni = dividi_due_regioni(context.args or [])
+    if regioni is None:
+        await update.message.reply_html(
+            "Uso: <code>/confronta &lt;RegioneA&gt; &lt;RegioneB&gt;</code>\n"
+            "Esempio: <code>/confronta Emilia Romagna Lazio</code>. Digita /start per l'elenco delle regioni."
+        )
+        return
+    matrice = ottieni_matrice_prezzi()
+    if matrice.vuoto():
+        await update.message.reply_text("⚠️ I prezzi regionali non sono ancora disponibili. Riprova più tardi.")
+        return
+    await update.message.reply_html(formatta_confronto(matrice, *regioni))
+
+@misura_durata(DURATA_HANDLER.labels(comando="inline"))
+async def inline_query_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Risponde alle query inline (@bot Lomb) con i risultati già pronti nello snapshot.
+    Arrivano a ogni tasto premuto: non si accede mai al DB.
+    """
+    snapshot = ottieni_snapshot()
+    risultati = snapshot.risultati_inline(update.inline_query.query)
+    # Finché non ci sono dati la cache di Telegram resta breve, per non fissare una risposta vuota
+    await update.inline_query.answer(risultati, cache_time=INLINE_CACHE_SECONDI if not snapshot.vuoto() else 10)
+
+_USO_STORICO = (
+    "Uso: <code>/storico &lt;Regione&gt; [giorni] [carburante]</code>\n"
+    f"Esempio: <code>/storico Lombardia 14 Gasolio</code> (al massimo {RETENTION_GIORNI} giorni)."
+)
+
+def analizza_argomenti_storico(parole: list):
+    """Da [regione..., giorni?, carburante?] (in qualunque ordine in coda) a (regione, giorni, carburante)."""
+    parole = list(parole)
+    giorni, carburante = RETENTION_GIORNI, None
+    while parole:
+        if parole[-1].isdigit():
+            giorni = int(parole.pop())
+        elif categoria_carburante(parole[-1]):
+            carburante = categoria_carburante(parole.pop())
+        else:
+            break
+    return normalizza_regione(" ".join(parole)), max(2, min(giorni, RETENTION_GIORNI)), carburante
+
+async def invia_grafico(update: Update, chiave: tuple, png: bytes | None, didascalia: str) -> bool:
+    """
+    Invia il grafico riusando il file_id di Telegram se già caricato in precedenza.
+    Senza `png` lo cerca in cache e restituisce False se non c'è.
+    """
+    file_id = cache_grafici.file_id(chiave)
+    if file_id is not None:
+        try:
+            await update.message.reply_photo(photo=file_id, caption=didascalia)
+            RICHIESTE_GRAFICI.labels(origine="file_id").inc()
+            return True
+        except BadRequest as e:
+            logger.warning(f"file_id del grafico non più valido ({e}): nuovo caricamento.")
+            cache_grafici.registra_file_id(chiave, None)
+    if png is None:
+        png, origine = await asyncio.to_thread(cache_grafici.leggi, chiave)
+        if png is None:
+            return False
+    else:
+        origine = "disegnato"
+    RICHIESTE_GRAFICI.labels(origine=origine).inc()
+    messaggio = await update.message.reply_photo(photo=png, caption=didascalia)
+    if messaggio and messaggio.photo:
+        cache_grafici.registra_file_id(chiave, messaggio.photo[-1].file_id)
+    return True
+
+@misura_durata(DURATA_HANDLER.labels(comando="storico"))
+@limita_per_chat
+async def storico_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Andamento dei prezzi di una regione come grafico PNG: /storico <Regione> [giorni] [carburante]."""
+    regione, giorni, carburante = analizza_argomenti_storico(context.args or [])
+    if regione not in REGIONI_VALIDATE:
+        await update.message.reply_html(_USO_STORICO)
+        return
+    didascalia = f"Prezzi medi {regione}, ultimi {giorni} giorni" + (f" ({carburante})" if carburante else "")
+
+    # Con la data dei dati già nello snapshot la risposta può arrivare dalla cache senza toccare il DB
+    data_regione = ottieni_snapshot().date_regioni.get(regione)
+    if data_regione is not None and await invia_grafico(update, (regione, carburante, giorni, data_regione), None, didascalia):
+        return
+
+    if _async_db_pool is None:
+        await update.message.reply_text("⚠️ Errore: Impossibile connettersi al database al momento.")
+        return
+    try:
+        async with accesso_dati():
+            serie = await leggi_storico_regione(regione, giorni, carburante)
+    except Sovraccarico:
+        await update.message.reply_text(_MESSAGGIO_SOVRACCARICO)
+        return
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+        logger.error(f"Errore nella lettura dello storico di {regione}: {e}")
+        await update.message.reply_text("⚠️ Errore durante il recupero dello storico. Riprova più tardi.")
+        return
+    if not serie:
+        await update.message.reply_text(f"❓ Mi dispiace, non ho ancora dati disponibili per la regione '{regione}'.")
+        return
+
+    chiave = (regione, carburante, giorni, max(date_serie[-1] for date_serie, _ in serie.values()))
+    if await invia_grafico(update, chiave, None, didascalia):
+        return
+    try:
+        png = await genera_grafico_storico(chiave, regione, serie, giorni)
+    except Exception as e: # BrokenProcessPool o errore di matplotlib nel processo figlio
+        logger.error(f"Errore nel disegno del grafico di {regione}: {e!r}")
+        await update.message.reply_text("⚠️ Non sono riuscito a disegnare il grafico. Riprova più tardi.")
+        return
+    await invia_grafico(update, chiave, png, didascalia)
+
+_USO_AVVISO = (
+    "Uso: <code>/avviso &lt;Regione&gt; &lt;Carburante&gt; &lt;soglia&gt;</code>\n"
+    "Esempio: <code>/avviso Lombardia Gasolio 1,70</code>"
+)
+
+@misura_durata(DURATA_HANDLER.labels(comando="avviso"))
+@limita_per_chat
+async def avviso_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Registra un avviso di prezzo: /avviso <Regione> <Carburante> <soglia>."""
+    if len(context.args) < 3:
+        await update.message.reply_html(_USO_AVVISO)
+        return
+    *parole_regione, testo_carburante, testo_soglia = context.args
+    regione = normalizza_regione(" ".join(parole_regione))
+    carburante = categoria_carburante(testo_carburante)
+    try:
+        soglia = float(testo_soglia.replace(",", "."))
+    except ValueError:
+        soglia = 0.0
+    if regione not in REGIONI_VALIDATE or carburante is None or not 0 < soglia < 10:
+        await update.message.reply_html(f"⚠️ Avviso non valido.\n{_USO_AVVISO}")
+        return
+    if _async_db_pool is None:
+        await update.message.reply_text("❌ Errore: Impossibile connettersi al database al momento.")
+        return
+
+    try:
+        async with accesso_dati():
+            salvato = await salva_avviso(update.effective_chat.id, regione, carburante, soglia)
+    except Sovraccarico:
+        await update.message.reply_text(_MESSAGGIO_SOVRACCARICO)
+        return
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+        logger.error(f"Errore Database durante il salvataggio di un avviso: {e}")
+        await update.message.reply_text("❌ Non sono riuscito a salvare l'avviso. Riprova più tardi.")
+        return
+    if not salvato:
+        await update.message.reply_text(f"⚠️ Hai già {MAX_AVVISI_PER_CHAT} avvisi: rimuovine uno con /rimuovi_avviso.")
+        return
+    await update.message.reply_html(
+        f"🔔 Avviso salvato: ti scriverò quando <b>{carburante}</b> in <b>{regione}</b> scende sotto € {soglia:.3f}."
+    )
+
+@misura_durata(DURATA_HANDLER.labels(comando="avvisi"))
+@limita_per_chat
+async def avvisi_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Elenca gli avvisi della chat."""
+    if _async_db_pool is None:
+        await update.message.reply_text("❌ Errore: Impossibile connettersi al database al momento.")
+        return
+    try:
+        async with accesso_dati():
+            avvisi = await elenca_avvisi(update.effective_chat.id)
+    except Sovraccarico:
+        await update.message.reply_text(_MESSAGGIO_SOVRACCARICO)
+        return
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+        logger.error(f"Errore Database durante la lettura degli avvisi: {e}")
+        await update.message.reply_text("❌ Non sono riuscito a leggere i tuoi avvisi. Riprova più tardi.")
+        return
+    if not avvisi:
+        await update.message.reply_html(f"Non hai avvisi attivi.\n{_USO_AVVISO}")
+        return
+    righe = [f"<code>{a['id']}</code> - {a['tipo_carburante']} in {a['regione']} sotto € {a['soglia']:.3f}" for a in avvisi]
+    await update.message.reply_html(
+        "🔔 <b>I tuoi avvisi</b>\n" + "\n".join(righe) + "\n\nPer rimuoverne uno: <code>/rimuovi_avviso &lt;numero&gt;</code>"
+    )
+
+@misura_durata(DURATA_HANDLER.labels(comando="rimuovi_avviso"))
+@limita_per_chat
+async def rimuovi_avviso_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Rimuove un avviso della chat: /rimuovi_avviso <numero>."""
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_html("Uso: <code>/rimuovi_avviso &lt;numero&gt;</code> (vedi /avvisi)")
+        return
+    if _async_db_pool is None:
+        await update.message.reply_text("❌ Errore: Impossibile connettersi al database al momento.")
+        return
+    try:
+        async with accesso_dati():
+            rimosso = await rimuovi_avviso(update.effective_chat.id, int(context.args[0]))
+    except Sovraccarico:
+        await update.message.reply_text(_MESSAGGIO_SOVRACCARICO)
+        return
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+        logger.error(f"Errore Database durante la rimozione di un avviso: {e}")
+        await update.message.reply_text("❌ Non sono riuscito a rimuovere l'avviso. Riprova più tardi.")
+        return
+    await update.message.reply_text("✅ Avviso rimosso." if rimosso else "⚠️ Nessun avviso con questo numero.")
+
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Risponde a comandi Telegram non gestiti esplicitamente."""
     await update.message.reply_text("Comando non riconosciuto. Digita /start per vedere i comandi disponibili.")
@@ -420,10 +2975,121 @@ async def unknown_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text("Non capisco questo messaggio. Digita /start per vedere cosa posso fare.")
 
 
+# --- Ciclo di vita dell'Application ---
+
+async def post_init(application: Application) -> None:
+    """Risorse asincrone da preparare prima di ricevere update (senza toccare il DB)."""
+    global _dispatcher_notifiche
+    _dispatcher_notifiche = DispatcherNotifiche(application.bot, conferma=conferma_notifica)
+    _dispatcher_notifiche.avvia()
+    avvia_pool_grafici()
+
+def prepara_database() -> None:
+    """Pool sincrono, migrazioni, indice dei distributori, snapshot e matrice dal DB."""
+    if all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
+        logger.info(f"Inizializzazione pool DB (min {DB_POOL_MIN}, max {DB_POOL_MAX})...")
+        try:
+            _ottieni_pool().preriscalda()
+        except Exception as e:
+            logger.error(f"Preriscaldamento del pool DB fallito: {e}")
+
+    # --- Schema (migrazioni) e indice dei distributori ---
+    applica_migrazioni()
+    carica_indice_impianti()
+
+    # --- Caricamento iniziale dello snapshot prezzi ---
+    logger.info("Caricamento iniziale dello snapshot prezzi dal database...")
+    if not aggiorna_snapshot_prezzi():
+        if ottieni_snapshot().vuoto():
+            logger.warning("Snapshot iniziale non disponibile: le richieste useranno il DB finché non verrà caricato.")
+        else:
+            logger.warning("DB non raggiungibile: si servono i prezzi dello snapshot locale, segnalati come non aggiornati.")
+    aggiorna_matrice_prezzi()
+
+async def avvia_database() -> None:
+    """
+    Prepara il DB mentre il bot è già in ascolto: con il DB lento o irraggiungibile
+    le richieste vengono servite dallo snapshot locale invece di attendere l'avvio.
+    """
+    await asyncio.to_thread(prepara_database)
+    await apri_pool_async()
+    if _async_db_pool is not None and _dispatcher_notifiche is not None:
+        # Notifiche rimaste da un'esecuzione precedente (riavvio, deploy, invii falliti)
+        try:
+            rimaste = await leggi_notifiche_in_uscita()
+            if rimaste:
+                logger.info(f"Riaccodate {len(rimaste)} notifiche non ancora inviate.")
+                _dispatcher_notifiche.accoda(rimaste)
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+            logger.error(f"Lettura delle notifiche da inviare fallita: {e}")
+    logger.info("Avvio del database completato.")
+
+async def post_shutdown(application: Application) -> None:
+    """Rilascia le risorse create in post_init."""
+    global _dispatcher_notifiche
+    if _dispatcher_notifiche is not None:
+        await _dispatcher_notifiche.ferma()
+        _dispatcher_notifiche = None
+    ferma_pool_grafici()
+    await chiudi_pool_async()
+
+async def esegui_bot(application: Application) -> None:
+    """
+    Esegue bot e server HTTP sullo stesso event loop fino a SIGINT/SIGTERM.
+    Gli update arrivano via webhook se WEBHOOK_URL è impostato, altrimenti con il polling.
+    """
+    porta = int(os.environ.get('PORT', 8080))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for segnale in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(segnale, stop.set)
+
+    await application.initialize()
+    await post_init(application)
+    runner = web.AppRunner(crea_app_web(application))
+    avvio_database = None
+    try:
+        # Il server HTTP deve già ascoltare quando Telegram riceve l'URL del webhook
+        await runner.setup()
+        await web.TCPSite(runner, host='0.0.0.0', port=porta).start()
+        logger.info(f"Server HTTP avviato su host 0.0.0.0 porta {porta}.")
+
+        if WEBHOOK_URL:
+            url_webhook = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+            logger.info(f"Avvio del bot Telegram in modalità webhook su {url_webhook}...")
+            await application.bot.set_webhook(
+                url=url_webhook,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=min(100, CONCORRENZA_UPDATE),
+            )
+        else:
+            logger.info("Avvio del bot Telegram in modalità polling...")
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await application.start()
+
+        # Bot e server HTTP rispondono già (dallo snapshot locale): il DB si prepara in background
+        avvio_database = asyncio.create_task(avvia_database())
+
+        await stop.wait()
+        logger.info("Segnale di arresto ricevuto, chiusura in corso...")
+    finally:
+        if avvio_database is not None and not avvio_database.done():
+            avvio_database.cancel()
+            await asyncio.gather(avvio_database, return_exceptions=True)
+        await runner.cleanup()
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+
 # --- Funzione Principale del Bot ---
 
 def main() -> None:
-    """Avvia il bot Telegram e il server Flask."""
+    """Avvia il bot Telegram e il server HTTP."""
 
     # Verifica iniziale variabili essenziali
     if not TELEGRAM_BOT_TOKEN:
@@ -432,32 +3098,45 @@ def main() -> None:
     if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
         logger.warning("Avvio con variabili DB mancanti. Le funzioni database non opereranno.")
 
+    # --- Snapshot locale: prezzi disponibili subito, anche se il DB non risponde ---
+    carica_snapshot_da_file()
+
     # --- Configurazione Scheduler ---
     logger.info("Configurazione dello scheduler APScheduler per aggiornamento giornaliero...")
     scheduler = BackgroundScheduler()
     trigger = CronTrigger(hour=8, minute=45, timezone=pytz.timezone("Europe/Rome"))
-    scheduler.add_job(update_database, trigger)
+    scheduler.add_job(gestore_aggiornamenti.esegui, trigger, args=["scheduler"])
+    scheduler.add_job(riprova_snapshot_obsoleto, "interval", minutes=SNAPSHOT_RIPROVA_MINUTI)
     scheduler.start()
-    logger.info("Scheduler avviato per eseguire update_database() ogni giorno alle 8:45 Europe/Rome.")
-
-    # --- Avvio Flask Server in un Thread Separato ---
-    flask_port = int(os.environ.get('PORT', 8080))
-    logger.info(f"Avvio del server Flask su host 0.0.0.0 porta {flask_port}...")
-    flask_thread = threading.Thread(
-        target=lambda: flask_app.run(host='0.0.0.0', port=flask_port, debug=False, use_reloader=False),
-        daemon=True # Il thread termina quando il main termina
-    )
-    flask_thread.start()
-    logger.info("Thread Flask avviato.")
+    logger.info("Scheduler avviato per eseguire l'aggiornamento ogni giorno alle 8:45 Europe/Rome.")
 
     # --- Avvio Bot Telegram ---
     logger.info("Creazione dell'istanza Application Telegram...")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(CONCORRENZA_UPDATE) # Gli update vengono gestiti in parallelo
+        .build()
+    )
     logger.info("Application Telegram creata.")
 
     # Registra i gestori Telegram
     application.add_handler(CommandHandler("start", start_command))
     logger.info("Handler per /start registrato.")
+    application.add_handler(CommandHandler("carburante", carburante_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(MessageHandler(filters.LOCATION & filters.UpdateType.MESSAGE & filters.ChatType.PRIVATE, posizione_command))
+    logger.info("Handler per /carburante e per le posizioni registrati.")
+    application.add_handler(CommandHandler("avviso", avviso_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("avvisi", avvisi_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("rimuovi_avviso", rimuovi_avviso_command, filters=filters.ChatType.PRIVATE))
+    logger.info("Handler per gli avvisi di prezzo registrati.")
+    application.add_handler(CommandHandler("classifica", classifica_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("confronta", confronta_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("storico", storico_command, filters=filters.ChatType.PRIVATE))
+    logger.info("Handler per /classifica, /confronta e /storico registrati.")
+    # Richiede la modalità inline attiva per il bot (/setinline su BotFather)
+    application.add_handler(InlineQueryHandler(inline_query_command))
+    logger.info("Handler per le query inline registrato.")
 
     # Gestore per i comandi /Regione (cattura tutti i comandi)
     application.add_handler(MessageHandler(filters.COMMAND & filters.ChatType.PRIVATE, regione_command))
@@ -467,16 +3146,19 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, unknown_message))
     logger.info("Handler per messaggi di testo generici registrato.")
 
-    # Avvia il polling del bot Telegram (blocca il thread principale)
-    logger.info("Avvio del bot Telegram in modalità polling...")
+    # Avvia bot e server HTTP (blocca il thread principale fino all'arresto)
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        asyncio.run(esegui_bot(application))
     except Exception as e:
         logger.critical(f"Errore critico durante l'esecuzione del bot: {e}", exc_info=True)
     finally:
-        logger.info("Bot Telegram polling terminato.")
+        logger.info("Bot Telegram terminato.")
         scheduler.shutdown() # Ferma lo scheduler quando il bot termina
+        if _db_pool is not None:
+            _db_pool.chiudi_tutte()
 
-# Esegui main() se lo script è lanciato direttamente
+# Esegui main() se lo script è lanciato direttamente; `python bot.py backfill <cartella>` importa un archivio
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        sys.exit(backfill_cli(sys.argv[2:]))
     main()
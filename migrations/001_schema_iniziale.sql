@@ -0,0 +1,42 @@
+-- Schema di partenza: le tabelle create finora da crea_tabelle_se_mancanti.
+-- IF NOT EXISTS rende la migrazione innocua sui database già esistenti.
+
+CREATE TABLE IF NOT EXISTS prezzi_regionali (
+    id SERIAL PRIMARY KEY,
+    regione TEXT NOT NULL,
+    tipo_carburante TEXT NOT NULL,
+    prezzo_medio NUMERIC(6, 3) NOT NULL,
+    data_aggiornamento DATE NOT NULL,
+    UNIQUE (regione, tipo_carburante, data_aggiornamento)
+);
+
+CREATE TABLE IF NOT EXISTS impianti (
+    id_impianto INTEGER PRIMARY KEY,
+    gestore TEXT,
+    bandiera TEXT,
+    nome TEXT,
+    indirizzo TEXT,
+    comune TEXT,
+    provincia TEXT,
+    latitudine DOUBLE PRECISION NOT NULL,
+    longitudine DOUBLE PRECISION NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS prezzi_impianti (
+    id_impianto INTEGER NOT NULL,
+    carburante TEXT NOT NULL,
+    prezzo NUMERIC(6, 3) NOT NULL,
+    self_service BOOLEAN NOT NULL,
+    data_comunicazione TIMESTAMP,
+    PRIMARY KEY (id_impianto, carburante, self_service)
+);
+
+CREATE TABLE IF NOT EXISTS avvisi_prezzo (
+    id SERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    regione TEXT NOT NULL,
+    tipo_carburante TEXT NOT NULL,
+    soglia NUMERIC(6, 3) NOT NULL,
+    notificato BOOLEAN NOT NULL DEFAULT FALSE, -- TRUE dopo l'avviso, finché il prezzo non torna sopra soglia
+    UNIQUE (chat_id, regione, tipo_carburante)
+);
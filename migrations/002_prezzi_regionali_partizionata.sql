@@ -0,0 +1,44 @@
+-- prezzi_regionali diventa partizionata per mese su data_aggiornamento: la retention
+-- elimina partizioni intere (DROP TABLE) invece di cancellare righe con DELETE.
+-- Una chiave primaria su tabella partizionata deve includere la colonna di partizione:
+-- la chiave naturale (già vincolo UNIQUE) sostituisce la colonna id, mai usata dalle query.
+-- Le partizioni dei mesi futuri le crea il bot prima di ogni import (assicura_partizioni).
+
+ALTER TABLE prezzi_regionali RENAME TO prezzi_regionali_non_partizionata;
+
+CREATE TABLE prezzi_regionali (
+    regione TEXT NOT NULL,
+    tipo_carburante TEXT NOT NULL,
+    prezzo_medio NUMERIC(6, 3) NOT NULL,
+    data_aggiornamento DATE NOT NULL,
+    CONSTRAINT prezzi_regionali_chiave PRIMARY KEY (regione, tipo_carburante, data_aggiornamento)
+) PARTITION BY RANGE (data_aggiornamento);
+
+-- Indice coprente per "ultimi prezzi di una regione": MAX(data) e righe di quella data
+-- si leggono con un index-only scan, senza visitare la tabella.
+CREATE INDEX prezzi_regionali_ultimi_per_regione
+    ON prezzi_regionali (regione, data_aggiornamento DESC)
+    INCLUDE (tipo_carburante, prezzo_medio);
+
+-- Una partizione per ogni mese già presente nei dati, poi il travaso
+DO $$
+DECLARE
+    mese DATE;
+BEGIN
+    FOR mese IN
+        SELECT DISTINCT date_trunc('month', data_aggiornamento)::date
+        FROM prezzi_regionali_non_partizionata
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF prezzi_regionali FOR VALUES FROM (%L) TO (%L)',
+            'prezzi_regionali_' || to_char(mese, 'YYYY_MM'), mese, (mese + INTERVAL '1 month')::date
+        );
+    END LOOP;
+END
+$$;
+
+INSERT INTO prezzi_regionali (regione, tipo_carburante, prezzo_medio, data_aggiornamento)
+SELECT regione, tipo_carburante, prezzo_medio, data_aggiornamento
+FROM prezzi_regionali_non_partizionata;
+
+DROP TABLE prezzi_regionali_non_partizionata;
@@ -0,0 +1,11 @@
+-- Outbox delle notifiche degli avvisi di prezzo. Le righe vengono scritte nella stessa
+-- transazione che marca gli avvisi come notificati e cancellate solo dopo l'invio
+-- (o un rifiuto definitivo di Telegram): al riavvio il bot riaccoda quelle rimaste,
+-- così un deploy durante lo smaltimento della coda non perde notifiche.
+
+CREATE TABLE notifiche_in_uscita (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    testo TEXT NOT NULL,
+    creata_il TIMESTAMPTZ NOT NULL DEFAULT now()
+);
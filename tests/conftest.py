@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import bot
+
+
+@pytest.fixture
+def db_in_process(monkeypatch, tmp_path):
+    """Pool del bot sul sostituto in-process di PostgreSQL, con file di stato in una cartella temporanea."""
+    monkeypatch.setattr(bot, "SNAPSHOT_FILE", str(tmp_path / "snapshot_prezzi.json"))
+    monkeypatch.setattr(bot, "STATO_DOWNLOAD_FILE", str(tmp_path / "stato_download.json"))
+    for nome in ("DB_HOST", "DB_PORT", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+        monkeypatch.setattr(bot, nome, "in-process")
+    monkeypatch.setattr(bot, "_db_pool", bot.PoolConnessioni(benchmark.ConnessioneFinta, 1, 2, 300, 10, 30))
+    monkeypatch.setattr(bot, "_snapshot_prezzi", bot.SnapshotPrezzi())
+    monkeypatch.setattr(bot, "_matrice_prezzi", bot.MatricePrezzi())
+    monkeypatch.setattr(bot, "_dispatcher_notifiche", None)
+
+
+@pytest.fixture
+def server_csv(monkeypatch):
+    """Server HTTP locale con ETag/Last-Modified che serve il CSV regionale a bot.CSV_URL."""
+    contenuti = {}
+    server, url_base = benchmark.avvia_server_http(contenuti, condizionale=True)
+    monkeypatch.setattr(bot, "CSV_URL", url_base + "/MediaRegionaleStradale.csv")
+    yield server, contenuti
+    server.shutdown()
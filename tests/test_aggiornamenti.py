@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from telegram.ext import Application
+
+import bot
+
+
+@pytest.fixture
+def aggiornamenti_contati(monkeypatch):
+    """Sostituisce gli aggiornamenti con versioni lente che contano le esecuzioni in parallelo."""
+    conteggio = {"in_corso": 0, "massimo": 0, "esecuzioni": 0}
+    lock = threading.Lock()
+    rilascia = threading.Event()
+
+    def aggiornamento_lento(report=None, forza=False, annullamento=None):
+        with lock:
+            conteggio["in_corso"] += 1
+            conteggio["esecuzioni"] += 1
+            conteggio["massimo"] = max(conteggio["massimo"], conteggio["in_corso"])
+        try:
+            rilascia.wait(5)
+            if report is not None:
+                report["esito"] = "aggiornato"
+            return True
+        finally:
+            with lock:
+                conteggio["in_corso"] -= 1
+
+    monkeypatch.setattr(bot, "update_database", aggiornamento_lento)
+    monkeypatch.setattr(bot, "update_impianti", lambda report=None, forza=False, annullamento=None: True)
+    monkeypatch.setattr(bot, "gestore_aggiornamenti", bot.GestoreAggiornamenti())
+    monkeypatch.setattr(bot, "UPDATE_SECRET", "segreto")
+    return conteggio, rilascia
+
+
+def test_raffica_di_avvii_concorrenti_un_solo_job(aggiornamenti_contati):
+    conteggio, rilascia = aggiornamenti_contati
+    partenza = threading.Barrier(50)
+    job_ids = []
+
+    def avvia():
+        partenza.wait()
+        job, _ = bot.gestore_aggiornamenti.avvia("http")
+        job_ids.append(job.id)
+
+    threads = [threading.Thread(target=avvia) for _ in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    scheduler = threading.Thread(target=bot.gestore_aggiornamenti.esegui)
+    scheduler.start()
+    time.sleep(0.05)
+    rilascia.set()
+    scheduler.join(5)
+
+    assert len(set(job_ids)) == 1
+    assert conteggio["esecuzioni"] == 1
+    assert conteggio["massimo"] == 1
+    assert bot.gestore_aggiornamenti.stato()["ultimi"][0]["stato"] == "completato"
+
+
+def test_raffica_di_trigger_http_un_solo_job_alla_volta(aggiornamenti_contati):
+    conteggio, rilascia = aggiornamenti_contati
+
+    async def esegui():
+        application = Application.builder().token("123:test").build()
+        async with TestClient(TestServer(bot.crea_app_web(application))) as client:
+            async def trigger():
+                risposta = await client.post("/trigger-update?secret=segreto")
+                assert risposta.status == 202
+                return await risposta.json()
+
+            risposte = await asyncio.gather(*(trigger() for _ in range(200)))
+            in_corso = (await (await client.get("/update-status")).json())["in_corso"]
+            rilascia.set()
+            while (await (await client.get("/update-status")).json())["in_corso"]:
+                await asyncio.sleep(0.01)
+        return risposte, in_corso
+
+    risposte, in_corso = asyncio.run(esegui())
+    assert len({r["job_id"] for r in risposte}) == 1
+    assert sum(r["nuovo"] for r in risposte) == 1
+    assert in_corso["job_id"] == risposte[0]["job_id"]
+    assert conteggio["esecuzioni"] == 1
+    assert conteggio["massimo"] == 1
+
+
+def test_stato_restituisce_copie_dei_report():
+    job = bot.JobAggiornamento(id="abc", origine="http", avviato_il=datetime.now())
+    job.report_prezzi["tempi"] = {"download": 0.1}
+    stato = job.come_dict()
+    job.report_prezzi["tempi"]["analisi"] = 0.2
+    job.report_prezzi["esito"] = "aggiornato"
+    assert stato["prezzi_regionali"] == {"tempi": {"download": 0.1}}
+
+
+@pytest.mark.parametrize("percorso", ["/trigger-update", "/update-cancel"])
+def test_secret_non_ascii_rifiutato_con_403(monkeypatch, percorso):
+    monkeypatch.setattr(bot, "UPDATE_SECRET", "segreto")
+
+    async def esegui():
+        application = Application.builder().token("123:test").build()
+        async with TestClient(TestServer(bot.crea_app_web(application))) as client:
+            return (await client.post(f"{percorso}?secret=s%C3%A8greto")).status
+
+    assert asyncio.run(esegui()) == 403
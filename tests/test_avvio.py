@@ -0,0 +1,39 @@
+import asyncio
+import socket
+import time
+
+import psycopg2
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def db_muto(monkeypatch):
+    """Porta locale che accetta la connessione TCP ma non risponde mai, come un DB bloccato."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+    monkeypatch.setattr(bot, "DB_HOST", "127.0.0.1")
+    monkeypatch.setattr(bot, "DB_PORT", str(server.getsockname()[1]))
+    for nome in ("DB_NAME", "DB_USER", "DB_PASSWORD"):
+        monkeypatch.setattr(bot, nome, "bot")
+    monkeypatch.setattr(bot, "DB_CONNECT_TIMEOUT", 2)
+    monkeypatch.setattr(bot, "DB_POOL_MIN", 1)
+    monkeypatch.setattr(bot, "_async_db_pool", None)
+    yield
+    server.close()
+
+
+def test_connessione_sincrona_rinuncia_entro_il_timeout(db_muto):
+    inizio = time.monotonic()
+    with pytest.raises(psycopg2.OperationalError):
+        bot._apri_connessione_db()
+    assert time.monotonic() - inizio < 5
+
+
+def test_pool_asincrono_rinuncia_entro_il_timeout(db_muto):
+    inizio = time.monotonic()
+    asyncio.run(bot.apri_pool_async())
+    assert time.monotonic() - inizio < 5
+    assert bot._async_db_pool is None
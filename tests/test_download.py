@@ -0,0 +1,84 @@
+import random
+
+import psycopg2
+
+import benchmark
+import bot
+
+
+def csv_regionale(seme: int = 1) -> bytes:
+    return benchmark.genera_csv_regionale(200, random.Random(seme))
+
+
+def richieste_csv(server) -> list:
+    return [intestazioni for percorso, intestazioni in server.richieste if percorso == "/MediaRegionaleStradale.csv"]
+
+
+def test_primo_import_salva_etag_e_last_modified(db_in_process, server_csv):
+    server, contenuti = server_csv
+    contenuti["/MediaRegionaleStradale.csv"] = csv_regionale()
+
+    report = {}
+    assert bot.update_database(report)
+    assert report["esito"] == "aggiornato"
+    stato = bot._leggi_stato_download()[bot.CSV_URL]
+    assert stato["etag"] and stato["last_modified"] and stato["sha256"]
+
+
+def test_304_non_rielabora_il_csv(db_in_process, server_csv):
+    server, contenuti = server_csv
+    contenuti["/MediaRegionaleStradale.csv"] = csv_regionale()
+    assert bot.update_database()
+    etag = bot._leggi_stato_download()[bot.CSV_URL]["etag"]
+
+    report = {}
+    assert bot.update_database(report)
+    assert report["esito"] == "invariato"
+    assert "analisi" not in report["tempi"]
+    seconda = richieste_csv(server)[-1]
+    assert seconda["If-None-Match"] == etag
+    assert seconda["If-Modified-Since"] == "Wed, 14 Oct 2026 08:00:00 GMT"
+
+
+def test_contenuto_identico_senza_etag_saltato_per_hash(db_in_process, monkeypatch):
+    contenuti = {"/MediaRegionaleStradale.csv": csv_regionale()}
+    server, url_base = benchmark.avvia_server_http(contenuti)
+    monkeypatch.setattr(bot, "CSV_URL", url_base + "/MediaRegionaleStradale.csv")
+    try:
+        assert bot.update_database()
+        report = {}
+        assert bot.update_database(report)
+    finally:
+        server.shutdown()
+    assert report["esito"] == "invariato"
+    assert "If-None-Match" not in richieste_csv(server)[-1]
+
+
+def test_contenuto_cambiato_viene_importato(db_in_process, server_csv):
+    server, contenuti = server_csv
+    contenuti["/MediaRegionaleStradale.csv"] = csv_regionale(1)
+    assert bot.update_database()
+    contenuti["/MediaRegionaleStradale.csv"] = csv_regionale(2)
+
+    report = {}
+    assert bot.update_database(report)
+    assert report["esito"] == "aggiornato"
+
+
+def test_stato_salvato_solo_dopo_il_commit(db_in_process, server_csv, monkeypatch):
+    server, contenuti = server_csv
+    contenuti["/MediaRegionaleStradale.csv"] = csv_regionale()
+
+    class ConnessioneCommitFallito(benchmark.ConnessioneFinta):
+        def commit(self):
+            raise psycopg2.OperationalError("commit fallito")
+
+    monkeypatch.setattr(bot, "_db_pool", bot.PoolConnessioni(ConnessioneCommitFallito, 1, 2, 300, 10, 30))
+    assert not bot.update_database()
+    assert bot.CSV_URL not in bot._leggi_stato_download()
+
+    # Al tentativo successivo il file va rielaborato, non saltato come invariato
+    monkeypatch.setattr(bot, "_db_pool", bot.PoolConnessioni(benchmark.ConnessioneFinta, 1, 2, 300, 10, 30))
+    report = {}
+    assert bot.update_database(report)
+    assert report["esito"] == "aggiornato"
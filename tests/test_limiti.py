@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+import benchmark
+import bot
+
+
+@pytest.fixture
+def dati_saturi(monkeypatch):
+    """Nessun posto libero per accedere ai dati e attesa massima minima."""
+    monkeypatch.setattr(bot, "_limite_accessi_dati", asyncio.Semaphore(0))
+    monkeypatch.setattr(bot, "ATTESA_MASSIMA_ACCESSO", 0.01)
+    monkeypatch.setattr(bot, "_async_db_pool", object())
+    chiamate = []
+
+    async def non_chiamare(*args):
+        chiamate.append(args)
+
+    for nome in ("salva_avviso", "elenca_avvisi", "rimuovi_avviso"):
+        monkeypatch.setattr(bot, nome, non_chiamare)
+    return chiamate
+
+
+class MessaggioRegistrato(benchmark.MessaggioFinto):
+    def __init__(self, api):
+        super().__init__("", api)
+        self.risposte = []
+
+    async def reply_text(self, text, **kwargs):
+        self.risposte.append(text)
+        return await super().reply_text(text, **kwargs)
+
+
+@pytest.mark.parametrize("handler, argomenti", [
+    (bot.avviso_command, ["Lombardia", "Gasolio", "1,70"]),
+    (bot.avvisi_command, []),
+    (bot.rimuovi_avviso_command, ["1"]),
+])
+def test_handler_degli_avvisi_passano_dal_limite_globale(dati_saturi, handler, argomenti):
+    api = benchmark.ApiFinta(0)
+    update = benchmark.UpdateFinto("", api, chat_id=id(handler))
+    update.message = MessaggioRegistrato(api)
+    contesto = benchmark.ContestoFinto(api)
+    contesto.args = argomenti
+    asyncio.run(handler(update, contesto))
+    assert update.message.risposte == [bot._MESSAGGIO_SOVRACCARICO]
+    assert dati_saturi == []
+
+
+def test_accesso_dati_rilascia_il_posto_anche_in_caso_di_errore(monkeypatch):
+    async def esegui():
+        monkeypatch.setattr(bot, "_limite_accessi_dati", asyncio.Semaphore(1))
+        with pytest.raises(RuntimeError):
+            async with bot.accesso_dati():
+                raise RuntimeError()
+        async with bot.accesso_dati():
+            pass
+
+    asyncio.run(esegui())
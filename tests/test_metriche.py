@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+import random
+
+import benchmark
+import bot
+
+# ~2 µs misurati per chiamata: la soglia lascia margine alle macchine lente ma resta
+# trascurabile anche rispetto al percorso strumentato più rapido (/Regione dallo
+# snapshot, ~70 µs) e a qualsiasi chiamata alla Bot API o al DB
+OVERHEAD_MASSIMO_NS = 20_000
+
+
+def test_overhead_misura_durata_trascurabile():
+    # Il minimo di più esecuzioni riduce il rumore di scheduling sulla macchina di test
+    esecuzioni = [benchmark.bench_metriche(argparse.Namespace(chiamate=20_000)) for _ in range(3)]
+    assert min(e["overhead_async_ns"] for e in esecuzioni) < OVERHEAD_MASSIMO_NS
+    assert min(e["overhead_sync_ns"] for e in esecuzioni) < OVERHEAD_MASSIMO_NS
+
+
+
+def test_cache_messaggi_esposta_come_counter():
+    bot.statistiche_cache_messaggi.registra(hit=True)
+    metrica = bot.CACHE_MESSAGGI.collect()[0]
+    assert metrica.type == "counter"
+    assert any(c.name == "bot_cache_messaggi_total" and c.labels == {"esito": "hit"} for c in metrica.samples)
+
+
+def test_regione_dallo_snapshot_registra_la_durata_della_lettura(monkeypatch):
+    monkeypatch.setattr(bot, "_snapshot_prezzi", benchmark.snapshot_sintetico(random.Random(1)))
+    prima = bot.DURATA_LETTURA_PREZZI.collect()[0]
+    conteggio = lambda metrica: next(c.value for c in metrica.samples if c.name.endswith("_count"))
+    iniziale = conteggio(prima)
+    api = benchmark.ApiFinta(0)
+    asyncio.run(bot.regione_command(benchmark.UpdateFinto("/Lombardia", api, chat_id=424242), benchmark.ContestoFinto(api)))
+    assert api.chiamate == {"sendMessage": 1}
+    assert conteggio(bot.DURATA_LETTURA_PREZZI.collect()[0]) == iniziale + 1
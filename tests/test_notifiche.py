@@ -0,0 +1,54 @@
+import asyncio
+
+from telegram.error import Forbidden, NetworkError
+
+import bot
+
+
+class BotRegistrato:
+    """Bot API finta: per ogni chat restituisce l'esito configurato e registra gli invii riusciti."""
+
+    def __init__(self, errori: dict):
+        self._errori = errori
+        self.inviati = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if chat_id in self._errori:
+            raise self._errori[chat_id]
+        self.inviati.append(chat_id)
+
+
+def esegui_dispatcher(bot_finto, notifiche, **opzioni):
+    confermate = []
+
+    async def conferma(id_notifica):
+        confermate.append(id_notifica)
+
+    async def esegui():
+        dispatcher = bot.DispatcherNotifiche(bot_finto, messaggi_al_secondo=None, intervallo_chat=0,
+                                             conferma=conferma, **opzioni)
+        dispatcher.avvia()
+        dispatcher.accoda(notifiche)
+        await dispatcher.attendi_svuotamento()
+        await dispatcher.ferma()
+        return dispatcher
+
+    return asyncio.run(esegui()), confermate
+
+
+def test_confermate_solo_le_notifiche_inviate_o_rifiutate_definitivamente():
+    bot_finto = BotRegistrato({2: Forbidden("bot bloccato"), 3: NetworkError("timeout")})
+    dispatcher, confermate = esegui_dispatcher(
+        bot_finto, [(1, "a", 10), (2, "b", 20), (3, "c", 30), (4, "d", None)], max_tentativi=1
+    )
+    assert sorted(bot_finto.inviati) == [1, 4]
+    # La 30 è fallita per un errore temporaneo: resta nell'outbox per il prossimo avvio
+    assert sorted(confermate) == [10, 20]
+    assert dispatcher.inviati == 2 and dispatcher.falliti == 2
+
+
+def test_notifica_gia_in_coda_non_viene_duplicata():
+    bot_finto = BotRegistrato({})
+    _, confermate = esegui_dispatcher(bot_finto, [(1, "a", 10), (1, "a", 10), (2, "b", 11)])
+    assert sorted(bot_finto.inviati) == [1, 2]
+    assert sorted(confermate) == [10, 11]
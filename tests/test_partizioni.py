@@ -0,0 +1,83 @@
+from datetime import date
+
+import pytest
+
+import bot
+
+
+class CursoreRegistrato:
+    """Cursore psycopg2 finto: restituisce le partizioni indicate e registra le query eseguite."""
+
+    def __init__(self, partizioni):
+        self._partizioni = partizioni
+        self.query = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, parametri=None):
+        self.query.append(query.strip())
+
+    def fetchall(self):
+        return [(nome,) for nome in self._partizioni]
+
+
+class ConnessioneRegistrata:
+    def __init__(self, partizioni):
+        self.cursore = CursoreRegistrato(partizioni)
+
+    def cursor(self):
+        return self.cursore
+
+
+def con_oggi(monkeypatch, oggi: date):
+    class DataFissa(date):
+        @classmethod
+        def today(cls):
+            return cls(oggi.year, oggi.month, oggi.day)
+
+    monkeypatch.setattr(bot, "date", DataFissa)
+
+
+PARTIZIONI = [
+    "prezzi_regionali_2025_10",
+    "prezzi_regionali_2025_11",
+    "prezzi_regionali_2025_12",
+    "prezzi_regionali_2026_01",
+    "prezzi_regionali_2026_02",
+    "prezzi_regionali_non_partizionata", # nome che non corrisponde al formato: mai toccato
+]
+
+
+@pytest.mark.parametrize("oggi, giorni, attese", [
+    # limite 16/12/2025: novembre è tutto più vecchio, dicembre contiene ancora giorni da tenere
+    (date(2026, 1, 15), 30, ["prezzi_regionali_2025_10", "prezzi_regionali_2025_11"]),
+    # limite 31/12/2025: il 31 dicembre ha esattamente 30 giorni e va tenuto
+    (date(2026, 1, 30), 30, ["prezzi_regionali_2025_10", "prezzi_regionali_2025_11"]),
+    # limite 01/01/2026: dicembre (fino al 31) è tutto fuori dalla finestra
+    (date(2026, 1, 31), 30, ["prezzi_regionali_2025_10", "prezzi_regionali_2025_11", "prezzi_regionali_2025_12"]),
+    # finestra lunga: nessuna partizione abbastanza vecchia
+    (date(2026, 1, 15), 120, []),
+])
+def test_elimina_solo_partizioni_interamente_scadute(monkeypatch, oggi, giorni, attese):
+    con_oggi(monkeypatch, oggi)
+    conn = ConnessioneRegistrata(PARTIZIONI)
+    assert bot.elimina_partizioni_scadute(conn, giorni) == attese
+    assert [q for q in conn.cursore.query if q.startswith("DROP")] == [f"DROP TABLE {nome};" for nome in attese]
+
+
+def test_mese_successivo_a_cavallo_d_anno():
+    assert bot._mese_successivo(date(2025, 12, 1)) == date(2026, 1, 1)
+    assert bot._mese_successivo(date(2025, 12, 31)) == date(2026, 1, 1)
+    assert bot._mese_successivo(date(2026, 1, 31)) == date(2026, 2, 1)
+    assert bot._mese_successivo(date(2026, 11, 30)) == date(2026, 12, 1)
+
+
+def test_partizione_di_dicembre_termina_a_gennaio():
+    assert bot.sql_partizione_mese(date(2025, 12, 17)) == (
+        "CREATE TABLE IF NOT EXISTS prezzi_regionali_2025_12 PARTITION OF prezzi_regionali "
+        "FOR VALUES FROM ('2025-12-01') TO ('2026-01-01');"
+    )
@@ -0,0 +1,43 @@
+import psycopg2
+import pytest
+
+import benchmark
+import bot
+
+
+def connettore_che_fallisce_alla(n: int):
+    aperte = []
+
+    def connetti():
+        if len(aperte) + 1 == n:
+            aperte.append(None)
+            raise psycopg2.OperationalError("connessione rifiutata")
+        conn = benchmark.ConnessioneFinta()
+        aperte.append(conn)
+        return conn
+    return connetti
+
+
+def test_preriscalda_apre_tutte_le_connessioni_minime():
+    pool = bot.PoolConnessioni(benchmark.ConnessioneFinta, 4, 8, 300, 1, 30)
+    pool.preriscalda()
+    assert pool._totali == 4
+    assert len(pool._libere) == 4
+
+
+def test_preriscalda_fallito_restituisce_le_connessioni_gia_aperte():
+    pool = bot.PoolConnessioni(connettore_che_fallisce_alla(3), 4, 4, 300, 1, 30)
+    with pytest.raises(psycopg2.OperationalError):
+        pool.preriscalda()
+    assert pool._totali == 2
+    assert len(pool._libere) == 2
+
+
+def test_connessioni_in_uso_chiuse_al_rilascio_dopo_chiudi_tutte():
+    pool = bot.PoolConnessioni(benchmark.ConnessioneFinta, 0, 2, 300, 1, 30)
+    in_uso = pool.acquisisci()
+    pool.chiudi_tutte()
+    pool.rilascia(in_uso)
+    assert in_uso.closed
+    assert pool._totali == 0
+    assert not pool._libere
@@ -0,0 +1,14 @@
+from datetime import date
+
+import bot
+
+
+def test_db_vuoto_non_sovrascrive_lo_snapshot_caricato_da_file(db_in_process):
+    prezzi = {"Lombardia": {"Benzina": 1.85, "Gasolio": 1.74}}
+    bot.salva_snapshot_su_file(bot.crea_snapshot_prezzi(prezzi, {"Lombardia": date(2026, 10, 15)}))
+    assert bot.carica_snapshot_da_file()
+
+    assert bot.aggiorna_snapshot_prezzi() # il DB in-process risponde senza righe
+    snapshot = bot.ottieni_snapshot()
+    assert snapshot.prezzi == prezzi
+    assert snapshot.messaggio("Lombardia") is not None
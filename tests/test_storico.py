@@ -0,0 +1,58 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+
+import pytest
+
+import benchmark
+import bot
+
+
+class PoolRotto:
+    """Come un ProcessPoolExecutor il cui processo figlio è morto."""
+
+    def __init__(self):
+        self.fermato = False
+
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool("processo figlio terminato")
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.fermato = True
+
+
+@pytest.fixture
+def storico_sintetico(monkeypatch, tmp_path):
+    async def leggi_storico(regione, giorni, carburante=None):
+        return {"Benzina": ([date(2026, 10, 14), date(2026, 10, 15)], [1.80, 1.82])}
+
+    monkeypatch.setattr(bot, "leggi_storico_regione", leggi_storico)
+    monkeypatch.setattr(bot, "disegna_grafico_storico", lambda regione, serie, giorni: b"png")
+    monkeypatch.setattr(bot, "_async_db_pool", object())
+    monkeypatch.setattr(bot, "_snapshot_prezzi", bot.SnapshotPrezzi())
+    monkeypatch.setattr(bot, "cache_grafici", bot.CacheGrafici(str(tmp_path), max_memoria=10, max_disco=10))
+    monkeypatch.setattr(bot, "_crea_pool_grafici", lambda: ThreadPoolExecutor(max_workers=1))
+
+
+def test_pool_rotto_risposta_di_errore_e_pool_ricreato(storico_sintetico, monkeypatch):
+    rotto = PoolRotto()
+    api = benchmark.ApiFinta(0)
+
+    async def richiesta(chat_id):
+        contesto = benchmark.ContestoFinto(api)
+        contesto.args = ["Lombardia", "7"]
+        await bot.storico_command(benchmark.UpdateFinto("/storico", api, chat_id=chat_id), contesto)
+
+    async def esegui():
+        monkeypatch.setattr(bot, "_limite_grafici", asyncio.Semaphore(2))
+        monkeypatch.setattr(bot, "_pool_grafici", rotto)
+        await richiesta(1)
+        assert api.chiamate == {"sendMessage": 1}
+        await richiesta(2)
+
+    asyncio.run(esegui())
+    assert rotto.fermato
+    assert bot._pool_grafici is not rotto
+    assert api.chiamate == {"sendMessage": 1, "sendPhoto (caricamento)": 1}
+    bot._pool_grafici.shutdown()